@@ -1,3 +1,4 @@
-# download punkt model
-import nltk
-nltk.download('punkt')
+# download punkt model
+import nltk
+nltk.download('punkt')
+nltk.download('punkt_tab')
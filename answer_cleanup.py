@@ -0,0 +1,175 @@
+def _partial_suffix(text, pattern):
+    """Return the length of the longest end of text that is the beginning of pattern (but not all of it)."""
+    for length in range(min(len(pattern) - 1, len(text)), 0, -1):
+        if text.endswith(pattern[:length]):
+            return length
+    return 0
+
+
+class _Replace:
+    """Streaming text.replace(old, new)."""
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        self._buffer = ""
+
+    def feed(self, text):
+        buffer = self._buffer + text
+        output = []
+        while True:
+            index = buffer.find(self.old)
+            if index < 0:
+                break
+            output.append(buffer[:index] + self.new)
+            buffer = buffer[index + len(self.old):]
+        hold = _partial_suffix(buffer, self.old)
+        output.append(buffer[:len(buffer) - hold])
+        self._buffer = buffer[len(buffer) - hold:]
+        return "".join(output)
+
+    def finish(self):
+        buffer, self._buffer = self._buffer, ""
+        return buffer
+
+
+class _RemoveSpans:
+    """Streaming re.sub(re.escape(start) + '.*?' + re.escape(end) + '\\n?', '', text, flags=re.DOTALL)."""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self._buffer = ""
+        self._inside = False
+        self._drop_newline = False
+
+    def feed(self, text):
+        buffer = self._buffer + text
+        output = []
+        while buffer:
+            if self._drop_newline:
+                self._drop_newline = False
+                if buffer.startswith("\n"):
+                    buffer = buffer[1:]
+                    continue
+            if self._inside:
+                # hold everything after the start tag, an unclosed span is not removed
+                index = buffer.find(self.end, len(self.start))
+                if index < 0:
+                    break
+                buffer = buffer[index + len(self.end):]
+                self._inside = False
+                self._drop_newline = True
+                continue
+            index = buffer.find(self.start)
+            if index < 0:
+                hold = _partial_suffix(buffer, self.start)
+                output.append(buffer[:len(buffer) - hold])
+                buffer = buffer[len(buffer) - hold:]
+                break
+            output.append(buffer[:index])
+            buffer = buffer[index:]
+            self._inside = True
+        self._buffer = buffer
+        return "".join(output)
+
+    def finish(self):
+        buffer, self._buffer = self._buffer, ""
+        return buffer
+
+
+class _StripStart:
+    """Streaming removal of leading ai_name prefixes, whitespace and ':' (like the cleanup of message())."""
+
+    def __init__(self, ai_name=None):
+        self.ai_name = ai_name
+        self._buffer = ""
+        self._phase = 0 if ai_name else 1
+
+    def feed(self, text, final=False):
+        if self._phase > 3:
+            return text
+        buffer = self._buffer + text
+        if self._phase == 0:
+            while buffer.startswith(self.ai_name):
+                buffer = buffer[len(self.ai_name):]
+            if not final and self.ai_name.startswith(buffer):
+                self._buffer = buffer
+                return ""
+            self._phase = 1
+        while self._phase <= 3:
+            if self._phase == 2:
+                buffer = buffer.lstrip(":")
+            else:
+                buffer = buffer.lstrip()
+            if not final and buffer == "":
+                self._buffer = ""
+                return ""
+            # the ':' only follow a name
+            self._phase += 1 if self._phase == 2 or self.ai_name else 2
+        self._buffer = ""
+        return buffer
+
+    def finish(self):
+        return self.feed("", final=True)
+
+
+class _StripEnd:
+    """Streaming removal of trailing whitespace."""
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, text):
+        buffer = self._buffer + text
+        stripped = buffer.rstrip()
+        self._buffer = buffer[len(stripped):]
+        return stripped
+
+    def finish(self):
+        self._buffer = ""
+        return ""
+
+
+class AnswerCleaner:
+    def __init__(self, stages):
+        """Cleanup of a single answer. Text passes the stages in order, every stage only holds back what might still change."""
+        self._stages = stages
+
+    def feed(self, text):
+        """Add generated text, returns the cleaned text that is final."""
+        for stage in self._stages:
+            text = stage.feed(text)
+        return text
+
+    def finish(self):
+        """Return the rest of the cleaned text at the end of the answer."""
+        text = ""
+        for stage in self._stages:
+            text = stage.feed(text) + stage.finish()
+        return text
+
+
+class CleanupPipeline:
+    def __init__(self, remove_spans=(), replacements=(), ai_name=None):
+        """
+        Answer cleanup of an instruction config, applied in this order:
+        removal of remove_spans ((start, end) tags and everything between them, plus one following line break),
+        replacements ((old, new) in order), removal of leading ai_name prefixes and ':' (if ai_name is set)
+        and removal of leading and trailing whitespace.
+        """
+        self.remove_spans = list(remove_spans)
+        self.replacements = [(old, new) for old, new in replacements if old]
+        self.ai_name = ai_name
+
+    def stream(self):
+        """Return an AnswerCleaner for a streamed answer."""
+        stages = [_RemoveSpans(start, end) for start, end in self.remove_spans]
+        stages += [_Replace(old, new) for old, new in self.replacements]
+        stages += [_StripStart(self.ai_name), _StripEnd()]
+        return AnswerCleaner(stages)
+
+    def clean(self, text):
+        """Clean up a complete answer."""
+        cleaner = self.stream()
+        return cleaner.feed(text) + cleaner.finish()
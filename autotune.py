@@ -0,0 +1,303 @@
+# Finds the fastest llama.cpp settings (threads, batch size, GPU layers) for a .gguf model on this host
+# and saves them as a profile per model and host. model_registry.load_llama applies saved profiles.
+#
+# usage: python autotune.py [--model-file cache/llama2/model.gguf] [--cpus 4] [--quick]
+import argparse
+import functools
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import threading
+import time
+
+# llama.cpp default batch size (used when no profile exists)
+DEFAULT_BATCH_SIZE = 512
+# gpu_layers candidates if the number of layers of the model is unknown (99 = all)
+DEFAULT_GPU_LAYER_CANDIDATES = (0, 10, 20, 30, 40, 99)
+BATCH_SIZE_CANDIDATES = (64, 128, 256, 512)
+# the request the settings are optimized for: prompt tokens to evaluate and tokens to generate
+PROMPT_TOKENS = 512
+DECODE_TOKENS = 64
+BENCHMARK_TEXT = ("The quick brown fox jumps over the lazy dog while the assistant explains the weather, "
+                  "the history of the city and a recipe for dinner in a few short sentences. ")
+
+
+def _cpu_model():
+    try:
+        with open("/proc/cpuinfo", "r") as file:
+            for line in file:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def usable_cpus():
+    """Return the cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def physical_core_count(cpus):
+    """Return the number of physical cores among cpus (hyper-threads share a core)."""
+    cores = set()
+    try:
+        with open("/proc/cpuinfo", "r") as file:
+            processor = physical_id = None
+            for line in file:
+                key, _, value = line.partition(":")
+                key, value = key.strip(), value.strip()
+                if key == "processor":
+                    processor = int(value)
+                elif key == "physical id":
+                    physical_id = value
+                elif key == "core id" and processor in cpus:
+                    cores.add((physical_id, value))
+    except (OSError, ValueError):
+        pass
+    return len(cores) or len(cpus)
+
+
+@functools.lru_cache(maxsize=1)
+def gpu_names():
+    """Return the names of the NVIDIA GPUs (empty without nvidia-smi)."""
+    if shutil.which("nvidia-smi") is None:
+        return ()
+    try:
+        output = subprocess.run(["nvidia-smi", "--query-gpu=name", "--format=csv,noheader"],
+                                capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return ()
+    return tuple(line.strip() for line in output.splitlines() if line.strip())
+
+
+def host_fingerprint():
+    """Describe the hardware (and llama.cpp build) the settings depend on."""
+    try:
+        import llama_cpp
+        llama_version = llama_cpp.__version__
+    except (ImportError, AttributeError):
+        llama_version = None
+    return {
+        "machine": platform.machine(),
+        "cpu": _cpu_model(),
+        "logical_cores": os.cpu_count(),
+        # with MODEL_REPLICAS > 1, every replica runs on a share of the cores and needs its own profile
+        "usable_cores": len(usable_cpus()),
+        "gpus": list(gpu_names()),
+        "llama_cpp": llama_version,
+    }
+
+
+def host_key(fingerprint):
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def model_key(model_path):
+    """Identify a model file by name and size (hashing gigabytes of weights would take too long)."""
+    return f"{os.path.basename(model_path)}:{os.path.getsize(model_path)}"
+
+
+class ProfileStore:
+    def __init__(self, filename="autotune_profiles.json"):
+        """Tuned settings in a JSON file: {model key: {host key: profile}}."""
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.filename, "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, model_path):
+        """Return the profile of model_path on this host (or None)."""
+        with self._lock:
+            return self._read().get(model_key(model_path), {}).get(host_key(host_fingerprint()))
+
+    def put(self, model_path, profile):
+        with self._lock:
+            profiles = self._read()
+            profiles.setdefault(model_key(model_path), {})[host_key(profile['host'])] = profile
+            directory = os.path.dirname(self.filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_filename = self.filename + ".tmp"
+            with open(tmp_filename, "w") as file:
+                json.dump(profiles, file, indent=2)
+            os.replace(tmp_filename, self.filename)
+
+
+def _benchmark_tokens(llm, count):
+    tokens = llm.tokenize(BENCHMARK_TEXT.encode("utf-8"), add_bos=True)
+    text_tokens = llm.tokenize(BENCHMARK_TEXT.encode("utf-8"), add_bos=False)
+    while len(tokens) < count:
+        tokens += text_tokens
+    return tokens[:count]
+
+
+def benchmark(model_path, threads, threads_batch, batch_size, gpu_layers,
+              prompt_tokens=PROMPT_TOKENS, decode_tokens=DECODE_TOKENS):
+    """
+    Load the model with the given settings and return the prompt evaluation and decode speed (tokens per second).
+    Decoding feeds fixed tokens one at a time, so sampling is not part of the measurement.
+    """
+    from llama_cpp import Llama
+
+    llm = Llama(model_path=model_path, n_gpu_layers=gpu_layers, n_threads=threads, n_threads_batch=threads_batch,
+                n_batch=batch_size, n_ctx=prompt_tokens + decode_tokens + 8, use_mmap=True, verbose=False)
+    try:
+        tokens = _benchmark_tokens(llm, prompt_tokens + decode_tokens)
+        # the first evaluation allocates the compute buffers
+        llm.eval(tokens[:8])
+        llm.reset()
+
+        start_time = time.perf_counter()
+        llm.eval(tokens[:prompt_tokens])
+        prompt_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for token in tokens[prompt_tokens:]:
+            llm.eval([token])
+        decode_seconds = time.perf_counter() - start_time
+    finally:
+        del llm
+
+    return {
+        "prompt_tokens_per_second": round(prompt_tokens / prompt_seconds, 2),
+        "decode_tokens_per_second": round(decode_tokens / decode_seconds, 2),
+    }
+
+
+def request_seconds(result, prompt_tokens=PROMPT_TOKENS, decode_tokens=DECODE_TOKENS * 2):
+    """Estimated duration of a typical request (prompt evaluation and answer) with the speed of a benchmark result."""
+    return prompt_tokens / result["prompt_tokens_per_second"] + decode_tokens / result["decode_tokens_per_second"]
+
+
+def thread_candidates(cpus, quick=False):
+    """Thread counts to try: powers of two, the physical cores and all usable cores."""
+    count = len(cpus)
+    candidates = {count, physical_core_count(cpus), max(1, count // 2)}
+    if not quick:
+        threads = 1
+        while threads < count:
+            candidates.add(threads)
+            threads *= 2
+        candidates.add(max(1, physical_core_count(cpus) - 1))
+    return sorted(candidates)
+
+
+def _gpu_layer_candidates(model_path):
+    layers = _layer_count(model_path)
+    if layers is None:
+        return list(DEFAULT_GPU_LAYER_CANDIDATES)
+    # all layers (+1 for the output layer) and fractions of them
+    return sorted({0, layers // 4, layers // 2, layers * 3 // 4, layers + 1})
+
+
+def _layer_count(model_path):
+    try:
+        from llama_cpp import Llama
+        llm = Llama(model_path=model_path, n_gpu_layers=0, n_ctx=8, vocab_only=True, verbose=False)
+    except Exception:
+        return None
+    metadata = getattr(llm, "metadata", None) or {}
+    for key, value in metadata.items():
+        if key.endswith(".block_count"):
+            return int(value)
+    return None
+
+
+def tune(model_path, quick=False, log=print):
+    """
+    Benchmark settings for model_path on the cores this process may use and return the best profile.
+
+    The settings are tuned one after another: GPU layers (for the duration of a typical request),
+    the decode threads and the prompt evaluation threads (both from one thread sweep),
+    then the batch size (for prompt evaluation).
+    """
+    cpus = usable_cpus()
+    threads = physical_core_count(cpus)
+    settings = {"threads": threads, "threads_batch": threads, "batch_size": DEFAULT_BATCH_SIZE, "gpu_layers": 0}
+    trials = []
+
+    def run(**changes):
+        trial_settings = dict(settings, **changes)
+        try:
+            result = benchmark(model_path, trial_settings["threads"], trial_settings["threads_batch"],
+                               trial_settings["batch_size"], trial_settings["gpu_layers"])
+        except Exception as e:
+            # like running out of GPU memory
+            log(f"autotune {trial_settings}: failed ({e})")
+            return None
+        log(f"autotune {trial_settings}: {result['prompt_tokens_per_second']} prompt tokens/s, "
+            f"{result['decode_tokens_per_second']} tokens/s")
+        trials.append(dict(trial_settings, **result))
+        return result
+
+    started = time.perf_counter()
+    if gpu_names():
+        results = {layers: run(gpu_layers=layers) for layers in _gpu_layer_candidates(model_path)}
+        results = {layers: result for layers, result in results.items() if result is not None}
+        if results:
+            settings["gpu_layers"] = min(results, key=lambda layers: request_seconds(results[layers]))
+
+    results = {count: run(threads=count, threads_batch=count) for count in thread_candidates(cpus, quick)}
+    results = {count: result for count, result in results.items() if result is not None}
+    if not results:
+        raise RuntimeError(f"no benchmark of {model_path} succeeded")
+    settings["threads"] = max(results, key=lambda count: results[count]["decode_tokens_per_second"])
+    settings["threads_batch"] = max(results, key=lambda count: results[count]["prompt_tokens_per_second"])
+
+    if not quick:
+        results = {size: run(batch_size=size) for size in BATCH_SIZE_CANDIDATES}
+        results = {size: result for size, result in results.items() if result is not None}
+        if results:
+            settings["batch_size"] = max(results, key=lambda size: results[size]["prompt_tokens_per_second"])
+
+    # the speeds of the trials the settings were chosen by
+    prompt_speeds = [trial["prompt_tokens_per_second"] for trial in trials
+                     if (trial["threads_batch"], trial["batch_size"], trial["gpu_layers"]) ==
+                     (settings["threads_batch"], settings["batch_size"], settings["gpu_layers"])]
+    decode_speeds = [trial["decode_tokens_per_second"] for trial in trials
+                     if (trial["threads"], trial["gpu_layers"]) == (settings["threads"], settings["gpu_layers"])]
+    return dict(settings,
+                prompt_tokens_per_second=max(prompt_speeds),
+                decode_tokens_per_second=max(decode_speeds),
+                host=host_fingerprint(),
+                tuned_at=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                tuning_seconds=round(time.perf_counter() - started, 1),
+                trials=trials)
+
+
+def main():
+    # only the model settings, importing chatbot would open the chat histories and register every model
+    import chat_config
+
+    parser = argparse.ArgumentParser(description="Find the fastest llama.cpp settings for a model on this host.")
+    parser.add_argument("--model-file", help="path of the .gguf file (default: the default model of chat_config.py)")
+    parser.add_argument("--cpus", type=int, help="tune for the first CPUS usable cores (like the share of a replica with MODEL_REPLICAS)")
+    parser.add_argument("--quick", action="store_true", help="fewer thread counts, keep the default batch size")
+    parser.add_argument("--profiles", default=chat_config.AUTOTUNE_PROFILES, help="profile file (default: AUTOTUNE_PROFILES)")
+    args = parser.parse_args()
+
+    model_path = args.model_file or chat_config.transformer_model_path
+    if model_path is None or not os.path.exists(model_path):
+        parser.error("model file not found")
+    if args.cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, usable_cpus()[:args.cpus])
+
+    profile = tune(model_path, quick=args.quick)
+    ProfileStore(args.profiles).put(model_path, profile)
+    print(json.dumps({name: value for name, value in profile.items() if name != "trials"}, indent=2))
+    print(f"saved to {args.profiles}")
+
+
+if __name__ == "__main__":
+    main()
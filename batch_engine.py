@@ -0,0 +1,278 @@
+import codecs
+import collections
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+class BatchSequence:
+    def __init__(self, prompt_tokens, max_tokens=384, temperature=0.7, top_k=40, top_p=0.95, repeat_penalty=1.1,
+                 stop=None, last_n_tokens=64, should_stop=None):
+        """A single generation running in a BatchEngine slot. (see BatchEngine.submit)"""
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repeat_penalty = repeat_penalty
+        self.stop = [s for s in (stop or []) if s]
+        self.last_n_tokens = last_n_tokens
+        self.should_stop = should_stop
+
+        self.slot = None
+        self.n_past = 0  # tokens of this sequence in the KV cache
+        self.n_prompt_done = 0
+        self.next_token = None
+        self.generated_tokens = []
+        self.text = ""
+        self.finish_reason = None
+        self.error = None
+        self.cancelled = False
+
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._emitted = 0
+        self._pieces = queue.Queue()
+        self._done = threading.Event()
+
+    @property
+    def prefilled(self):
+        return self.n_prompt_done >= len(self.prompt_tokens)
+
+    def cancel(self):
+        """Stop generating. The slot is freed at the next token boundary."""
+        self.cancelled = True
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the sequence to finish and return the generated text."""
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return self.text
+
+    def stream(self):
+        """Yield the generated text in pieces as it is generated."""
+        while True:
+            piece = self._pieces.get()
+            if piece is None:
+                break
+            yield piece
+        if self.error is not None:
+            raise RuntimeError(self.error)
+
+    def _add_token(self, token, piece):
+        """Add a sampled token. Returns True if a stop string was generated."""
+        self.generated_tokens.append(token)
+        search_start = max(0, len(self.text) - max((len(s) for s in self.stop), default=0))
+        self.text += self._decoder.decode(piece)
+
+        for stop in self.stop:
+            index = self.text.find(stop, search_start)
+            if index >= 0:
+                self.text = self.text[:index]
+                return True
+
+        # hold back the end of the text if it could be the beginning of a stop string
+        hold = 0
+        for stop in self.stop:
+            for length in range(min(len(stop) - 1, len(self.text)), hold, -1):
+                if self.text.endswith(stop[:length]):
+                    hold = length
+                    break
+        self._emit(len(self.text) - hold)
+        return False
+
+    def _emit(self, end):
+        if end > self._emitted:
+            self._pieces.put(self.text[self._emitted:end])
+            self._emitted = end
+
+    def _finish(self, reason, error=None):
+        self.finish_reason = reason
+        self.error = error
+        if error is None:
+            self._emit(len(self.text))
+        self._pieces.put(None)
+        self._done.set()
+
+
+class BatchEngine:
+    def __init__(self, llm, n_slots=4, n_batch=512, seed=None, cpus=None):
+        """
+        Continuous batching on a single llama_cpp.Llama.
+
+        Every sequence gets its own KV cache slot (llama.cpp sequence id), llm must have been created with
+        n_ctx large enough for n_slots sequences. New sequences are admitted at token boundaries, their prompts
+        are evaluated in the same llama_decode() calls as the next tokens of the running sequences,
+        finished sequences free their slot right away.
+        The engine owns the llama context, llm must not be used for generation at the same time.
+        With cpus, the engine thread (and the threads llama.cpp starts from it) only runs on those cores.
+        """
+        import llama_cpp
+
+        self._llama_cpp = llama_cpp
+        self.llm = llm
+        self.n_slots = n_slots
+        self.n_batch = n_batch
+        self.slot_context_length = llm.n_ctx() // n_slots
+        self.n_vocab = llm.n_vocab()
+        self.eos_token = llm.token_eos()
+        self.cpus = cpus
+        self._rng = np.random.default_rng(seed)
+
+        self._batch = llama_cpp.llama_batch_init(n_batch, 0, n_slots)
+        self._slots = [None] * n_slots
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+        for slot in range(n_slots):
+            llama_cpp.llama_kv_cache_seq_rm(llm.ctx, slot, -1, -1)
+
+        self._thread = threading.Thread(target=self._run, name="batch-engine", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt_tokens, **sampling):
+        """
+        Queue a generation for prompt_tokens and return its BatchSequence.
+
+        sampling: max_tokens, temperature, top_k, top_p, repeat_penalty, stop (see BatchSequence)
+        and should_stop, a function that is called at every token boundary and cancels the sequence when it returns True.
+        """
+        sequence = BatchSequence(list(prompt_tokens), **sampling)
+        if len(sequence.prompt_tokens) >= self.slot_context_length:
+            raise ValueError(f"prompt has {len(sequence.prompt_tokens)} tokens, a slot holds {self.slot_context_length}")
+        with self._condition:
+            self._pending.append(sequence)
+            self._condition.notify()
+        return sequence
+
+    def active_count(self):
+        return sum(1 for sequence in self._slots if sequence is not None)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self._llama_cpp.llama_batch_free(self._batch)
+
+    def _run(self):
+        if self.cpus and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.cpus)
+        while True:
+            with self._condition:
+                while not self._closed and not self._pending and self.active_count() == 0:
+                    self._condition.wait()
+                if self._closed:
+                    break
+                self._admit()
+            try:
+                self._step()
+            except Exception as e:
+                print(f"batch engine error: {e}")
+                for sequence in self._slots:
+                    if sequence is not None:
+                        self._release(sequence, "error", str(e))
+
+        for sequence in self._slots:
+            if sequence is not None:
+                self._release(sequence, "error", "batch engine closed")
+        while self._pending:
+            self._pending.popleft()._finish("error", "batch engine closed")
+
+    def _admit(self):
+        """Move pending sequences into free slots. (called with the condition held)"""
+        for slot in range(self.n_slots):
+            if not self._pending:
+                return
+            if self._slots[slot] is None:
+                sequence = self._pending.popleft()
+                sequence.slot = slot
+                self._slots[slot] = sequence
+
+    def _release(self, sequence, reason, error=None):
+        self._llama_cpp.llama_kv_cache_seq_rm(self.llm.ctx, sequence.slot, -1, -1)
+        self._slots[sequence.slot] = None
+        sequence._finish(reason, error)
+
+    def _step(self):
+        """Evaluate one batch: the next token of every generating sequence plus as many prompt tokens as fit."""
+        for sequence in self._slots:
+            if sequence is not None and (sequence.cancelled or (sequence.should_stop is not None and sequence.should_stop())):
+                self._release(sequence, "cancelled")
+
+        items = []  # (sequence, token, position, compute logits)
+        for sequence in self._slots:
+            if sequence is not None and sequence.prefilled:
+                items.append((sequence, sequence.next_token, sequence.n_past, True))
+        for sequence in self._slots:
+            if sequence is None or sequence.prefilled:
+                continue
+            room = self.n_batch - len(items)
+            if room <= 0:
+                break
+            start = sequence.n_prompt_done
+            for index, token in enumerate(sequence.prompt_tokens[start:start + room], start):
+                items.append((sequence, token, index, index == len(sequence.prompt_tokens) - 1))
+        if not items:
+            return
+
+        batch = self._batch
+        batch.n_tokens = len(items)
+        for index, (sequence, token, position, logits) in enumerate(items):
+            batch.token[index] = token
+            batch.pos[index] = position
+            batch.n_seq_id[index] = 1
+            batch.seq_id[index][0] = sequence.slot
+            batch.logits[index] = logits
+        result = self._llama_cpp.llama_decode(self.llm.ctx, batch)
+        if result != 0:
+            raise RuntimeError(f"llama_decode failed ({result})")
+
+        for index, (sequence, token, position, logits) in enumerate(items):
+            sequence.n_past = position + 1
+            if not sequence.prefilled:
+                sequence.n_prompt_done = position + 1
+            if logits:
+                self._sample(sequence, index)
+
+    def _sample(self, sequence, batch_index):
+        logits_pointer = self._llama_cpp.llama_get_logits_ith(self.llm.ctx, batch_index)
+        logits = np.ctypeslib.as_array(logits_pointer, shape=(self.n_vocab,)).copy()
+
+        # repetition penalty (like llama.cpp) on the last tokens of the prompt and the answer
+        if sequence.repeat_penalty != 1.0:
+            recent = (sequence.prompt_tokens + sequence.generated_tokens)[-sequence.last_n_tokens:]
+            recent = np.unique(np.array(recent, dtype=np.intc))
+            penalized = logits[recent]
+            logits[recent] = np.where(penalized > 0, penalized / sequence.repeat_penalty, penalized * sequence.repeat_penalty)
+
+        if sequence.temperature <= 0:
+            token = int(np.argmax(logits))
+        else:
+            top_k = min(sequence.top_k, self.n_vocab) if sequence.top_k > 0 else self.n_vocab
+            candidates = np.argpartition(logits, -top_k)[-top_k:]
+            candidates = candidates[np.argsort(logits[candidates])[::-1]]
+            probabilities = np.exp((logits[candidates] - logits[candidates[0]]) / sequence.temperature)
+            probabilities /= probabilities.sum()
+            if sequence.top_p < 1.0:
+                keep = int(np.searchsorted(np.cumsum(probabilities), sequence.top_p)) + 1
+                candidates = candidates[:keep]
+                probabilities = probabilities[:keep] / probabilities[:keep].sum()
+            token = int(self._rng.choice(candidates, p=probabilities))
+
+        if token == self.eos_token:
+            self._release(sequence, "stop")
+            return
+        if sequence._add_token(token, self.llm.detokenize([token])):
+            self._release(sequence, "stop")
+            return
+        if len(sequence.generated_tokens) >= sequence.max_tokens or sequence.n_past + 1 >= self.slot_context_length:
+            self._release(sequence, "length")
+            return
+        sequence.next_token = token
@@ -0,0 +1,127 @@
+# Compares the tokenize-once chunker (summary_generator.chunk_token_ids) with the previous
+# sentence-by-sentence implementation on a synthetic multi-megabyte transcript.
+#
+# usage (from the repository root): python benchmarks/bench_chunking.py --size-mb 2
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import nltk
+
+import summary_generator
+
+WORDS = ("so i think we should talk about the release plan first because the build is still failing on windows "
+         "and nobody has looked at the memory leak yet but the new voice model sounds great honestly").split()
+
+
+def make_transcript(size_bytes, seed=0):
+    """Generate a chat-like transcript of roughly size_bytes characters."""
+    rng = random.Random(seed)
+    speakers = ["Alice", "Bob", "Carol", "Dave"]
+    lines = []
+    size = 0
+    while size < size_bytes:
+        # mostly short sentences, sometimes a very long rambling one with commas
+        if rng.random() < 0.01:
+            sentence = ", ".join(" ".join(rng.choices(WORDS, k=rng.randint(5, 15))) for _ in range(rng.randint(40, 80)))
+        else:
+            sentence = " ".join(rng.choices(WORDS, k=rng.randint(4, 30)))
+        line = f"{rng.choice(speakers)}: {sentence.capitalize()}{rng.choice(['.', '?', '!'])}"
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
+
+
+def legacy_chunk_text(text, max_length):
+    """The chunker summary_generator used before (encodes every sentence and sub-sentence separately)."""
+    tokenizer = summary_generator.tokenizer
+    total_length = len(tokenizer.encode(text))
+
+    if total_length <= max_length:
+        return [text]
+
+    sentences = nltk.sent_tokenize(text)
+    chunks = []
+    chunk = ""
+    chunk_length = 0
+
+    for sentence in sentences:
+        sentence_length = len(tokenizer.encode(sentence))
+
+        if sentence_length > max_length:
+            sub_sentences = sentence.split(", ")
+
+            for sub_sentence in sub_sentences:
+                sub_sentence_length = len(tokenizer.encode(sub_sentence))
+
+                if chunk_length + sub_sentence_length > max_length:
+                    chunks.append(chunk.strip())
+                    chunk = ""
+                    chunk_length = 0
+
+                if sub_sentence_length > max_length:
+                    sub_sentence = tokenizer.decode(tokenizer.encode(sub_sentence)[:max_length])
+                    sub_sentence_length = len(tokenizer.encode(sub_sentence))
+
+                chunk += sub_sentence + ", "
+                chunk_length += sub_sentence_length
+
+            continue
+
+        if chunk_length + sentence_length > max_length:
+            chunks.append(chunk.strip())
+            chunk = ""
+            chunk_length = 0
+
+        chunk += sentence + " "
+        chunk_length += sentence_length
+
+    if chunk:
+        chunks.append(chunk.strip())
+
+    return chunks
+
+
+def legacy_prepare(text, max_length):
+    """Legacy pre-model work: chunk the text, then the pipeline tokenizes every chunk again."""
+    chunks = legacy_chunk_text(text, max_length)
+    summary_generator.tokenizer(chunks, truncation=True)
+    return chunks
+
+
+def measure(function, *args, repeat=3):
+    """Return (best run time in seconds, result of the last run)."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark summary_generator chunking.")
+    parser.add_argument("--size-mb", type=float, nargs="+", default=[0.5, 1, 2])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    summary_generator.subsystem.ensure_loaded()
+    max_length = summary_generator.tokenizer.model_max_length
+    print(f"{'size':>8} {'legacy':>10} {'tokenize-once':>14} {'speedup':>8} {'chunks (legacy/new)':>20}")
+    for size_mb in args.size_mb:
+        text = make_transcript(int(size_mb * 1024 * 1024))
+        # the legacy chunks still need to be tokenized by the pipeline, the new chunks are token ids already
+        legacy_time, legacy_chunks = measure(legacy_prepare, text, max_length, repeat=args.repeat)
+        new_time, new_chunks = measure(summary_generator.chunk_token_ids, text, max_length, repeat=args.repeat)
+        print(f"{size_mb:>6.1f}MB {legacy_time:>9.2f}s {new_time:>13.2f}s {legacy_time / new_time:>7.1f}x "
+              f"{len(legacy_chunks):>10}/{len(new_chunks)}")
+
+
+if __name__ == "__main__":
+    main()
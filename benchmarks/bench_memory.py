@@ -0,0 +1,92 @@
+# Measures building, reopening and searching a vector_memory.MemoryIndex with many memories,
+# with the HNSW index (hnswlib) and with the exact search.
+# The vectors are random unit vectors around topic centers (like embeddings of chat messages),
+# so the embedding model is not part of the measurement.
+#
+# usage (from the repository root): python benchmarks/bench_memory.py --memories 100000 300000
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import vector_memory
+
+
+class RandomEmbedder:
+    name = "random-384"
+    dimension = 384
+
+    def __init__(self, topics=1000, spread=0.6, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.centers = vector_memory._normalize(self.rng.standard_normal((topics, self.dimension)).astype(np.float32))
+        self.spread = spread
+
+    def encode(self, texts):
+        centers = self.centers[self.rng.integers(0, len(self.centers), len(texts))]
+        noise = self.rng.standard_normal((len(texts), self.dimension)).astype(np.float32) * self.spread / np.sqrt(self.dimension)
+        return vector_memory._normalize(centers + noise)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run(count, use_ann, queries, top_k, batch_size=4096):
+    embedder = RandomEmbedder()
+    directory = tempfile.mkdtemp(prefix="bench-memory-")
+    index = vector_memory.MemoryIndex(directory, embedder, use_ann=use_ann)
+
+    start_time = time.perf_counter()
+    for start in range(0, count, batch_size):
+        size = min(batch_size, count - start)
+        memories = [{"name": "User", "text": f"memory {start + i}", "time": start + i} for i in range(size)]
+        index.append(memories, embedder.encode(memories))
+    build_seconds = time.perf_counter() - start_time
+    index.save()
+
+    start_time = time.perf_counter()
+    index = vector_memory.MemoryIndex(directory, embedder, use_ann=use_ann)
+    open_seconds = time.perf_counter() - start_time
+
+    latencies = []
+    recall_hits = 0
+    for query in embedder.encode([""] * queries):
+        start_time = time.perf_counter()
+        results = index.search(query, top_k)
+        latencies.append(time.perf_counter() - start_time)
+        # compare the best result with the exact nearest neighbour
+        exact_best = int(np.argmax(np.asarray(index.vectors[:index.count], dtype=np.float32) @ query))
+        recall_hits += results[0][1]["time"] == exact_best
+
+    return {
+        "memories": count,
+        "index": "hnsw" if index.ann is not None else "exact",
+        "build_s": round(build_seconds, 2),
+        "open_s": round(open_seconds, 2),
+        "search_p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "search_p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "top1_recall": round(recall_hits / queries, 3),
+        "vector_file_mb": round(os.path.getsize(os.path.join(directory, "vectors.f16")) / (1 << 20), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the long-term memory vector index.")
+    parser.add_argument("--memories", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=8)
+    args = parser.parse_args()
+
+    for count in args.memories:
+        for use_ann in (True, False):
+            print(run(count, use_ann, args.queries, args.top_k))
+
+
+if __name__ == "__main__":
+    main()
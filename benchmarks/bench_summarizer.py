@@ -0,0 +1,125 @@
+# Compares the summarizer backends (SUMMARY_BACKEND: torch, int8, onnx) on synthetic chat transcripts:
+# load time, latency per text, peak memory (RSS) and how close the summaries are to the ones of the float32 torch model
+# (ROUGE-L F1 and exact matches).
+# Every backend runs in its own process, so the memory of one doesn't count for the next.
+#
+# usage (from the repository root): python benchmarks/bench_summarizer.py --texts 20 --threads 4
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, ".."))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import summary_backends
+import summary_generator
+from bench_chunking import make_transcript
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rouge_l(candidate, reference):
+    """ROUGE-L F1 of the words of candidate and reference (longest common subsequence)."""
+    candidate, reference = candidate.lower().split(), reference.lower().split()
+    if not candidate or not reference:
+        return float(candidate == reference)
+    previous = [0] * (len(reference) + 1)
+    for word in candidate:
+        current = [0]
+        for column, reference_word in enumerate(reference):
+            current.append(previous[column] + 1 if word == reference_word else max(previous[column + 1], current[column]))
+        previous = current
+    common = previous[-1]
+    if common == 0:
+        return 0.0
+    precision, recall = common / len(candidate), common / len(reference)
+    return 2 * precision * recall / (precision + recall)
+
+
+def run_backend(texts, max_length):
+    """Summarize texts one at a time with the backend of this process and return the measurements and summaries."""
+    rss_before = rss_mb()
+    start_time = time.perf_counter()
+    summary_generator.subsystem.ensure_loaded()
+    load_seconds = time.perf_counter() - start_time
+
+    # the first generate() call allocates buffers (and compiles kernels)
+    summary_generator.summarize(texts[0], max_length=max_length)
+    latencies = []
+    summaries = []
+    for text in texts:
+        start_time = time.perf_counter()
+        summaries.append(summary_generator.summarize(text, max_length=max_length))
+        latencies.append(time.perf_counter() - start_time)
+
+    return {
+        "backend": summary_generator.SUMMARY_BACKEND,
+        "threads": summary_generator.SUMMARY_THREADS,
+        "load_s": round(load_seconds, 2),
+        "latency_p50_s": round(percentile(latencies, 0.5), 3),
+        "latency_p95_s": round(percentile(latencies, 0.95), 3),
+        "texts_per_s": round(len(texts) / sum(latencies), 2),
+        "model_rss_mb": round(rss_mb() - rss_before, 1),
+        "max_rss_mb": round(rss_mb(), 1),
+        "summaries": summaries,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the summarizer backends.")
+    parser.add_argument("--backends", nargs="+", default=list(summary_backends.BACKENDS), choices=summary_backends.BACKENDS)
+    parser.add_argument("--texts", type=int, default=20)
+    parser.add_argument("--text-chars", type=int, default=1500, help="size of a transcript (about one chunk at 1500)")
+    parser.add_argument("--threads", type=int, default=0, help="SUMMARY_THREADS (0 = all cores)")
+    parser.add_argument("--max-length", type=int, default=142)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    texts = [make_transcript(args.text_chars, seed=seed) for seed in range(args.texts)]
+    if args.child:
+        try:
+            result = run_backend(texts, args.max_length)
+        except Exception as e:
+            # like a backend that is not installed
+            result = {"error": f"{type(e).__name__}: {' '.join(str(e).split())[:300]}"}
+        print(json.dumps(result))
+        return
+
+    reference = None
+    for backend in args.backends:
+        command = [sys.executable, os.path.abspath(__file__), "--child", "--texts", str(args.texts),
+                   "--text-chars", str(args.text_chars), "--max-length", str(args.max_length)]
+        env = dict(os.environ, SUMMARY_BACKEND=backend, SUMMARY_THREADS=str(args.threads))
+        output = subprocess.run(command, capture_output=True, text=True, env=env)
+        if output.returncode != 0:
+            print(json.dumps({"backend": backend, "error": f"exit code {output.returncode}"}))
+            continue
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        if "error" in result:
+            print(json.dumps({"backend": backend, **result}))
+            continue
+        summaries = result.pop("summaries")
+        if backend == "torch":
+            reference = summaries
+        if reference is not None:
+            # output quality compared with the float32 model
+            scores = [rouge_l(summary, reference_summary) for summary, reference_summary in zip(summaries, reference)]
+            result["rouge_l_vs_torch"] = round(sum(scores) / len(scores), 3)
+            result["exact_match_vs_torch"] = round(sum(a == b for a, b in zip(summaries, reference)) / len(summaries), 3)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
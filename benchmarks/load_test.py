@@ -0,0 +1,302 @@
+# Load test of the API server with the stub models (see stub_backends.py).
+#
+# Starts main.app with uvicorn in this process (histories in a temporary directory), sends a mix of
+# /chat, /chat_stream, /summary and /inject_memory requests from concurrent clients and prints
+# latency percentiles, time to first token, throughput and memory as JSON.
+# Server settings are read from the environment as usual (INFERENCE_MAX_QUEUE_SIZE, CHAT_HISTORY_BACKEND, ...).
+# With --workers > 1, the server runs as dispatcher.py with that many worker processes (of stub_app.py) instead.
+# Continuous batching (BATCH_ENGINE_SLOTS) needs the real llama.cpp and can't be used with the stub model.
+#
+# usage (from the repository root):
+#   python benchmarks/load_test.py --concurrency 8 --requests 200 --output benchmark_results.jsonl
+import argparse
+import asyncio
+import http.client
+import re
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.join(BENCHMARK_DIR, "..")
+sys.path.insert(0, REPOSITORY_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+AUTH_TOKEN = "benchmark"
+# instruction config with chat history and summaries, so persistence and summarization are part of the benchmark
+BENCHMARK_INSTRUCTION = "benchmark_chat"
+
+PROMPTS = ["what time is it", "tell me a joke about cats", "turn the volume down", "translate good morning to german",
+           "how is the weather today", "what is the capital of france", "remind me to drink water", "say hello to everyone"]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summarize_latencies(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.5),
+        "p90": percentile(values, 0.9),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def add_benchmark_instruction():
+    import chatbot
+
+    chatbot.instructions[BENCHMARK_INSTRUCTION] = dict(chatbot.instructions["_"], save_history=True,
+                                                       generate_summary_on_full_history=True)
+
+
+def start_server(port):
+    import uvicorn
+    import main
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def start_dispatcher(port, workers, args):
+    """Start dispatcher.py with workers processes of stub_app.py, return a function that stops it."""
+    import dispatcher
+
+    os.environ.update(STUB_TOKEN_LATENCY=str(args.token_latency), STUB_PROMPT_TOKEN_LATENCY=str(args.prompt_token_latency),
+                      STUB_ANSWER_TOKENS=str(args.answer_tokens), STUB_SUMMARY_TOKEN_LATENCY=str(args.summary_token_latency),
+                      PYTHONPATH=os.pathsep.join([REPOSITORY_DIR, BENCHMARK_DIR, os.environ.get("PYTHONPATH", "")]))
+    server = dispatcher.Dispatcher(workers, base_port=free_port(), app="stub_app:app",
+                                   history_instructions=dispatcher.history_instructions() | {BENCHMARK_INSTRUCTION})
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(server.serve("127.0.0.1", port))
+
+    def run_dispatcher():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=run_dispatcher, daemon=True)
+    thread.start()
+    for worker in server.workers:
+        deadline = time.monotonic() + 120
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", worker.port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"worker {worker.index} didn't start")
+                time.sleep(0.2)
+
+    def stop():
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join()
+        server.stop()
+
+    return stop
+
+
+class Client:
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+
+    def _connection(self):
+        if getattr(self.local, "connection", None) is None:
+            self.local.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=300)
+        return self.local.connection
+
+    def post(self, path, params, stream=False, interrupt=False):
+        """
+        Return (status, seconds until the first body bytes, seconds until the end of the response).
+        With interrupt, the connection is closed after the first body bytes (like a user interrupting a voice answer).
+        """
+        start_time = time.perf_counter()
+        connection = self._connection()
+        try:
+            connection.request("POST", path + "?" + urllib.parse.urlencode(params), headers={"X-Auth-Token": AUTH_TOKEN})
+            response = connection.getresponse()
+            first_byte_time = None
+            while True:
+                data = response.read1(65536) if stream else response.read()
+                if first_byte_time is None:
+                    first_byte_time = time.perf_counter() - start_time
+                    if interrupt:
+                        connection.close()
+                        self.local.connection = None
+                        break
+                if not data or not stream:
+                    break
+            return response.status, first_byte_time, time.perf_counter() - start_time
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self.local.connection = None
+            return 0, None, time.perf_counter() - start_time
+
+    def generated_tokens(self, workers):
+        """Return the generated tokens of all workers (from /metrics)."""
+        total = 0
+        for index in range(workers):
+            connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+            connection.request("GET", f"/metrics?worker={index}")
+            text = connection.getresponse().read().decode("utf-8")
+            connection.close()
+            total += sum(float(value) for value in re.findall(r"^llm_generated_tokens_total\S* (\S+)$", text, re.MULTILINE))
+        return total
+
+
+def make_requests(count, mix, sessions, seed):
+    """Return a reproducible list of (kind, path, params)."""
+    rng = random.Random(seed)
+    kinds = list(mix.keys())
+    weights = [mix[kind] for kind in kinds]
+    requests = []
+    for _ in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        session_id = f"s{rng.randrange(sessions)}"
+        prompt = rng.choice(PROMPTS)
+        if kind == "chat":
+            requests.append((kind, "/chat", {"text_prompt": prompt, "instruction_name": BENCHMARK_INSTRUCTION, "session_id": session_id}))
+        elif kind == "chat_stateless":
+            requests.append((kind, "/chat", {"text_prompt": prompt, "disable_history": "true"}))
+        elif kind in ("chat_stream", "chat_stream_interrupted"):
+            requests.append((kind, "/chat_stream", {"text_prompt": prompt, "instruction_name": BENCHMARK_INSTRUCTION, "session_id": session_id}))
+        elif kind == "summary":
+            text = " ".join(f"{rng.choice(['Alice', 'Bob'])}: {rng.choice(PROMPTS)}." for _ in range(rng.randint(20, 200)))
+            requests.append((kind, "/summary", {"text": text}))
+        elif kind == "inject_memory":
+            requests.append((kind, "/inject_memory", {"text": prompt, "user": "User", "instruction_name": BENCHMARK_INSTRUCTION, "session_id": session_id}))
+    return requests
+
+
+def run(args):
+    import stub_backends
+
+    port = free_port()
+    if args.workers > 1:
+        stop_server = start_dispatcher(port, args.workers, args)
+    else:
+        stub_backends.install(token_latency=args.token_latency, prompt_token_latency=args.prompt_token_latency,
+                              answer_tokens=args.answer_tokens, summary_token_latency=args.summary_token_latency)
+        add_benchmark_instruction()
+        server = start_server(port)
+
+        def stop_server():
+            import chatbot
+
+            chatbot.chat_manager.store.flush()
+            server.should_exit = True
+
+    client = Client(port)
+
+    mix = dict(pair.split("=") for pair in args.mix.split(","))
+    mix = {kind: float(weight) for kind, weight in mix.items()}
+    requests = make_requests(args.requests, mix, args.sessions, args.seed)
+
+    results = []
+    results_lock = threading.Lock()
+
+    def send(request):
+        kind, path, params = request
+        status, first_byte, total = client.post(path, params, stream=kind.startswith("chat_stream"),
+                                                interrupt=kind == "chat_stream_interrupted")
+        with results_lock:
+            results.append((kind, status, first_byte, total))
+
+    # one request per worker first, so model loading isn't part of the measurement
+    for index in range(args.workers):
+        for kind, path, params in make_requests(1, {"chat": 1}, 1, args.seed):
+            send((kind, path, dict(params, worker=index)))
+    results.clear()
+    generated_tokens_before = client.generated_tokens(args.workers)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(send, requests))
+    duration = time.perf_counter() - start_time
+    generated_tokens = client.generated_tokens(args.workers) - generated_tokens_before
+    stop_server()
+
+    report = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {key: value for key, value in vars(args).items() if key != "output"},
+        "duration": duration,
+        "throughput": len(results) / duration,
+        "generated_tokens_per_second": generated_tokens / duration,
+        "errors": sum(1 for _, status, _, _ in results if status != 200),
+        "status_codes": {},
+        "latency": {},
+        "time_to_first_token": summarize_latencies([first_byte for kind, status, first_byte, _ in results
+                                                    if kind == "chat_stream" and status == 200]),
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if args.workers > 1:
+        # the largest worker process
+        report["max_worker_rss_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    for kind, status, _, _ in results:
+        report["status_codes"][f"{kind}:{status}"] = report["status_codes"].get(f"{kind}:{status}", 0) + 1
+    for kind in mix:
+        report["latency"][kind] = summarize_latencies([total for k, status, _, total in results if k == kind and status == 200])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the API server with stub models.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--sessions", type=int, default=16, help="number of chat sessions the requests are spread over")
+    parser.add_argument("--mix", default="chat=4,chat_stateless=2,chat_stream=3,summary=1,inject_memory=1",
+                        help="request kinds and their weights (also chat_stream_interrupted: the client disconnects after the first token)")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="seconds per generated token")
+    parser.add_argument("--prompt-token-latency", type=float, default=0.0005, help="seconds per evaluated prompt token")
+    parser.add_argument("--answer-tokens", type=int, default=48)
+    parser.add_argument("--summary-token-latency", type=float, default=0.002)
+    parser.add_argument("--workers", type=int, default=1, help="worker processes behind dispatcher.py (1 = the server runs in this process)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append the results as a JSON line to this file")
+    args = parser.parse_args()
+
+    os.environ["AUTH_TOKEN"] = AUTH_TOKEN
+    os.environ.setdefault("WARMUP", "lazy")
+    os.chdir(tempfile.mkdtemp(prefix="llm-api-benchmark-"))
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(os.path.join(REPOSITORY_DIR, args.output) if not os.path.isabs(args.output) else args.output, "a") as file:
+            file.write(json.dumps(report) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+# main.app with the stub models (see stub_backends.py), for the worker processes of load_test.py --workers.
+# The stub settings are passed in STUB_* environment variables.
+import os
+
+import stub_backends
+
+stub_backends.install(token_latency=float(os.environ.get("STUB_TOKEN_LATENCY", 0.01)),
+                      prompt_token_latency=float(os.environ.get("STUB_PROMPT_TOKEN_LATENCY", 0.0005)),
+                      answer_tokens=int(os.environ.get("STUB_ANSWER_TOKENS", 48)),
+                      summary_token_latency=float(os.environ.get("STUB_SUMMARY_TOKEN_LATENCY", 0.002)))
+
+import load_test
+import main
+
+load_test.add_benchmark_instruction()
+app = main.app
@@ -0,0 +1,182 @@
+# Deterministic stand-ins for the llama.cpp model and the summarization model, so the server
+# (scheduling, caching, persistence, streaming) can be benchmarked without the real models.
+#
+# usage:
+#   import stub_backends
+#   stub_backends.install(token_latency=0.01, prompt_token_latency=0.0005)
+import hashlib
+import re
+import time
+
+import numpy as np
+
+WORDS = ("the of and to a in is you that it he was for on are as with his they at be this have from or one had by "
+         "word but not what all were we when your can said there use an each which she do how their if will up other").split()
+
+
+def _tokenize(text):
+    """Whitespace tokenizer: (token, start, end) for every word and every single non-space character."""
+    return [(match.group(), match.start(), match.end()) for match in re.finditer(r"\w+|[^\w\s]", text)]
+
+
+def _token_id(token):
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=4).digest(), "little") % 32000 + 3
+
+
+class _StubState:
+    def __init__(self, input_ids):
+        self.input_ids = input_ids
+        self.llama_state_size = len(input_ids) * 1024
+
+
+class StubLlama:
+    def __init__(self, token_latency=0.01, prompt_token_latency=0.0005, answer_tokens=48, n_ctx=4096):
+        """
+        Fake llama_cpp.Llama: sleeps prompt_token_latency per evaluated prompt token and token_latency per
+        generated token. Like llama.cpp, tokens already evaluated in front of the new prompt are reused.
+        The answer is derived from the prompt, so runs are reproducible.
+        """
+        self.token_latency = token_latency
+        self.prompt_token_latency = prompt_token_latency
+        self.answer_tokens = answer_tokens
+        self._n_ctx = n_ctx
+        self.input_ids = np.zeros(0, dtype=np.intc)
+        self.n_tokens = 0
+        self.ctx = None
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def tokenize(self, text, add_bos=True):
+        tokens = [_token_id(token) for token, _, _ in _tokenize(text.decode("utf-8", errors="ignore"))]
+        return ([1] if add_bos else []) + tokens
+
+    def detokenize(self, tokens):
+        return " ".join(WORDS[token % len(WORDS)] for token in tokens).encode("utf-8")
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens):
+        time.sleep(len(tokens) * self.prompt_token_latency)
+        self.input_ids = np.concatenate([self.input_ids[:self.n_tokens], np.array(tokens, dtype=np.intc)])
+        self.n_tokens = len(self.input_ids)
+
+    def save_state(self):
+        return _StubState(self.input_ids[:self.n_tokens].copy())
+
+    def load_state(self, state):
+        self.input_ids = state.input_ids.copy()
+        self.n_tokens = len(self.input_ids)
+
+    def _evaluate_prompt(self, prompt_tokens):
+        # like Llama.generate: only evaluate the tokens after the common prefix
+        reused = 0
+        for a, b in zip(self.input_ids[:self.n_tokens].tolist(), prompt_tokens):
+            if a != b:
+                break
+            reused += 1
+        self.n_tokens = reused
+        self.eval(prompt_tokens[reused:])
+
+    def _answer_words(self, prompt):
+        seed = int.from_bytes(hashlib.blake2b(prompt.encode("utf-8"), digest_size=4).digest(), "little")
+        rng = np.random.default_rng(seed)
+        return [WORDS[index] for index in rng.integers(0, len(WORDS), self.answer_tokens)]
+
+    def __call__(self, prompt, max_tokens=128, stream=False, stopping_criteria=None, **kwargs):
+        prompt_tokens = self.tokenize(prompt.encode("utf-8"))
+        words = self._answer_words(prompt)[:max_tokens]
+        if stream:
+            return self._stream(prompt_tokens, words, stopping_criteria)
+
+        self._evaluate_prompt(prompt_tokens)
+        generated = []
+        for word in self._generate(words, stopping_criteria):
+            generated.append(word)
+        return {
+            "choices": [{"text": " " + " ".join(generated), "finish_reason": "length" if len(generated) == len(words) else "stop"}],
+            "usage": {"prompt_tokens": len(prompt_tokens), "completion_tokens": len(generated),
+                      "total_tokens": len(prompt_tokens) + len(generated)},
+        }
+
+    def _generate(self, words, stopping_criteria=None):
+        # like Llama.generate, the stopping criteria is checked after every token
+        for word in words:
+            time.sleep(self.token_latency)
+            self.eval([_token_id(word)])
+            yield word
+            if stopping_criteria is not None and stopping_criteria(self.input_ids[:self.n_tokens], None):
+                break
+
+    def _stream(self, prompt_tokens, words, stopping_criteria=None):
+        self._evaluate_prompt(prompt_tokens)
+        for word in self._generate(words, stopping_criteria):
+            yield {"choices": [{"text": " " + word, "finish_reason": None}]}
+
+
+class StubSentenceSplitter:
+    def span_tokenize(self, text):
+        start = 0
+        for match in re.finditer(r"[.!?]+(?=\s|$)", text):
+            yield start, match.end()
+            start = match.end()
+            while start < len(text) and text[start].isspace():
+                start += 1
+        if start < len(text):
+            yield start, len(text)
+
+
+class StubTokenizer:
+    model_max_length = 512
+
+    def __call__(self, segments, add_special_tokens=False, return_offsets_mapping=False, **kwargs):
+        encoded = [_tokenize(segment) for segment in segments]
+        return {
+            'input_ids': [[_token_id(token) for token, _, _ in tokens] for tokens in encoded],
+            'offset_mapping': [[(start, end) for _, start, end in tokens] for tokens in encoded],
+        }
+
+    def num_special_tokens_to_add(self):
+        return 2
+
+    def decode(self, token_ids):
+        return " ".join(WORDS[token % len(WORDS)] for token in token_ids)
+
+
+def make_summarize_token_chunks(token_latency):
+    """
+    Stand-in for summary_generator.summarize_token_chunks that takes token_latency per generated token.
+    Like model.generate(), a batch takes as long as its longest summary.
+    """
+    def summarize_token_chunks(chunks, max_length=142, batch_size=None):
+        import summary_generator
+
+        batch_size = batch_size or summary_generator.SUMMARY_BATCH_SIZE
+        summaries = []
+        for batch_start in range(0, len(chunks), batch_size):
+            batch = [[WORDS[token % len(WORDS)] for token in chunk[:max_length // 4]] for chunk in chunks[batch_start:batch_start + batch_size]]
+            time.sleep(max(len(words) for words in batch) * token_latency)
+            summaries += [" ".join(words) for words in batch]
+        return summaries
+    return summarize_token_chunks
+
+
+def install(token_latency=0.01, prompt_token_latency=0.0005, answer_tokens=48, summary_token_latency=0.002):
+    """Replace the models of chatbot and summary_generator with the stubs (call before any model is loaded)."""
+    import chatbot
+    import summary_generator
+
+    chatbot.registry.loader = lambda model, replica: StubLlama(
+        token_latency=token_latency, prompt_token_latency=prompt_token_latency, answer_tokens=answer_tokens,
+        n_ctx=model.context_length * max(1, model.batch_slots))
+
+    def load_summarizer():
+        summary_generator.sentence_splitter = StubSentenceSplitter()
+        summary_generator.tokenizer = StubTokenizer()
+        summary_generator.summarizer = object()
+
+    summary_generator.subsystem.enabled = True
+    summary_generator.subsystem.state = "not_loaded"
+    summary_generator.subsystem._load = load_summarizer
+    summary_generator.summarize_token_chunks = make_summarize_token_chunks(summary_token_latency)
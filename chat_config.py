@@ -0,0 +1,127 @@
+# Model files, generation settings and instruction configs of the chatbot.
+# Importing this module only reads the environment (and looks for the .gguf files), it loads no model and opens no
+# chat history, so other processes (dispatcher.py, autotune.py) can read the configs without starting the chatbot.
+import glob
+import os
+
+# Directories to search for the .gguf files
+directories = ["/root/.cache/llama2/", "cache/llama2/"]
+
+
+def find_model_file(file_name):
+    """Return the path of the .gguf file file_name in one of the model directories (or None)."""
+    if file_name:
+        for directory in directories:
+            potential_path = os.path.join(directory, file_name)
+            if os.path.exists(potential_path):
+                return potential_path
+    return None
+
+
+# Try to get the model file name from the environment variable
+transformer_model_path = find_model_file(os.environ.get('MODEL_FILE'))
+
+# If transformer_model_path is still None, search for any .gguf file
+if transformer_model_path is None:
+    for directory in directories:
+        # Use glob to find all .gguf files in the directory
+        gguf_files = glob.glob(os.path.join(directory, "*.gguf"))
+
+        # If any .gguf files are found, take the first one
+        if gguf_files:
+            transformer_model_path = gguf_files[0]
+            break  # Exit the loop if a .gguf file is found
+
+# Check if a .gguf file was found
+if transformer_model_path is None:
+    print(".gguf file not found in any of the specified directories.")
+else:
+    print(f".gguf file found: {transformer_model_path}")
+
+# the coding_llm instruction config uses CODING_MODEL_FILE (falls back to the default model if it is not found)
+coding_model_path = find_model_file(os.environ.get('CODING_MODEL_FILE'))
+
+############################
+# force stop generating string
+STOP_GENERATING_STRING = "[end of text]"
+
+# 'max_new_tokens': 512
+# Llama2-Chat config
+config = {'max_new_tokens': 384, 'repetition_penalty': 1.1, 'temperature': 0.7, 'context_length': 3072,
+          'stop': [STOP_GENERATING_STRING]}
+
+# CodeLlama config
+#config = {'max_new_tokens': 1024, 'repetition_penalty': 1.1, 'temperature': 0.1, 'context_length': 3072}
+
+# BATCH_ENGINE_SLOTS > 1 generates up to that many answers together in one batch (continuous batching).
+# every slot gets its own context_length of KV cache. The prompt cache is not used in that mode.
+BATCH_ENGINE_SLOTS = int(os.environ.get('BATCH_ENGINE_SLOTS', 1))
+
+# models are loaded on first use (the default model also by warmup at server startup).
+# if loading a model would use more than MODEL_MEMORY_BUDGET bytes, the least recently used idle models are unloaded. (0 = no limit)
+# MODEL_REPLICAS instances of the default model serve requests in parallel, each on its own share of the CPU cores.
+MODEL_MEMORY_BUDGET = int(os.environ.get('MODEL_MEMORY_BUDGET', 0))
+MODEL_REPLICAS = int(os.environ.get('MODEL_REPLICAS', 1))
+DEFAULT_MODEL = "llama2"
+
+
+def optional_int_env(name):
+    value = os.environ.get(name, '')
+    return int(value) if value else None
+
+
+# llama.cpp settings of the default model (unset = autotune profile, or the defaults)
+MODEL_THREADS = optional_int_env('MODEL_THREADS')
+MODEL_THREADS_BATCH = optional_int_env('MODEL_THREADS_BATCH')
+MODEL_BATCH_SIZE = optional_int_env('MODEL_BATCH_SIZE')
+MODEL_GPU_LAYERS = optional_int_env('MODEL_GPU_LAYERS')
+
+# tuned llama.cpp settings per model and host are kept in AUTOTUNE_PROFILES (created by "python autotune.py").
+# AUTOTUNE: "apply" (default) uses saved profiles, "startup" also tunes models without a profile when they are loaded, "off" ignores them.
+AUTOTUNE = os.environ.get('AUTOTUNE', 'apply')
+AUTOTUNE_PROFILES = os.environ.get('AUTOTUNE_PROFILES', 'autotune_profiles.json')
+
+# models the instruction configs can use (see the 'model' setting of the instruction configs)
+# threads: llama.cpp threads per replica for generating, threads_batch: for prompt evaluation (the cores of the replica without profile),
+# batch_size: prompt tokens evaluated at once, gpu_layers: layers offloaded to the GPU (30 without profile). None = autotune profile.
+models = {
+    "llama2": {'path': transformer_model_path, 'context_length': config['context_length'], 'threads': MODEL_THREADS,
+               'threads_batch': MODEL_THREADS_BATCH, 'batch_size': MODEL_BATCH_SIZE, 'gpu_layers': MODEL_GPU_LAYERS,
+               'replicas': MODEL_REPLICAS, 'batch_slots': BATCH_ENGINE_SLOTS},
+    "codellama": {'path': coding_model_path, 'context_length': 4096, 'threads': None, 'threads_batch': None,
+                  'batch_size': None, 'gpu_layers': None, 'replicas': 1, 'batch_slots': 1},
+}
+
+
+instructions = {
+    "_": {
+        # the current time is placed after the history, so the system prompt and history stay cacheable.
+        'init_prompt': "[INST] <<SYS>>\nYou are a helpful, respectful, honest Assistant. your name is {ai_name}. Only tell the date and time if asked. Always answer as helpfully as possible, while being safe. Your answers should not include any harmful, unethical, racist, sexist, toxic, dangerous, or illegal content. Ensure that your responses are socially unbiased and positive in nature. If a question does not make any sense, or is not factually coherent, explain why instead of answering something not correct. If you don't know the answer to a question, Don't share false information. Keep the answers short.{summary}\n<</SYS>>\n{history}(current time is {current_day}, {current_datetime})\n{name}{prompt}" + STOP_GENERATING_STRING + "[/INST]\n",
+        'result_replacements': {
+            STOP_GENERATING_STRING: "",
+        },
+        'ai_name': "Assistant",
+        'save_history': False,
+        'generate_summary_on_full_history': False,
+        'remove_emotions_from_history': False,
+        'instruct_tags_type': "llama2",
+        'communication_type': "multi_user_chat",
+        'model': "llama2",
+        # an answer that was cut off (client disconnect or deadline) is added to the chat history as far as it was generated.
+        # (with False, the message and the partial answer are not added)
+        'save_partial_answers': True,
+    },
+    # CodeLlama (Alpaca/Vicuna instruction format) model template (https://huggingface.co/Phind/Phind-CodeLlama-34B-v2 , https://huggingface.co/TheBloke/Phind-CodeLlama-34B-v2-GGUF)
+    "coding_llm": {
+        'init_prompt': "### System Prompt\nYou are an intelligent programming assistant.\n\n### User Message\n{prompt}\n\n### Assistant\n",
+        'result_replacements': {},
+        'ai_name': "Assistant",
+        'save_history': False,
+        'generate_summary_on_full_history': False,
+        'remove_emotions_from_history': False,
+        'instruct_tags_type': "",
+        'communication_type': "",
+        'model': "codellama",
+        'save_partial_answers': False,
+    }
+}
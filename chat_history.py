@@ -1,137 +1,342 @@
-import threading
-import json
-import os
-
-import summary_generator
-
-
-class ChatManager:
-    def __init__(self):
-        """Initialize a new ChatManager to manage multiple chat histories."""
-        self.chats = {}
-        self.locks = {}  # Separate lock for each chat_key
-
-    def _get_lock(self, chat_key):
-        """Get the lock for a given chat_key, create one if it doesn't exist."""
-        if chat_key not in self.locks:
-            self.locks[chat_key] = threading.Lock()
-        return self.locks[chat_key]
-    
-    def initialize_chat(self, chat_key, max_entries=None):
-        """Initialize a new chat history with an optional max_entries."""
-        if chat_key not in self.chats:
-            self.chats[chat_key] = {"messages": [], "summary": "", "max_entries": max_entries}
-
-    def add_message(self, chat_key, name, text):
-        """Add a new message to the specified chat history."""
-        # If chat_key does not exist, initialize it with no max_entries by default
-        if chat_key not in self.chats:
-            self.initialize_chat(chat_key)
-
-        message = {
-            "name": name,
-            "text": text
-        }
-        self.chats[chat_key]['messages'].append(message)
-
-        # If we exceed the maximum number of entries, remove the oldest message
-        max_entries = self.chats[chat_key]['max_entries']
-        current_length = len(self.chats[chat_key]['messages'])
-        if max_entries is not None and current_length > max_entries:
-            excess = current_length - max_entries
-            self.chats[chat_key]['messages'] = self.chats[chat_key]['messages'][excess:]
-
-    def get_messages(self, chat_key):
-        """Return the list of messages for the specified chat_key."""
-        return self.chats.get(chat_key, {}).get('messages', [])
-
-    def get_all_messages_string(self, chat_key, ai_name='Assistant', stop='[end of text]'):
-        """ Concatenate all messages in the format "Name: text" """
-        if chat_key not in self.chats:
-            return ""
-        # join all messages in the format "Name: Text" but when user is ai_name, add [end of text] to the end.
-        return "\n".join([
-            f"{message['name']}: {message['text']}{' '+stop if message['name'] == ai_name else ''}"
-            for message in self.chats[chat_key]['messages']
-        ])
-        #return "\n".join([f"{message['name']}: {message['text']}" for message in self.chats[chat_key]['messages']])
-
-    def get_summary(self, chat_key):
-        """Return the summary for the specified chat_key."""
-        return self.chats.get(chat_key, {}).get('summary', "")
-
-    def clear_chat(self, chat_key, retain_count=0):
-        """Clear all messages for the specified chat_key."""
-        if chat_key in self.chats:
-            if retain_count > 0:
-                self.chats[chat_key]['messages'] = self.chats[chat_key]['messages'][-retain_count:]
-            else:
-                self.chats[chat_key]['messages'] = []
-
-    def clear_summary(self, chat_key):
-        """Clear the summary for the specified chat_key."""
-        if chat_key in self.chats:
-            self.chats[chat_key]['summary'] = ""
-
-    def generate_summary(self, chat_key):
-        if chat_key not in self.chats:
-            return
-
-        # Concatenate all messages in the format "Name: text"
-        text_to_summarize = self.get_summary(chat_key)
-        text_to_summarize += "\n\n"+self.get_all_messages_string(chat_key, stop='')
-
-        print("generating summary for " + chat_key)
-        summary = summary_generator.summarize(text_to_summarize)
-        # Set the summary for the specified chat_key.
-        self.chats[chat_key]['summary'] = summary
-        return summary
-
-    def get_current_size(self, chat_key):
-        """Return the current number of messages for a given chat_key."""
-        if chat_key not in self.chats:
-            return 0
-        return len(self.chats[chat_key]['messages'])
-
-    def get_max_size(self, chat_key):
-        """Return the max_entries value for a given chat_key."""
-        if chat_key not in self.chats:
-            return 0
-        return self.chats[chat_key]['max_entries']
-
-    def is_full(self, chat_key):
-        """Check if the list of messages for a given chat_key has reached its max_entries."""
-        if chat_key not in self.chats:
-            return False
-        max_entries = self.get_max_size(chat_key)
-        current_entries = self.get_current_size(chat_key)
-        return current_entries >= max_entries
-
-    def save_history_to_file(self, chat_key, directory='chat_histories'):
-        """Save individual chat history to a JSON file based on the chat_key."""
-        with self._get_lock(chat_key):
-            # Ensure the directory exists
-            if not os.path.exists(directory):
-                os.makedirs(directory)
-
-            filename = os.path.join(directory, f"{chat_key}.json")
-            try:
-                with open(filename, 'w') as file:
-                    json.dump(self.chats.get(chat_key, {}), file)
-            except (IOError, PermissionError) as e:
-                print(f"Error saving chat '{chat_key}' to file '{filename}': {e}")
-
-    def load_history_from_file(self, chat_key, directory='chat_histories'):
-        """Load individual chat history from a JSON file based on the chat_key."""
-        filename = os.path.join(directory, f"{chat_key}.json")
-        try:
-            with open(filename, 'r') as file:
-                loaded_chat = json.load(file)
-                # Preserve the current max_entries if it exists
-                if chat_key in self.chats:
-                    loaded_chat['max_entries'] = self.chats[chat_key]['max_entries']
-                self.chats[chat_key] = loaded_chat
-        except FileNotFoundError:
-            print(f"File for chat '{chat_key}' not found in '{directory}'. Starting with an empty chat history.")
-        except (IOError, PermissionError) as e:
-            print(f"Error loading chat '{chat_key}' from file '{filename}': {e}")
+import contextlib
+import threading
+from collections import OrderedDict
+
+import history_store
+import summary_generator
+
+
+class ChatManager:
+    def __init__(self, max_entries=None, max_resident_chats=None, store=None, summary_mode='incremental', max_summary_segments=3,
+                 token_counter=None, token_limit=None, long_term_memory=None):
+        """
+        Initialize a new ChatManager to manage multiple chat histories.
+
+        Chats are loaded from store (a history_store.HistoryStore, JSON journal in chat_histories/ by default) on first use.
+        If max_resident_chats is set, only that many chats are kept in memory,
+        the least recently used chat is written back and dropped.
+
+        summary_mode "incremental" only summarizes the messages dropped since the last summary into a new segment
+        and rolls the segments up into one summary once there are more than max_summary_segments.
+        summary_mode "full" re-summarizes the previous summary together with all messages.
+
+        token_counter(text) returns the number of model tokens of a text. It is used once per message
+        and the result is stored with the message. A chat counts as full once its messages have token_limit tokens.
+
+        With long_term_memory (a vector_memory.LongTermMemory), every message is also kept there,
+        so it can be recalled after it was dropped from the history.
+        """
+        self.chats = OrderedDict()
+        self.locks = {}  # chat_key -> [lock, number of threads using it], separate lock for each chat_key
+        self.max_entries = max_entries
+        self.max_resident_chats = max_resident_chats
+        if store is None:
+            store = history_store.JournalHistoryStore()
+        self.store = store
+        self._residency_lock = threading.RLock()
+        self._summarizing = set()  # chat_keys with a summary in progress
+        self.summary_mode = summary_mode
+        self.max_summary_segments = max_summary_segments
+        self.token_counter = token_counter
+        self.token_limit = token_limit
+        self.long_term_memory = long_term_memory
+
+    @contextlib.contextmanager
+    def _get_lock(self, chat_key):
+        """Hold the lock of chat_key, create one if it doesn't exist (it is dropped once no thread uses it and the chat was evicted)."""
+        with self._residency_lock:
+            entry = self.locks.get(chat_key)
+            if entry is None:
+                entry = self.locks[chat_key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._residency_lock:
+                entry[1] -= 1
+                if entry[1] == 0 and chat_key not in self.chats:
+                    del self.locks[chat_key]
+
+    def _touch(self, chat_key):
+        """Make chat_key resident (loading it from disk if needed), mark it as most recently used and return it."""
+        with self._residency_lock:
+            if chat_key in self.chats:
+                self.chats.move_to_end(chat_key)
+                return self.chats[chat_key]
+            self.initialize_chat(chat_key, max_entries=self.max_entries)
+            self.load_history(chat_key)
+            chat = self.chats[chat_key]
+            self._evict()
+            return chat
+
+    def _evict(self):
+        """Write back and drop least recently used chats until max_resident_chats is satisfied."""
+        if self.max_resident_chats is None:
+            return
+        # the most recently used chat is never evicted
+        while len(self.chats) > max(self.max_resident_chats, 1):
+            chat_key = next(iter(self.chats))
+            self.save_history(chat_key)
+            del self.chats[chat_key]
+            # a lock that is held or waited for is dropped by its last user
+            entry = self.locks.get(chat_key)
+            if entry is not None and entry[1] == 0:
+                del self.locks[chat_key]
+
+    def is_resident(self, chat_key):
+        """Check if the chat history for chat_key is currently held in memory."""
+        return chat_key in self.chats
+
+    def initialize_chat(self, chat_key, max_entries=None):
+        """Initialize a new chat history with an optional max_entries."""
+        if chat_key not in self.chats:
+            self.chats[chat_key] = {"messages": [], "summary": "", "max_entries": max_entries}
+
+    def add_message(self, chat_key, name, text):
+        """Add a new message to the specified chat history."""
+        chat = self._touch(chat_key)
+
+        message = {
+            "name": name,
+            "text": text
+        }
+        if self.token_counter is not None:
+            message['tokens'] = self.token_counter(f"{name}: {text}")
+        with self._get_lock(chat_key):
+            chat['messages'].append(message)
+            self.store.append_message(chat_key, message)
+
+            # If we exceed the maximum number of entries, remove the oldest message
+            # (not while a summary is generated, these messages are dropped once they are summarized)
+            max_entries = chat['max_entries']
+            current_length = len(chat['messages'])
+            if max_entries is not None and current_length > max_entries and chat_key not in self._summarizing:
+                excess = current_length - max_entries
+                chat['messages'] = chat['messages'][excess:]
+                self.store.truncate_messages(chat_key, max_entries)
+
+        if self.long_term_memory is not None:
+            self.long_term_memory.add(chat_key, name, text)
+
+    def get_messages(self, chat_key):
+        """Return the list of messages for the specified chat_key."""
+        return self._touch(chat_key)['messages']
+
+    def get_long_term_memories(self, chat_key, text, token_budget, top_k=8):
+        """Return the "name: text" lines of older messages relevant to text (not the ones still in the history) within token_budget."""
+        if self.long_term_memory is None or token_budget <= 0:
+            return []
+        chat = self._touch(chat_key)
+        with self._get_lock(chat_key):
+            history = [(message['name'], message['text']) for message in chat['messages']]
+        token_counter = self.token_counter or (lambda line: len(line) // 4 + 1)
+        try:
+            return self.long_term_memory.recall(chat_key, text, token_budget, token_counter, top_k=top_k, exclude=history)
+        except Exception as e:
+            # the answer works without memories
+            print(f"Error recalling long-term memories of chat '{chat_key}': {e}")
+            return []
+
+    @staticmethod
+    def _format_message(message, ai_name='Assistant', stop='[end of text]'):
+        # format as "Name: Text" but when user is ai_name, add [end of text] to the end.
+        return f"{message['name']}: {message['text']}{' '+stop if message['name'] == ai_name and stop else ''}"
+
+    def get_all_messages_string(self, chat_key, ai_name='Assistant', stop='[end of text]'):
+        """ Concatenate all messages in the format "Name: text" """
+        chat = self._touch(chat_key)
+        return "\n".join([self._format_message(message, ai_name=ai_name, stop=stop) for message in chat['messages']])
+        #return "\n".join([f"{message['name']}: {message['text']}" for message in self.chats[chat_key]['messages']])
+
+    def _message_tokens(self, message):
+        """Return the token count of a message ("Name: text"), counting it only if it was stored without one."""
+        if 'tokens' not in message:
+            if self.token_counter is None:
+                return 0
+            message['tokens'] = self.token_counter(f"{message['name']}: {message['text']}")
+        return message['tokens']
+
+    def get_history_tokens(self, chat_key):
+        """Return the number of tokens of all messages of chat_key."""
+        return sum(self._message_tokens(message) for message in self._touch(chat_key)['messages'])
+
+    def get_messages_string_within_budget(self, chat_key, token_budget, ai_name='Assistant', stop='[end of text]'):
+        """Like get_all_messages_string, but only with the newest messages that fit into token_budget tokens."""
+        chat = self._touch(chat_key)
+        if self.token_counter is None:
+            return self.get_all_messages_string(chat_key, ai_name=ai_name, stop=stop)
+
+        stop_tokens = self.token_counter(" " + stop) if stop else 0
+        selected = []
+        used_tokens = 0
+        for message in reversed(chat['messages']):
+            # +1 for the line break between messages
+            message_tokens = self._message_tokens(message) + 1
+            if message['name'] == ai_name:
+                message_tokens += stop_tokens
+            if used_tokens + message_tokens > token_budget:
+                break
+            selected.append(message)
+            used_tokens += message_tokens
+        return "\n".join([self._format_message(message, ai_name=ai_name, stop=stop) for message in reversed(selected)])
+
+    def get_summary(self, chat_key):
+        """Return the summary for the specified chat_key."""
+        return self._touch(chat_key).get('summary', "")
+
+    def clear_chat(self, chat_key, retain_count=0):
+        """Clear all messages for the specified chat_key."""
+        chat = self._touch(chat_key)
+        with self._get_lock(chat_key):
+            if retain_count > 0:
+                chat['messages'] = chat['messages'][-retain_count:]
+            else:
+                chat['messages'] = []
+            self.store.truncate_messages(chat_key, retain_count)
+
+    def clear_summary(self, chat_key):
+        """Clear the summary for the specified chat_key."""
+        fields = {'summary': "", 'summary_rollup': "", 'summary_segments': []}
+        self._touch(chat_key).update(fields)
+        self.store.update(chat_key, **fields)
+
+    def generate_summary(self, chat_key):
+        chat = self._touch(chat_key)
+
+        # Concatenate all messages in the format "Name: text"
+        text_to_summarize = self.get_summary(chat_key)
+        text_to_summarize += "\n\n"+self.get_all_messages_string(chat_key, stop='')
+
+        print("generating summary for " + chat_key)
+        summary = summary_generator.summarize(text_to_summarize)
+        # Set the summary for the specified chat_key.
+        chat['summary'] = summary
+        self.store.update(chat_key, summary=summary)
+        return summary
+
+    def _retain_count(self, messages, retain_tokens):
+        """Return how many of the newest messages have at most retain_tokens tokens together."""
+        retain_count = 0
+        retained_tokens = 0
+        for message in reversed(messages):
+            retained_tokens += self._message_tokens(message)
+            if retained_tokens > retain_tokens:
+                break
+            retain_count += 1
+        return retain_count
+
+    def trim(self, chat_key, retain_tokens):
+        """
+        Drop the oldest messages without summarizing them, so the newest messages with at most retain_tokens tokens
+        (and less than max_entries messages) are left. Used for full histories that are not summarized.
+        """
+        chat = self._touch(chat_key)
+        with self._get_lock(chat_key):
+            if chat_key in self._summarizing:
+                return
+            retain_count = self._retain_count(chat['messages'], retain_tokens)
+            if chat['max_entries'] is not None:
+                retain_count = min(retain_count, chat['max_entries'] - 1)
+            if retain_count < len(chat['messages']):
+                chat['messages'] = chat['messages'][len(chat['messages']) - retain_count:]
+                self.store.truncate_messages(chat_key, retain_count)
+
+    def summarize(self, chat_key, retain_count=0, retain_tokens=None):
+        """
+        Summarize the chat and drop the summarized messages except the newest retain_count of them
+        (or, with retain_tokens, the newest messages that have at most retain_tokens tokens together).
+
+        The messages are snapshotted before the (slow) summarization and merged back afterwards,
+        so messages added in the meantime are never lost.
+        """
+        chat = self._touch(chat_key)
+        with self._get_lock(chat_key):
+            if chat_key in self._summarizing:
+                return None
+            self._summarizing.add(chat_key)
+            previous_summary = chat.get('summary', "")
+            # chats summarized before incremental summaries existed start with their summary as roll-up
+            rollup = chat.get('summary_rollup', previous_summary if 'summary_segments' not in chat else "")
+            segments = list(chat.get('summary_segments', []))
+            snapshot = list(chat['messages'])
+
+        if retain_tokens is not None:
+            retain_count = self._retain_count(snapshot, retain_tokens)
+
+        # only messages are appended while summarizing, so the snapshot is still the start of the list
+        drop_count = max(len(snapshot) - retain_count, 0)
+        try:
+            print("generating summary for " + chat_key)
+            if self.summary_mode == 'incremental':
+                fields = self._roll_summary(rollup, segments, snapshot[:drop_count])
+            else:
+                text_to_summarize = previous_summary
+                text_to_summarize += "\n\n" + self._format_messages(snapshot)
+                fields = {'summary': summary_generator.summarize(text_to_summarize)}
+        except Exception:
+            with self._get_lock(chat_key):
+                self._summarizing.discard(chat_key)
+            raise
+
+        chat = self._touch(chat_key)
+        with self._get_lock(chat_key):
+            chat['messages'] = chat['messages'][drop_count:]
+            self.store.truncate_messages(chat_key, len(chat['messages']))
+            chat.update(fields)
+            self.store.update(chat_key, **fields)
+            self._summarizing.discard(chat_key)
+        return fields['summary']
+
+    @staticmethod
+    def _format_messages(messages):
+        return "\n".join([f"{message['name']}: {message['text']}" for message in messages])
+
+    def _roll_summary(self, rollup, segments, dropped_messages):
+        """Summarize dropped_messages into a new segment and roll up the segments if there are too many."""
+        if dropped_messages:
+            segments = segments + [summary_generator.summarize(self._format_messages(dropped_messages))]
+        if len(segments) > self.max_summary_segments:
+            rollup = summary_generator.summarize("\n\n".join([rollup] + segments).strip())
+            segments = []
+        summary = " ".join([part for part in [rollup] + segments if part != ""])
+        return {'summary': summary, 'summary_rollup': rollup, 'summary_segments': segments}
+
+    def get_current_size(self, chat_key):
+        """Return the current number of messages for a given chat_key."""
+        return len(self._touch(chat_key)['messages'])
+
+    def get_max_size(self, chat_key):
+        """Return the max_entries value for a given chat_key."""
+        return self._touch(chat_key)['max_entries']
+
+    def is_full(self, chat_key):
+        """Check if the list of messages for a given chat_key has reached its max_entries or token_limit."""
+        if self.token_limit is not None and self.get_history_tokens(chat_key) >= self.token_limit:
+            return True
+        max_entries = self.get_max_size(chat_key)
+        if max_entries is None:
+            return False
+        current_entries = self.get_current_size(chat_key)
+        return current_entries >= max_entries
+
+    def save_history(self, chat_key):
+        """Persist the chat history of chat_key. (Backends that persist every change on its own only flush it in the background)"""
+        chat = self.chats.get(chat_key)
+        if chat is None:
+            # not resident, so there is nothing newer than the stored history
+            return
+        with self._get_lock(chat_key):
+            self.store.save(chat_key, chat)
+
+    def load_history(self, chat_key):
+        """Load individual chat history from the store based on the chat_key."""
+        loaded_chat = self.store.load(chat_key)
+        if loaded_chat is None:
+            return
+        loaded_chat.setdefault('messages', [])
+        loaded_chat.setdefault('summary', "")
+        # Preserve the current max_entries if it exists
+        if chat_key in self.chats:
+            loaded_chat['max_entries'] = self.chats[chat_key]['max_entries']
+        self.chats[chat_key] = loaded_chat
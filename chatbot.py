@@ -1,313 +1,677 @@
-import os
-import glob
-import re
-from datetime import datetime
-import threading
-
-from llama_cpp import Llama
-
-import chat_history
-
-# Try to get the model file name from the environment variable
-env_model_file = os.environ.get('MODEL_FILE')
-
-# Directories to search for the .gguf file
-directories = ["/root/.cache/llama2/", "cache/llama2/"]
-
-# Initialize transformer_model_path to None
-transformer_model_path = None
-
-# If the environment variable is set, use it to construct the model path
-if env_model_file:
-    for directory in directories:
-        potential_path = os.path.join(directory, env_model_file)
-        if os.path.exists(potential_path):
-            transformer_model_path = potential_path
-            break  # Exit the loop if the model file is found
-
-# If transformer_model_path is still None, search for any .gguf file
-if transformer_model_path is None:
-    for directory in directories:
-        # Use glob to find all .gguf files in the directory
-        gguf_files = glob.glob(os.path.join(directory, "*.gguf"))
-
-        # If any .gguf files are found, take the first one
-        if gguf_files:
-            transformer_model_path = gguf_files[0]
-            break  # Exit the loop if a .gguf file is found
-
-# Check if a .gguf file was found
-if transformer_model_path is None:
-    print(".gguf file not found in any of the specified directories.")
-else:
-    print(f".gguf file found: {transformer_model_path}")
-
-############################
-# force stop generating string
-STOP_GENERATING_STRING = "[end of text]"
-
-# 'max_new_tokens': 512
-# Llama2-Chat config
-config = {'max_new_tokens': 384, 'repetition_penalty': 1.1, 'temperature': 0.7, 'context_length': 3072,
-          'stop': [STOP_GENERATING_STRING], 'threads': int(os.cpu_count())}
-
-# CodeLlama config
-#config = {'max_new_tokens': 1024, 'repetition_penalty': 1.1, 'temperature': 0.1, 'context_length': 3072, 'threads': int(os.cpu_count())}
-
-# load model
-print("loading " + transformer_model_path + " ... using " + str(os.cpu_count()) + " threads.")
-llm = Llama(model_path=transformer_model_path, n_gpu_layers=30, n_ctx=config['context_length'])
-
-
-instructions = {
-    "_": {
-        'init_prompt': "[INST] <<SYS>>\nYou are a helpful, respectful, honest Assistant. your name is {ai_name}. current time is {current_day}, {current_datetime}. Only tell the date and time if asked. Always answer as helpfully as possible, while being safe. Your answers should not include any harmful, unethical, racist, sexist, toxic, dangerous, or illegal content. Ensure that your responses are socially unbiased and positive in nature. If a question does not make any sense, or is not factually coherent, explain why instead of answering something not correct. If you don't know the answer to a question, Don't share false information. Keep the answers short.{summary}\n<</SYS>>\n{history}{name}{prompt}" + STOP_GENERATING_STRING + "[/INST]\n",
-        'result_replacements': {
-            STOP_GENERATING_STRING: "",
-        },
-        'ai_name': "Assistant",
-        'save_history': False,
-        'generate_summary_on_full_history': False,
-        'remove_emotions_from_history': False,
-        'instruct_tags_type': "llama2",
-        'communication_type': "multi_user_chat",
-    },
-    # CodeLlama (Alpaca/Vicuna instruction format) model template (https://huggingface.co/Phind/Phind-CodeLlama-34B-v2 , https://huggingface.co/TheBloke/Phind-CodeLlama-34B-v2-GGUF)
-    "coding_llm": {
-        'init_prompt': "### System Prompt\nYou are an intelligent programming assistant.\n\n### User Message\n{prompt}\n\n### Assistant\n",
-        'result_replacements': {},
-        'ai_name': "Assistant",
-        'save_history': False,
-        'generate_summary_on_full_history': False,
-        'remove_emotions_from_history': False,
-        'instruct_tags_type': "",
-        'communication_type': "",
-    }
-}
-
-# CHAT_MAX_HISTORY_ENTRIES should at least have 2 more than CHAT_MAX_DETAILED_HISTORY
-# (because chat and answer are added before summarization)
-CHAT_MAX_HISTORY_ENTRIES = 7
-CHAT_MAX_DETAILED_HISTORY = 4
-chat_manager = chat_history.ChatManager()
-for chat_manager_instruction in instructions.keys():
-    chat_manager.initialize_chat(chat_manager_instruction, max_entries=CHAT_MAX_HISTORY_ENTRIES)
-    chat_manager.load_history_from_file(chat_manager_instruction)
-
-
-def remove_llama2_instruct_tags(text):
-    # Use regular expression to remove everything between [INST] and [/INST], including the tags themselves
-    text = re.sub(r'\[INST\].*?\[/INST\]\n?', '', text, flags=re.DOTALL)
-
-    text = text.replace(STOP_GENERATING_STRING, "")
-    text = text.replace("[INST]", "").replace("[/INST]", "")
-    text = text.replace("<<SYS>>", "").replace("<</SYS>>", "")
-
-    return text
-
-
-def remove_emotions(text):
-    # This regular expression matches any string that starts with an asterisk (*) and ends with an asterisk (*)
-    # and removes it from the text. (like *ears perk up* and similar)
-    return re.sub(r'(?<!\*)\*.*?\*(?!\*)', '', text).strip()
-
-
-def replace_strings_in_result(text, instruction='tiger'):
-    result_replacements = instructions[instruction]['result_replacements']
-
-    for original, new in result_replacements.items():
-        text = text.replace(original, new)
-    return text
-
-
-def add_summary_to_chat_history(instruction_name='_'):
-    chat_manager.generate_summary(instruction_name)
-    chat_manager.clear_chat(instruction_name, retain_count=CHAT_MAX_DETAILED_HISTORY)
-
-    chat_manager.save_history_to_file(instruction_name)
-
-
-def message(text, name='User', instruction='_', disable_history=False):
-    global llm
-
-    name_str = ''
-    if name != '':
-        name_str = name + ": "
-
-    # Get the current date, time, and day of the week
-    current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    current_day = datetime.now().strftime("%A")
-
-    # Get AI name of instructions set
-    ai_name = instructions[instruction]['ai_name']
-
-    # remove instruct tags from user input to prevent issues.
-    if instructions[instruction]['instruct_tags_type'] == 'llama2':
-        text = remove_llama2_instruct_tags(text)
-
-    # Fetch chat history and summary for AI memory
-    summary = ""
-    history = ""
-    if not disable_history and instructions[instruction]['save_history']:
-        summary = chat_manager.get_summary(instruction)
-        if summary != "":
-            summary = " Summary of previous messages: " + summary
-        history = chat_manager.get_all_messages_string(instruction, ai_name=ai_name, stop=STOP_GENERATING_STRING)
-        if history != "":
-            history = history + "\n"
-
-    # format prompt to fit instruction prompt template
-    prompt = instructions[instruction]['init_prompt'].format(
-        ai_name=ai_name,
-        summary=summary,
-        history=history,
-        prompt=text, name=name_str, current_day=current_day, current_datetime=current_datetime
-    )
-
-    # Call the AI model
-    try:
-        answer_dict = llm(prompt,
-                          max_tokens=config['max_new_tokens'],
-                          stop=[STOP_GENERATING_STRING],
-                          echo=False,
-                          temperature=config['temperature'],
-                          repeat_penalty=config['repetition_penalty'],
-                          )
-        print(answer_dict)
-        answer = answer_dict['choices'][0]['text']
-    except Exception as e:
-        print(e)
-        return ""
-
-    # cleanup AI answer according to instruction config
-    if instructions[instruction]['instruct_tags_type'] == 'llama2':
-        answer = remove_llama2_instruct_tags(answer)  # these should never be in the answer text
-    answer = replace_strings_in_result(answer)
-
-    # remove chat name from the beginning of the answer (and possible from empty name remaining ':')
-    if instructions[instruction]['communication_type'] == 'multi_user_chat':
-        while answer.startswith(ai_name):
-            answer = answer[len(ai_name):]
-        answer = answer.strip()
-        while answer.startswith(":"):
-            answer = answer[len(":"):]
-
-    # trim spaces from answer
-    answer = answer.strip()
-
-    # add new entries to chat history and generate new summary if needed
-    if not disable_history and instructions[instruction]['save_history']:
-        history_answer = answer.replace("\n", " ")
-        if instructions[instruction]['remove_emotions_from_history']:
-            history_answer = remove_emotions(answer.replace("\n", " "))
-        chat_manager.add_message(instruction, name, text.replace("\n", " "))
-        chat_manager.add_message(instruction,
-                                 instructions[instruction]['ai_name'],
-                                 history_answer
-                                 )
-        # generate new summary if chat history is full (in a background thread)
-        if instructions[instruction]['generate_summary_on_full_history'] and chat_manager.is_full(instruction):
-            threading.Thread(target=add_summary_to_chat_history, args=(instruction,)).start()
-
-        chat_manager.save_history_to_file(instruction)
-
-    print("Chat answer:" + answer)
-
-    return answer
-
-
-async def message_stream(text, name='User', instruction='_', disable_history=False):
-    global llm
-
-    name_str = ''
-    if name != '':
-        name_str = name + ": "
-
-    # Get the current date, time, and day of the week
-    current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    current_day = datetime.now().strftime("%A")
-
-    # Get AI name of instructions set
-    ai_name = instructions[instruction]['ai_name']
-
-    # remove instruct tags from user input to prevent issues.
-    if instructions[instruction]['instruct_tags_type'] == 'llama2':
-        text = remove_llama2_instruct_tags(text)
-
-    # Fetch chat history and summary for AI memory
-    summary = ""
-    history = ""
-    if not disable_history and instructions[instruction]['save_history']:
-        summary = chat_manager.get_summary(instruction)
-        if summary != "":
-            summary = " Summary of previous messages: " + summary
-        history = chat_manager.get_all_messages_string(instruction, ai_name=ai_name, stop=STOP_GENERATING_STRING)
-        if history != "":
-            history = history + "\n"
-
-    # format prompt to fit instruction prompt template
-    prompt = instructions[instruction]['init_prompt'].format(
-        ai_name=ai_name,
-        summary=summary,
-        history=history,
-        prompt=text, name=name_str, current_day=current_day, current_datetime=current_datetime
-    )
-
-    # Call the AI model
-    answer_text = ""
-    try:
-        text_stream = llm(prompt, stream=True,
-                          max_tokens=config['max_new_tokens'],
-                          stop=[STOP_GENERATING_STRING],
-                          echo=False,
-                          temperature=config['temperature'],
-                          repeat_penalty=config['repetition_penalty'],
-                          )
-        for answer in text_stream:
-            answer_text += answer["choices"][0]["text"]
-            yield answer["choices"][0]["text"]
-
-        # add new entries to chat history and generate new summary if needed
-        if not disable_history and instructions[instruction]['save_history']:
-            history_answer = answer_text.replace("\n", " ")
-            if instructions[instruction]['remove_emotions_from_history']:
-                history_answer = remove_emotions(answer_text)
-            chat_manager.add_message(instruction, name, text)
-            chat_manager.add_message(instruction,
-                                     instructions[instruction]['ai_name'],
-                                     history_answer
-                                     )
-            # generate new summary if chat history is full (in a background thread)
-            if instructions[instruction]['generate_summary_on_full_history'] and chat_manager.is_full(instruction):
-                threading.Thread(target=add_summary_to_chat_history, args=(instruction,)).start()
-
-            chat_manager.save_history_to_file(instruction)
-
-    except Exception as e:
-        print(e)
-
-
-def inject_memory(text, name='AI', instruction='_'):
-    if not instructions[instruction]['save_history']:
-        return None
-
-    usr_name = name
-    ai_name = instructions[instruction]['ai_name']
-    if name.lower() == 'AI'.lower():
-        usr_name = ai_name
-
-    text = text.format(AI=ai_name)
-
-    history_answer = text.replace("\n", " ")
-    if instructions[instruction]['remove_emotions_from_history']:
-        history_answer = remove_emotions(text.replace("\n", " "))
-
-    chat_manager.add_message(instruction,
-                             usr_name,
-                             history_answer
-                             )
-    if chat_manager.is_full(instruction):
-        threading.Thread(target=add_summary_to_chat_history, args=(instruction,)).start()
-    chat_manager.save_history_to_file(instruction)
-
-    return "SUCCESS"
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import functools
+
+import answer_cleanup
+import autotune
+import chat_history
+import history_store
+import inference_queue
+import metrics
+import model_registry
+import response_cache
+import summary_generator
+import summary_worker
+import vector_memory
+
+from chat_config import (STOP_GENERATING_STRING, config, MODEL_MEMORY_BUDGET, DEFAULT_MODEL, AUTOTUNE,
+                         AUTOTUNE_PROFILES, models, instructions)
+
+# every model has its own request queue.
+# INFERENCE_MAX_QUEUE_SIZE waiting requests are accepted, more are rejected (HTTP 429).
+# INFERENCE_QUEUE_TIMEOUT is the default number of seconds a request may wait for the model (0 = no timeout).
+INFERENCE_MAX_QUEUE_SIZE = int(os.environ.get('INFERENCE_MAX_QUEUE_SIZE', 16))
+INFERENCE_QUEUE_TIMEOUT = float(os.environ.get('INFERENCE_QUEUE_TIMEOUT', 120))
+# number of streamed tokens that may wait for a slow client before generation pauses
+STREAM_BUFFER_SIZE = int(os.environ.get('STREAM_BUFFER_SIZE', 64))
+# /chat_batch answers at most CHAT_BATCH_CONCURRENCY messages at a time
+# (0 = as many as the model generates at once, its replicas times BATCH_ENGINE_SLOTS)
+CHAT_BATCH_CONCURRENCY = int(os.environ.get('CHAT_BATCH_CONCURRENCY', 0))
+# seconds a batch message waits before trying again when the inference queue is full
+CHAT_BATCH_RETRY_INTERVAL = 0.5
+# default max. seconds per request (waiting and generating). At the deadline, generation stops
+# and the answer generated so far is returned. (0 = no deadline)
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', 0))
+
+# evaluated prompt prefixes (KV cache) are kept per instruction and per conversation,
+# so only the new part of a prompt needs to be evaluated. (per model replica, 0 = disabled)
+PROMPT_CACHE_MAX_BYTES = int(os.environ.get('PROMPT_CACHE_MAX_BYTES', 1 << 30))
+
+# answers to requests without chat history can be cached for RESPONSE_CACHE_TTL seconds (0 = disabled).
+# the cache holds RESPONSE_CACHE_MAX_BYTES in memory, with RESPONSE_CACHE_DIR also on disk.
+# (prompts that contain the current time only match within the same minute)
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 0))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 16 << 20))
+RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR', '')
+answer_cache = None
+if RESPONSE_CACHE_TTL > 0:
+    answer_cache = response_cache.ResponseCache(ttl=RESPONSE_CACHE_TTL, capacity_bytes=RESPONSE_CACHE_MAX_BYTES,
+                                                directory=RESPONSE_CACHE_DIR or None)
+
+registry = model_registry.ModelRegistry(memory_budget_bytes=MODEL_MEMORY_BUDGET,
+                                        profiles=autotune.ProfileStore(AUTOTUNE_PROFILES) if AUTOTUNE != 'off' else None,
+                                        autotune_on_load=AUTOTUNE == 'startup')
+for model_name, model_settings in models.items():
+    if model_settings['path'] is None and model_name != DEFAULT_MODEL:
+        print(f"model file of '{model_name}' not found, using '{DEFAULT_MODEL}' instead.")
+        registry.alias(model_name, DEFAULT_MODEL)
+        continue
+    registry.register(model_name, **model_settings,
+                      max_queue_size=INFERENCE_MAX_QUEUE_SIZE, queue_timeout=INFERENCE_QUEUE_TIMEOUT or None,
+                      prompt_cache_bytes=PROMPT_CACHE_MAX_BYTES, required=model_name == DEFAULT_MODEL)
+
+# the default model (for warmup and readiness)
+model = registry.get(DEFAULT_MODEL).subsystem
+
+# the prompt gets the newest history messages that fit into the context next to the rest of the prompt and the answer.
+# a chat history is summarized once it has CHAT_HISTORY_TOKEN_LIMIT tokens, the newest CHAT_DETAILED_HISTORY_TOKENS are kept.
+# CHAT_MAX_HISTORY_ENTRIES is only a safety limit, older messages are dropped without summary.
+CHAT_HISTORY_TOKEN_LIMIT = int(os.environ.get('CHAT_HISTORY_TOKEN_LIMIT', 1536))
+CHAT_DETAILED_HISTORY_TOKENS = int(os.environ.get('CHAT_DETAILED_HISTORY_TOKENS', 512))
+CHAT_MAX_HISTORY_ENTRIES = int(os.environ.get('CHAT_MAX_HISTORY_ENTRIES', 100))
+# chat histories are loaded on first use, at most CHAT_MAX_RESIDENT_SESSIONS are kept in memory.
+CHAT_MAX_RESIDENT_SESSIONS = int(os.environ.get('CHAT_MAX_RESIDENT_SESSIONS', 256))
+# number of worker processes serving the API (set by dispatcher.py). every chat is served by one of them,
+# the history store is shared, so it defaults to sqlite with more than one worker.
+WORKER_COUNT = int(os.environ.get('WORKER_COUNT', 1))
+# CHAT_HISTORY_BACKEND selects how chat histories are persisted:
+# "journal" (append-only log + snapshots), "sqlite" (single database in WAL mode) or "json" (full rewrite per message)
+CHAT_HISTORY_BACKEND = os.environ.get('CHAT_HISTORY_BACKEND', 'sqlite' if WORKER_COUNT > 1 else 'journal')
+CHAT_HISTORY_FLUSH_INTERVAL = float(os.environ.get('CHAT_HISTORY_FLUSH_INTERVAL', 1.0))
+# CHAT_SUMMARY_MODE "incremental" only summarizes the messages dropped from the history and rolls the summaries up
+# once there are more than CHAT_MAX_SUMMARY_SEGMENTS. "full" re-summarizes the summary together with the whole history.
+CHAT_SUMMARY_MODE = os.environ.get('CHAT_SUMMARY_MODE', 'incremental')
+CHAT_MAX_SUMMARY_SEGMENTS = int(os.environ.get('CHAT_MAX_SUMMARY_SEGMENTS', 3))
+# LONG_TERM_MEMORY=1 keeps every chat message (and injected memory) in a vector index per chat (in long_term_memory/).
+# the older messages most relevant to a prompt are added to it, with at most LONG_TERM_MEMORY_TOKENS tokens.
+# EMBEDDING_MODEL is a sentence-transformers model (without sentence-transformers, hashed word features are used).
+LONG_TERM_MEMORY = os.environ.get('LONG_TERM_MEMORY', '0') not in ('0', 'false', 'False')
+LONG_TERM_MEMORY_TOKENS = int(os.environ.get('LONG_TERM_MEMORY_TOKENS', 256))
+LONG_TERM_MEMORY_TOP_K = int(os.environ.get('LONG_TERM_MEMORY_TOP_K', 8))
+LONG_TERM_MEMORY_MIN_SCORE = float(os.environ.get('LONG_TERM_MEMORY_MIN_SCORE', 0.3))
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+
+
+def get_model(instruction):
+    """Return the model_registry.Model of an instruction config."""
+    return registry.get(instructions[instruction].get('model', DEFAULT_MODEL))
+
+
+def count_tokens(text, instruction='_'):
+    """Return the number of model tokens of text. (stored history messages are counted with the default instruction)"""
+    try:
+        return len(get_model(instruction).tokenize(text, add_bos=False))
+    except Exception:
+        # rough estimate, so histories can still be stored while the model is unavailable
+        return len(text) // 4 + 1
+
+
+long_term_memory = None
+if LONG_TERM_MEMORY:
+    long_term_memory = vector_memory.LongTermMemory(embedding_model=EMBEDDING_MODEL, min_score=LONG_TERM_MEMORY_MIN_SCORE)
+
+chat_manager = chat_history.ChatManager(max_entries=CHAT_MAX_HISTORY_ENTRIES, max_resident_chats=CHAT_MAX_RESIDENT_SESSIONS,
+                                        store=history_store.create_history_store(CHAT_HISTORY_BACKEND, flush_interval=CHAT_HISTORY_FLUSH_INTERVAL),
+                                        summary_mode=CHAT_SUMMARY_MODE, max_summary_segments=CHAT_MAX_SUMMARY_SEGMENTS,
+                                        token_counter=count_tokens, token_limit=CHAT_HISTORY_TOKEN_LIMIT,
+                                        long_term_memory=long_term_memory)
+
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def is_valid_session_id(session_id):
+    """Session ids are used in file names, so only allow a safe set of characters."""
+    return session_id == '' or SESSION_ID_PATTERN.match(session_id) is not None
+
+
+def get_chat_key(instruction, session_id=''):
+    """Return the chat history key of a conversation. Without session_id, all callers of an instruction share one history."""
+    if session_id:
+        return f"{instruction}__{session_id}"
+    return instruction
+
+
+# prompt template fields that change between conversations or requests.
+# everything in front of the first one is the same for every prompt of an instruction config.
+VOLATILE_PROMPT_FIELDS = ['{summary}', '{history}', '{name}', '{prompt}', '{current_day}', '{current_datetime}']
+
+
+def get_static_prompt_prefix(instruction):
+    """Return the formatted part of the instruction prompt that is the same for every request."""
+    init_prompt = instructions[instruction]['init_prompt']
+    cut = min([init_prompt.find(field) for field in VOLATILE_PROMPT_FIELDS if field in init_prompt], default=len(init_prompt))
+    return init_prompt[:cut].format(ai_name=instructions[instruction]['ai_name'])
+
+
+def prepare_prompt_state(replica, prompt, instruction, conversation_key=None):
+    """
+    Load the longest cached KV state matching prompt into the llm of replica, so llama.cpp only evaluates the new tokens.
+    Must be called while holding the model slot.
+    """
+    llm = replica.llm
+    prompt_state_cache = replica.prompt_cache
+
+    if PROMPT_CACHE_MAX_BYTES <= 0 or replica.engine is not None:
+        return
+
+    prompt_tokens = llm.tokenize(prompt.encode("utf-8"))
+
+    reused = 0
+    if conversation_key is not None:
+        reused = prompt_state_cache.restore(llm, ('conversation', instruction, conversation_key), prompt_tokens)
+
+    instruction_key = ('instruction', instruction)
+    reused = max(reused, prompt_state_cache.restore(llm, instruction_key, prompt_tokens))
+
+    # evaluate the static instruction prefix once, so every conversation of this instruction can start from it
+    prefix_tokens = llm.tokenize(get_static_prompt_prefix(instruction).encode("utf-8"))
+    if reused < len(prefix_tokens) and prefix_tokens == prompt_tokens[:len(prefix_tokens)]:
+        llm.reset()
+        llm.eval(prefix_tokens)
+        prompt_state_cache.store(llm, instruction_key)
+        reused = len(prefix_tokens)
+
+    print(f"prompt cache: reusing {reused} of {len(prompt_tokens)} prompt tokens")
+
+
+def store_prompt_state(replica, instruction, conversation_key):
+    """Cache the current KV state of the llm of replica for the next turn of a conversation."""
+    if PROMPT_CACHE_MAX_BYTES <= 0 or replica.engine is not None or conversation_key is None:
+        return
+    replica.prompt_cache.store(replica.llm, ('conversation', instruction, conversation_key))
+
+
+def remove_llama2_instruct_tags(text):
+    # Use regular expression to remove everything between [INST] and [/INST], including the tags themselves
+    text = re.sub(r'\[INST\].*?\[/INST\]\n?', '', text, flags=re.DOTALL)
+
+    text = text.replace(STOP_GENERATING_STRING, "")
+    text = text.replace("[INST]", "").replace("[/INST]", "")
+    text = text.replace("<<SYS>>", "").replace("<</SYS>>", "")
+
+    return text
+
+
+def remove_emotions(text):
+    # This regular expression matches any string that starts with an asterisk (*) and ends with an asterisk (*)
+    # and removes it from the text. (like *ears perk up* and similar)
+    return re.sub(r'(?<!\*)\*.*?\*(?!\*)', '', text).strip()
+
+
+# answer cleanup pipelines by instruction config name
+cleanup_pipelines = {}
+
+
+def get_answer_cleanup(instruction):
+    """Return the answer_cleanup.CleanupPipeline of an instruction config (created on first use)."""
+    pipeline = cleanup_pipelines.get(instruction)
+    if pipeline is None:
+        remove_spans = []
+        replacements = []
+        if instructions[instruction]['instruct_tags_type'] == 'llama2':
+            # these should never be in the answer text (see remove_llama2_instruct_tags)
+            remove_spans.append(("[INST]", "[/INST]"))
+            replacements += [(STOP_GENERATING_STRING, ""), ("[INST]", ""), ("[/INST]", ""), ("<<SYS>>", ""), ("<</SYS>>", "")]
+        replacements += list(instructions[instruction]['result_replacements'].items())
+
+        # remove chat name from the beginning of the answer (and possible from empty name remaining ':')
+        ai_name = None
+        if instructions[instruction]['communication_type'] == 'multi_user_chat':
+            ai_name = instructions[instruction]['ai_name']
+
+        pipeline = cleanup_pipelines[instruction] = answer_cleanup.CleanupPipeline(remove_spans, replacements, ai_name)
+    return pipeline
+
+
+def add_summary_to_chat_history(chat_key='_'):
+    # a coalesced request might find the chat already summarized
+    if not chat_manager.is_full(chat_key):
+        return
+    if not summary_generator.subsystem.enabled:
+        chat_manager.trim(chat_key, retain_tokens=CHAT_DETAILED_HISTORY_TOKENS)
+        chat_manager.save_history(chat_key)
+        return
+    start_time = time.perf_counter()
+    chat_manager.summarize(chat_key, retain_tokens=CHAT_DETAILED_HISTORY_TOKENS)
+    duration = time.perf_counter() - start_time
+    metrics.summary_seconds.observe(duration, kind="chat")
+    metrics.log_event("chat_summary", chat_key=chat_key, duration=round(duration, 4))
+
+    chat_manager.save_history(chat_key)
+
+
+# summaries are generated in the background, at most SUMMARY_MAX_WORKERS at the same time and one per chat.
+SUMMARY_MAX_WORKERS = int(os.environ.get('SUMMARY_MAX_WORKERS', 1))
+summary_scheduler = summary_worker.SummaryWorker(add_summary_to_chat_history, max_workers=SUMMARY_MAX_WORKERS)
+
+
+def handle_full_history(chat_key, instruction='_'):
+    """
+    Summarize a full chat history in the background, or, if the instruction config (or the server) doesn't generate summaries,
+    drop its oldest messages right away, so the newest CHAT_DETAILED_HISTORY_TOKENS are left.
+    """
+    if not chat_manager.is_full(chat_key):
+        return
+    if summary_generator.subsystem.enabled and instructions[instruction]['generate_summary_on_full_history']:
+        summary_scheduler.request(chat_key)
+    else:
+        chat_manager.trim(chat_key, retain_tokens=CHAT_DETAILED_HISTORY_TOKENS)
+
+
+def build_prompt(text, name='User', instruction='_', chat_key=None):
+    """
+    Format the instruction prompt template for text.
+    With chat_key, the summary, the newest history messages that fit into the context
+    and relevant older messages (long-term memory) are added.
+
+    Returns the prompt and the cleaned up text.
+    """
+    name_str = ''
+    if name != '':
+        name_str = name + ": "
+
+    # Get the current date, time, and day of the week
+    # (minute resolution, so the prompt doesn't change every second)
+    current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M")
+    current_day = datetime.now().strftime("%A")
+
+    # Get AI name of instructions set
+    ai_name = instructions[instruction]['ai_name']
+    init_prompt = instructions[instruction]['init_prompt']
+
+    # remove instruct tags from user input to prevent issues.
+    if instructions[instruction]['instruct_tags_type'] == 'llama2':
+        text = remove_llama2_instruct_tags(text)
+
+    prompt_fields = {
+        'ai_name': ai_name,
+        'summary': "",
+        'history': "",
+        'prompt': text, 'name': name_str, 'current_day': current_day, 'current_datetime': current_datetime,
+    }
+
+    # Fetch chat history and summary for AI memory
+    if chat_key is not None:
+        summary = chat_manager.get_summary(chat_key)
+        if summary != "":
+            prompt_fields['summary'] = " Summary of previous messages: " + summary
+        # memories go behind the history (they change with every prompt, the history in front of them stays cacheable)
+        memories = ""
+        if long_term_memory is not None:
+            memory_lines = chat_manager.get_long_term_memories(chat_key, text, LONG_TERM_MEMORY_TOKENS, top_k=LONG_TERM_MEMORY_TOP_K)
+            if memory_lines:
+                memories = "(memories of earlier messages:\n" + "\n".join(memory_lines) + ")\n"
+        prompt_fields['history'] = memories
+        # the history gets the part of the context the rest of the prompt and the answer don't need
+        context_length = get_model(instruction).context_length
+        token_budget = context_length - config['max_new_tokens'] - count_tokens(init_prompt.format(**prompt_fields), instruction) - 1
+        history = chat_manager.get_messages_string_within_budget(chat_key, token_budget, ai_name=ai_name, stop=STOP_GENERATING_STRING)
+        if history != "":
+            prompt_fields['history'] = history + "\n" + memories
+
+    # format prompt to fit instruction prompt template
+    return init_prompt.format(**prompt_fields), text
+
+
+def submit_to_engine(replica, prompt, cancellation):
+    """Queue prompt in the batch engine of replica with the sampling settings of config."""
+    return replica.engine.submit(replica.llm.tokenize(prompt.encode("utf-8")),
+                                 max_tokens=config['max_new_tokens'],
+                                 stop=[STOP_GENERATING_STRING],
+                                 temperature=config['temperature'],
+                                 repeat_penalty=config['repetition_penalty'],
+                                 should_stop=cancellation.is_cancelled,
+                                 )
+
+
+def stop_when_cancelled(cancellation):
+    """Return a llama.cpp stopping criteria (checked after every token) that ends the generation once cancellation is cancelled."""
+    return lambda input_ids, logits: cancellation.is_cancelled()
+
+
+def save_answer_to_history(chat_key, name, text, answer, instruction, cancellation):
+    """Add a message and its answer to the chat history and request a summary if the history is full."""
+    if cancellation.is_cancelled() and (not instructions[instruction]['save_partial_answers'] or answer == ""):
+        return
+
+    history_answer = answer.replace("\n", " ")
+    if instructions[instruction]['remove_emotions_from_history']:
+        history_answer = remove_emotions(answer.replace("\n", " "))
+    chat_manager.add_message(chat_key, name, text.replace("\n", " "))
+    chat_manager.add_message(chat_key,
+                             instructions[instruction]['ai_name'],
+                             history_answer
+                             )
+    # generate new summary if chat history is full (in the background)
+    handle_full_history(chat_key, instruction)
+
+    chat_manager.save_history(chat_key)
+
+
+def report_timings(ticket, instruction, stats=None, generation=None):
+    """
+    Log and record the timings of a finished request and copy them into stats (if given).
+
+    generation can hold prompt_tokens, completion_tokens, prompt_eval_time and time_to_first_token.
+    """
+    model_name = get_model(instruction).name
+    generation = dict(generation or {})
+
+    metrics.queue_wait_seconds.observe(ticket.queue_wait, model=model_name, instruction=instruction)
+    if ticket.started_at is not None:
+        metrics.generation_seconds.observe(ticket.generation_time, model=model_name, instruction=instruction)
+    if generation.get('prompt_tokens'):
+        metrics.prompt_tokens.inc(generation['prompt_tokens'], model=model_name)
+    if generation.get('prompt_eval_time') is not None:
+        metrics.prompt_eval_seconds.observe(generation['prompt_eval_time'], model=model_name)
+    if generation.get('time_to_first_token') is not None:
+        metrics.time_to_first_token_seconds.observe(generation['time_to_first_token'], model=model_name, instruction=instruction)
+    if generation.get('cancelled'):
+        metrics.cancelled_requests.inc(model=model_name, reason=generation['cancelled'])
+    if generation.get('completion_tokens'):
+        metrics.generated_tokens.inc(generation['completion_tokens'], model=model_name)
+        # the time after the prompt evaluation is spent generating
+        decode_time = ticket.generation_time - (generation.get('prompt_eval_time') or generation.get('time_to_first_token') or 0)
+        if decode_time > 0:
+            generation['tokens_per_second'] = generation['completion_tokens'] / decode_time
+            metrics.tokens_per_second.observe(generation['tokens_per_second'], model=model_name)
+
+    metrics.log_event("inference", instruction=instruction, model=model_name,
+                      queue_wait=round(ticket.queue_wait, 4), generation_time=round(ticket.generation_time, 4),
+                      **{key: round(value, 4) if isinstance(value, float) else value for key, value in generation.items()})
+    if stats is not None:
+        stats['queue_wait'] = ticket.queue_wait
+        stats['generation_time'] = ticket.generation_time
+        stats.update(generation)
+
+
+def generate_answer(prompt, instruction='_', conversation_key=None, priority=0, timeout=None, stats=None, cancellation=None):
+    """
+    Generate and clean up the answer to a formatted prompt. Returns None if generation failed.
+    If cancellation is cancelled during generation, the answer generated so far is returned.
+
+    Raises inference_queue.QueueFullError if the inference queue is saturated,
+    inference_queue.QueueTimeoutError if the model did not become free within timeout seconds and
+    inference_queue.RequestCancelledError if cancellation is cancelled while waiting for the model.
+    """
+    if cancellation is None:
+        cancellation = inference_queue.Cancellation()
+
+    # Wait for our turn on the model
+    ticket = get_model(instruction).scheduler.submit(priority=priority, timeout=timeout)
+    ticket.wait(cancellation)
+
+    # Call the AI model
+    generation = {}
+    try:
+        with get_model(instruction).use() as replica, replica.pinned():
+            if replica.engine is not None:
+                sequence = submit_to_engine(replica, prompt, cancellation)
+                answer = sequence.result()
+                generation['prompt_tokens'] = len(sequence.prompt_tokens)
+                generation['completion_tokens'] = len(sequence.generated_tokens)
+            else:
+                prepare_prompt_state(replica, prompt, instruction, conversation_key)
+                replica.reset_timings()
+                answer_dict = replica.llm(prompt,
+                                          max_tokens=config['max_new_tokens'],
+                                          stop=[STOP_GENERATING_STRING],
+                                          echo=False,
+                                          temperature=config['temperature'],
+                                          repeat_penalty=config['repetition_penalty'],
+                                          stopping_criteria=stop_when_cancelled(cancellation),
+                                          )
+                generation['prompt_eval_time'] = replica.prompt_eval_seconds()
+                if not cancellation.is_cancelled():
+                    store_prompt_state(replica, instruction, conversation_key)
+                generation['prompt_tokens'] = answer_dict['usage']['prompt_tokens']
+                generation['completion_tokens'] = answer_dict['usage']['completion_tokens']
+                answer = answer_dict['choices'][0]['text']
+        if cancellation.is_cancelled():
+            generation['cancelled'] = cancellation.reason
+    except Exception as e:
+        print(e)
+        return None
+    finally:
+        ticket.release()
+        report_timings(ticket, instruction, stats, generation)
+
+    # cleanup AI answer according to instruction config
+    return get_answer_cleanup(instruction).clean(answer)
+
+
+def message(text, name='User', instruction='_', disable_history=False, priority=0, timeout=None, stats=None, session_id='',
+            cancellation=None):
+    """
+    Generate an answer to text.
+
+    Raises inference_queue.QueueFullError if the inference queue is saturated,
+    inference_queue.QueueTimeoutError if the model did not become free within timeout seconds and
+    inference_queue.RequestCancelledError if cancellation is cancelled while waiting for the model (or an identical request).
+    If stats is a dict, queue_wait and generation_time (seconds) are written into it
+    (and response_cache "hit", "coalesced" or "miss" if the answer cache is used,
+    cancelled "disconnected" or "deadline" if the answer was cut off).
+    """
+    if cancellation is None:
+        cancellation = inference_queue.Cancellation(REQUEST_DEADLINE or None)
+    chat_key = get_chat_key(instruction, session_id)
+
+    conversation_key = None
+    if not disable_history and instructions[instruction]['save_history']:
+        conversation_key = chat_key
+    prompt, text = build_prompt(text, name, instruction, conversation_key)
+
+    if answer_cache is not None and conversation_key is None:
+        # without history, the answer only depends on the prompt, the model and the sampling settings
+        cache_key = response_cache.make_key(get_model(instruction).name, prompt, config['max_new_tokens'],
+                                            config['temperature'], config['repetition_penalty'], STOP_GENERATING_STRING)
+        generated = {}
+
+        def generate_cacheable_answer():
+            generated['answer'] = generate_answer(prompt, instruction, None, priority, timeout, stats, cancellation)
+            # answers that were cut off are not cached
+            return None if cancellation.is_cancelled() else generated['answer']
+
+        answer, cache_source = answer_cache.get_or_compute(cache_key, generate_cacheable_answer, cancellation)
+        if cache_source == "miss":
+            answer = generated['answer']
+        elif answer is None:
+            # the identical request this one waited for was cancelled
+            answer = generate_answer(prompt, instruction, None, priority, timeout, stats, cancellation)
+        if stats is not None:
+            stats['response_cache'] = cache_source
+    else:
+        answer = generate_answer(prompt, instruction, conversation_key, priority, timeout, stats, cancellation)
+    if answer is None:
+        return ""
+    if cancellation.is_cancelled() and stats is not None:
+        stats['cancelled'] = cancellation.reason
+
+    # add new entries to chat history and generate new summary if needed
+    if not disable_history and instructions[instruction]['save_history']:
+        save_answer_to_history(chat_key, name, text, answer, instruction, cancellation)
+
+    return answer
+
+
+def message_stream(text, name='User', instruction='_', disable_history=False, priority=0, timeout=None, session_id='',
+                   cancellation=None):
+    """
+    Enqueue a streamed answer to text and return an async iterator yielding the answer tokens.
+
+    Queue admission happens immediately, so inference_queue.QueueFullError is raised
+    before any response is sent. Generation runs on a worker thread, so the event loop stays responsive.
+    Generation stops when the generator is closed (client disconnect) or cancellation is cancelled,
+    the queue slot is released if the generator is closed or dropped without being iterated.
+    """
+    if cancellation is None:
+        cancellation = inference_queue.Cancellation(REQUEST_DEADLINE or None)
+    ticket = get_model(instruction).scheduler.submit(priority=priority, timeout=timeout)
+    return inference_queue.stream_from_thread(
+        functools.partial(_generate_stream, ticket, text, name=name, instruction=instruction, disable_history=disable_history,
+                          session_id=session_id, cancellation=cancellation),
+        max_buffer=STREAM_BUFFER_SIZE,
+        on_stop=functools.partial(cancellation.cancel, "disconnected"),
+        # a response that is dropped before it starts streaming never runs _generate_stream, which releases the ticket
+        on_unused=ticket.release
+    )
+
+
+def _generate_stream(ticket, text, emit, name='User', instruction='_', disable_history=False, session_id='', cancellation=None):
+    """Generate a streamed answer on a worker thread and pass every token to emit()."""
+    if cancellation is None:
+        cancellation = inference_queue.Cancellation()
+    generation = {'completion_tokens': 0}
+    # everything after submit() is in the try, so the ticket is always released
+    try:
+        chat_key = get_chat_key(instruction, session_id)
+
+        conversation_key = None
+        if not disable_history and instructions[instruction]['save_history']:
+            conversation_key = chat_key
+        prompt, text = build_prompt(text, name, instruction, conversation_key)
+
+        # Call the AI model
+        answer_text = ""
+        cleaner = get_answer_cleanup(instruction).stream()
+        ticket.wait(cancellation)
+
+        with get_model(instruction).use() as replica, replica.pinned():
+            if replica.engine is not None:
+                sequence = submit_to_engine(replica, prompt, cancellation)
+                generation['prompt_tokens'] = len(sequence.prompt_tokens)
+                for piece in sequence.stream():
+                    generation['completion_tokens'] = len(sequence.generated_tokens)
+                    piece = cleaner.feed(piece)
+                    if piece and not answer_text:
+                        generation['time_to_first_token'] = ticket.generation_time
+                    answer_text += piece
+                    if piece and not emit(piece):
+                        # client is gone, stop generating
+                        cancellation.cancel("disconnected")
+                        sequence.cancel()
+                        break
+            else:
+                prepare_prompt_state(replica, prompt, instruction, conversation_key)
+                generation['prompt_tokens'] = len(replica.llm.tokenize(prompt.encode("utf-8")))
+                text_stream = replica.llm(prompt, stream=True,
+                                          max_tokens=config['max_new_tokens'],
+                                          stop=[STOP_GENERATING_STRING],
+                                          echo=False,
+                                          temperature=config['temperature'],
+                                          repeat_penalty=config['repetition_penalty'],
+                                          stopping_criteria=stop_when_cancelled(cancellation),
+                                          )
+                for answer in text_stream:
+                    generation['completion_tokens'] += 1
+                    piece = cleaner.feed(answer["choices"][0]["text"])
+                    if piece and not answer_text:
+                        generation['time_to_first_token'] = ticket.generation_time
+                    answer_text += piece
+                    if piece and not emit(piece):
+                        # client is gone, stop generating
+                        cancellation.cancel("disconnected")
+                        text_stream.close()
+                        break
+                if not cancellation.is_cancelled():
+                    store_prompt_state(replica, instruction, conversation_key)
+
+            # text held back by the cleanup (like a possible beginning of a replaced string)
+            piece = cleaner.finish()
+            answer_text += piece
+            if piece and not emit(piece):
+                cancellation.cancel("disconnected")
+            if cancellation.is_cancelled():
+                generation['cancelled'] = cancellation.reason
+
+        # add new entries to chat history and generate new summary if needed
+        if not disable_history and instructions[instruction]['save_history']:
+            save_answer_to_history(chat_key, name, text, answer_text, instruction, cancellation)
+
+    except Exception as e:
+        print(e)
+    finally:
+        ticket.release()
+        report_timings(ticket, instruction, generation=generation)
+
+
+def message_batch(items, emit, priority=-1, cancellation=None):
+    """
+    Answer many messages, items are dicts with the arguments of message() (text, name, instruction, session_id,
+    disable_history) and an optional id. emit(result) is called as every answer is done, with
+    {"type": "result", "index", "id", "answer", "queue_wait", "generation_time"} or {"type": "error", "index", "id", "error"}.
+
+    Messages of the same chat history are answered in order, everything else in parallel, as many at a time as the models
+    can generate (see CHAT_BATCH_CONCURRENCY), so batching engines stay full without filling the inference queue.
+    A full queue (interactive requests) is waited out. Stops when emit returns False or cancellation is cancelled.
+    """
+    if cancellation is None:
+        cancellation = inference_queue.Cancellation()
+    chats = {}
+    for index, item in enumerate(items):
+        if not item.get('disable_history') and instructions[item['instruction']]['save_history']:
+            chats.setdefault(get_chat_key(item['instruction'], item.get('session_id', '')), []).append(index)
+        else:
+            chats[index] = [index]
+    concurrency = CHAT_BATCH_CONCURRENCY or max(get_model(item['instruction']).scheduler.max_concurrency for item in items)
+    emit_lock = threading.Lock()
+
+    def answer_chat(indexes):
+        for index in indexes:
+            item = items[index]
+            stats = {}
+            result = None
+            while result is None and not cancellation.is_cancelled():
+                try:
+                    answer = message(item['text'], name=item.get('name', 'User'), instruction=item['instruction'],
+                                     disable_history=item.get('disable_history', False), priority=priority, stats=stats,
+                                     session_id=item.get('session_id', ''), cancellation=cancellation)
+                    result = {"type": "result", "index": index, "id": item.get('id'), "answer": answer,
+                              "queue_wait": round(stats.get('queue_wait', 0.0), 3), "generation_time": round(stats.get('generation_time', 0.0), 3)}
+                except inference_queue.QueueFullError:
+                    time.sleep(CHAT_BATCH_RETRY_INTERVAL)
+                except inference_queue.RequestCancelledError:
+                    return
+                except Exception as e:
+                    result = {"type": "error", "index": index, "id": item.get('id'), "error": str(e)}
+            if result is None:
+                return
+            with emit_lock:
+                if not emit(result):
+                    cancellation.cancel("disconnected")
+                    return
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(chats))), thread_name_prefix="chat-batch") as executor:
+        for future in [executor.submit(answer_chat, indexes) for indexes in chats.values()]:
+            future.result()
+
+
+def inject_memory(text, name='AI', instruction='_', session_id=''):
+    if not instructions[instruction]['save_history']:
+        return None
+
+    chat_key = get_chat_key(instruction, session_id)
+
+    usr_name = name
+    ai_name = instructions[instruction]['ai_name']
+    if name.lower() == 'AI'.lower():
+        usr_name = ai_name
+
+    text = text.format(AI=ai_name)
+
+    history_answer = text.replace("\n", " ")
+    if instructions[instruction]['remove_emotions_from_history']:
+        history_answer = remove_emotions(text.replace("\n", " "))
+
+    chat_manager.add_message(chat_key,
+                             usr_name,
+                             history_answer
+                             )
+    handle_full_history(chat_key, instruction)
+    chat_manager.save_history(chat_key)
+
+    return "SUCCESS"
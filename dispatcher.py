@@ -0,0 +1,319 @@
+# Serves the API with several worker processes (WORKERS) behind one port.
+#
+# Every worker is a uvicorn process of main:app on its own local port, pinned to its share of the CPU cores.
+# The model weights are memory mapped (use_mmap), so the workers share them in the page cache instead of each
+# holding a copy. Requests with a chat history (/chat, /chat_stream, /chat_batch, /inject_memory, /ws with an instruction config
+# that saves its history, or with a session_id) are routed by their instruction config and session,
+# so every chat is always served by the same worker (session affinity).
+# Other requests (and requests with disable_history) go to the least busy worker, ?worker=<index> selects one (like /ready?worker=1,
+# it is ignored for requests with a chat history).
+# /metrics returns the metrics of all workers, every sample labeled with its worker="<index>".
+#
+# usage: python dispatcher.py [--workers 4] [--host 0.0.0.0] [--port 8000]
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.parse
+import zlib
+
+import chat_config
+import metrics
+import model_registry
+
+WORKERS = int(os.environ.get('WORKERS', 1))
+# worker i listens on 127.0.0.1:WORKER_BASE_PORT + i
+WORKER_BASE_PORT = int(os.environ.get('WORKER_BASE_PORT', 8100))
+# paths that use the chat history of (instruction_name, session_id)
+SESSION_PATHS = {"/chat", "/chat_stream", "/chat_batch", "/inject_memory", "/ws"}
+MAX_HEADER_BYTES = 65536
+RESTART_DELAY = 2.0
+STOP_TIMEOUT = 15.0
+
+
+def _error_response(status, reason, detail, retry_after=None):
+    body = json.dumps({"detail": detail}).encode("utf-8")
+    headers = [f"HTTP/1.1 {status} {reason}", "Content-Type: application/json", f"Content-Length: {len(body)}",
+               "Connection: close"]
+    if retry_after is not None:
+        headers.append(f"Retry-After: {retry_after}")
+    return ("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body
+
+
+def rewrite_head(head, client_host):
+    """
+    Prepare the request head for the worker: one request per worker connection (Connection: close,
+    except for WebSocket upgrades) and the client address in X-Forwarded-For (uvicorn trusts it from 127.0.0.1).
+    """
+    lines = head.decode("latin-1").split("\r\n")
+    request_line = lines[0]
+    headers = []
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(":")
+            headers.append((name.strip(), value.strip()))
+    upgrade = any(name.lower() == "connection" and "upgrade" in value.lower() for name, value in headers)
+    if not upgrade:
+        headers = [(name, value) for name, value in headers if name.lower() not in ("connection", "keep-alive")]
+        headers.append(("Connection", "close"))
+    headers = [(name, value) for name, value in headers if name.lower() != "x-forwarded-for"]
+    headers.append(("X-Forwarded-For", client_host))
+    return (request_line + "\r\n" + "".join(f"{name}: {value}\r\n" for name, value in headers) + "\r\n").encode("latin-1")
+
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+
+
+async def _wait_lost(writer):
+    """Wait until the connection of writer is lost or closed (not only half-closed by the other side)."""
+    try:
+        await writer.wait_closed()
+    except (ConnectionError, OSError):
+        pass
+
+
+class Worker:
+    def __init__(self, index, port, count, cpus, app="main:app"):
+        """A uvicorn process of app on 127.0.0.1:port."""
+        self.index = index
+        self.port = port
+        self.count = count
+        self.cpus = cpus
+        self.app = app
+        self.process = None
+        self.active = 0
+        self.started_at = 0.0
+
+    def start(self):
+        env = dict(os.environ, WORKER_INDEX=str(self.index), WORKER_COUNT=str(self.count))
+        preexec_fn = None
+        if self.cpus and hasattr(os, "sched_setaffinity"):
+            # set before exec, so every thread of the worker (and of llama.cpp) inherits it
+            preexec_fn = lambda: os.sched_setaffinity(0, self.cpus)
+        self.process = subprocess.Popen([sys.executable, "-m", "uvicorn", self.app, "--host", "127.0.0.1", "--port", str(self.port)],
+                                        env=env, preexec_fn=preexec_fn)
+        self.started_at = time.monotonic()
+        metrics.log_event("worker_started", worker=self.index, pid=self.process.pid, port=self.port, cpus=self.cpus)
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.is_running():
+            self.process.terminate()
+
+    def wait(self, timeout):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+async def _get(port, target):
+    """Return the body of GET target from the worker on port (None if it is not available)."""
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    except OSError:
+        return None
+    try:
+        writer.write(f"GET {target} HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n".encode("latin-1"))
+        await writer.drain()
+        response = await reader.read()
+    except (ConnectionError, OSError):
+        return None
+    finally:
+        writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    if b" 200 " not in head.split(b"\r\n", 1)[0] + b" ":
+        return None
+    return body
+
+
+def history_instructions():
+    """Return the names of the instruction configs that save their chat history."""
+    return {name for name, instruction in chat_config.instructions.items() if instruction['save_history']}
+
+
+class Dispatcher:
+    def __init__(self, worker_count, base_port=WORKER_BASE_PORT, app="main:app", history_instructions=None):
+        """
+        Route requests to worker_count uvicorn processes of app (benchmarks use an app with stub models).
+        history_instructions are the instruction configs that save their history (None = all of them).
+        """
+        self.workers = [Worker(index, base_port + index, worker_count, cpus, app)
+                        for index, cpus in enumerate(model_registry.split_cpus(worker_count))]
+        self.history_instructions = history_instructions
+        self._stopping = False
+        self._connections = set()
+
+    def route(self, target):
+        """Return the worker for the request target (path and query)."""
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path in SESSION_PATHS and not query.get("disable_history", [""])[0].lower() in ("1", "true", "yes", "on"):
+            instruction = query.get("instruction_name", ["_"])[0]
+            session_id = query.get("session_id", [""])[0]
+            if session_id or self.history_instructions is None or instruction in self.history_instructions:
+                # ?worker= is ignored, another worker would answer from (and save to) a stale copy of the chat history
+                chat = instruction + "/" + session_id
+                return self.workers[zlib.crc32(chat.encode("utf-8")) % len(self.workers)]
+        if "worker" in query:
+            try:
+                return self.workers[int(query["worker"][0]) % len(self.workers)]
+            except ValueError:
+                pass
+        return min(self.workers, key=lambda worker: worker.active)
+
+    async def merged_metrics(self):
+        """Return the metrics of all running workers, labeled with their worker index."""
+        bodies = await asyncio.gather(*(_get(worker.port, "/metrics") for worker in self.workers))
+        return metrics.merge({worker.index: body.decode("utf-8") for worker, body in zip(self.workers, bodies) if body is not None})
+
+    async def handle(self, client_reader, client_writer):
+        # the event loop only keeps weak references to tasks, and the socket of a client that shut down its sending side
+        # is not polled anymore, so nothing else would keep the task alive while it waits for the worker
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            await self._exchange(client_reader, client_writer)
+        finally:
+            self._connections.discard(task)
+
+    async def _exchange(self, client_reader, client_writer):
+        try:
+            head = await client_reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            client_writer.write(_error_response(431, "Request Header Fields Too Large", "request header too large"))
+            await client_writer.drain()
+            client_writer.close()
+            return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            client_writer.close()
+            return
+
+        try:
+            target = head.split(b" ", 2)[1].decode("latin-1")
+        except IndexError:
+            client_writer.write(_error_response(400, "Bad Request", "invalid request line"))
+            await client_writer.drain()
+            client_writer.close()
+            return
+        url = urllib.parse.urlsplit(target)
+        if url.path == "/metrics" and "worker" not in urllib.parse.parse_qs(url.query):
+            body = (await self.merged_metrics()).encode("utf-8")
+            client_writer.write((f"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode("latin-1") + body)
+            await client_writer.drain()
+            client_writer.close()
+            return
+
+        worker = self.route(target)
+        client_host = (client_writer.get_extra_info("peername") or ("",))[0]
+
+        try:
+            worker_reader, worker_writer = await asyncio.open_connection("127.0.0.1", worker.port)
+        except OSError:
+            # the worker is (re)starting
+            client_writer.write(_error_response(503, "Service Unavailable", f"worker {worker.index} is not available", retry_after=5))
+            await client_writer.drain()
+            client_writer.close()
+            return
+
+        worker.active += 1
+        worker_writer.write(rewrite_head(head, client_host))
+        to_worker = asyncio.ensure_future(_pipe(client_reader, worker_writer))
+        to_client = asyncio.ensure_future(_pipe(worker_reader, client_writer))
+        client_lost = asyncio.ensure_future(_wait_lost(client_writer))
+        try:
+            # the worker closes the connection after the response. A client that only shuts down its sending side
+            # still gets the response, a client whose connection is lost closes it early (so the worker cancels the generation).
+            # (a client that closed its socket is noticed when the response is written to it)
+            await asyncio.wait([to_client, client_lost], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            to_worker.cancel()
+            to_client.cancel()
+            client_lost.cancel()
+            worker.active -= 1
+            worker_writer.close()
+            client_writer.close()
+
+    async def supervise(self):
+        """Restart workers that exited."""
+        while not self._stopping:
+            for worker in self.workers:
+                if not worker.is_running() and time.monotonic() - worker.started_at >= RESTART_DELAY:
+                    if worker.process is not None:
+                        metrics.log_event("worker_exited", worker=worker.index, returncode=worker.process.returncode)
+                    worker.start()
+            await asyncio.sleep(0.5)
+
+    async def serve(self, host, port):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, stop.set)
+            except (NotImplementedError, RuntimeError):
+                # Windows (Ctrl+C raises KeyboardInterrupt instead)
+                pass
+
+        supervisor = asyncio.ensure_future(self.supervise())
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_BYTES)
+        print(f"dispatching http://{host}:{port} to {len(self.workers)} workers (ports {self.workers[0].port}-{self.workers[-1].port})")
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            self._stopping = True
+            supervisor.cancel()
+
+    def stop(self):
+        self._stopping = True
+        for worker in self.workers:
+            worker.stop()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for worker in self.workers:
+            worker.wait(max(0.0, deadline - time.monotonic()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the API with several worker processes.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="worker processes (default: WORKERS, 1 = no dispatcher)")
+    parser.add_argument("--worker-port", type=int, default=WORKER_BASE_PORT, help="port of the first worker (default: WORKER_BASE_PORT)")
+    parser.add_argument("--app", default="main:app", help="ASGI app of the workers")
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        import uvicorn
+        uvicorn.run(args.app, host=args.host, port=args.port)
+        return
+
+    dispatcher = Dispatcher(args.workers, args.worker_port, args.app, history_instructions=history_instructions())
+    try:
+        asyncio.run(dispatcher.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.stop()
+
+
+if __name__ == "__main__":
+    main()
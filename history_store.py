@@ -0,0 +1,423 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+
+
+def _apply_operation(chat, operation):
+    """Apply a single journal operation to a chat dict."""
+    op = operation.get('op')
+    if op == 'add':
+        chat['messages'].append(operation['message'])
+    elif op == 'keep':
+        keep = operation['count']
+        chat['messages'] = chat['messages'][-keep:] if keep > 0 else []
+    elif op == 'set':
+        chat.update(operation['fields'])
+
+
+def _write_json_atomic(filename, data):
+    """Write data as JSON so that filename always contains either the old or the new version."""
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w') as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_filename, filename)
+
+
+class HistoryStore:
+    """
+    Persistence backend of ChatManager.
+
+    Every change of a chat is passed on as a single operation,
+    so backends can persist messages without rewriting the whole history.
+    """
+
+    def load(self, chat_key):
+        """Return the stored chat dict ({"messages": [...], "summary": "", ...}) or None if it doesn't exist."""
+        raise NotImplementedError
+
+    def append_message(self, chat_key, message):
+        """Persist a new message at the end of the chat."""
+        raise NotImplementedError
+
+    def truncate_messages(self, chat_key, keep):
+        """Only keep the newest keep messages of the chat."""
+        raise NotImplementedError
+
+    def update(self, chat_key, **fields):
+        """Persist chat fields other than the messages (like the summary)."""
+        raise NotImplementedError
+
+    def save(self, chat_key, chat):
+        """Called after a request changed the chat. chat is the complete in-memory chat dict."""
+        pass
+
+    def flush(self):
+        """Make all pending changes durable."""
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class JsonFileHistoryStore(HistoryStore):
+    def __init__(self, directory='chat_histories'):
+        """One JSON file per chat, rewritten completely (but atomically) on every save()."""
+        self.directory = directory
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _filename(self, chat_key):
+        return os.path.join(self.directory, f"{chat_key}.json")
+
+    def _get_lock(self, chat_key):
+        with self._locks_lock:
+            if chat_key not in self._locks:
+                self._locks[chat_key] = threading.Lock()
+            return self._locks[chat_key]
+
+    def load(self, chat_key):
+        filename = self._filename(chat_key)
+        try:
+            with open(filename, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except (IOError, PermissionError, ValueError) as e:
+            print(f"Error loading chat '{chat_key}' from file '{filename}': {e}")
+            return None
+
+    def append_message(self, chat_key, message):
+        pass
+
+    def truncate_messages(self, chat_key, keep):
+        pass
+
+    def update(self, chat_key, **fields):
+        pass
+
+    def save(self, chat_key, chat):
+        filename = self._filename(chat_key)
+        with self._get_lock(chat_key):
+            os.makedirs(self.directory, exist_ok=True)
+            start_time = time.perf_counter()
+            try:
+                _write_json_atomic(filename, chat)
+            except (IOError, PermissionError) as e:
+                print(f"Error saving chat '{chat_key}' to file '{filename}': {e}")
+            metrics.history_persist_seconds.observe(time.perf_counter() - start_time, backend="json")
+
+
+class JournalHistoryStore(HistoryStore):
+    def __init__(self, directory='chat_histories', flush_interval=1.0, compact_after=200):
+        """
+        Append-only journal per chat (<chat_key>.journal, one JSON operation per line)
+        on top of a snapshot (<chat_key>.json, same format as JsonFileHistoryStore).
+
+        Operations are buffered and written by a background thread every flush_interval seconds
+        with one fsync per batch. Once a journal holds compact_after operations,
+        it is folded into a new snapshot. Every operation carries a sequence number,
+        so a crash between writing the snapshot and truncating the journal can't apply an operation twice,
+        and a torn last journal line is ignored.
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.compact_after = compact_after
+        self._pending = {}  # chat_key -> list of operations not written yet
+        self._seq = {}  # chat_key -> last used sequence number
+        self._journal_size = {}  # chat_key -> number of operations in the journal file
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _snapshot_filename(self, chat_key):
+        return os.path.join(self.directory, f"{chat_key}.json")
+
+    def _journal_filename(self, chat_key):
+        return os.path.join(self.directory, f"{chat_key}.journal")
+
+    def _read(self, chat_key):
+        """Return (chat, last sequence number, number of journal operations) from disk."""
+        chat = None
+        filename = self._snapshot_filename(chat_key)
+        try:
+            with open(filename, 'r') as file:
+                chat = json.load(file)
+        except FileNotFoundError:
+            pass
+        except (IOError, PermissionError, ValueError) as e:
+            print(f"Error loading chat '{chat_key}' from file '{filename}': {e}")
+
+        seq = 0
+        if chat is not None:
+            seq = chat.pop('seq', 0)
+
+        journal_size = 0
+        filename = self._journal_filename(chat_key)
+        try:
+            with open(filename, 'r', encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        operation = json.loads(line)
+                    except ValueError:
+                        # torn write of the last line
+                        continue
+                    journal_size += 1
+                    if operation.get('seq', 0) <= seq:
+                        continue
+                    if chat is None:
+                        chat = {"messages": [], "summary": ""}
+                    _apply_operation(chat, operation)
+                    seq = operation['seq']
+        except FileNotFoundError:
+            pass
+        except (IOError, PermissionError) as e:
+            print(f"Error loading journal of chat '{chat_key}' from file '{filename}': {e}")
+
+        return chat, seq, journal_size
+
+    def load(self, chat_key):
+        self.flush()
+        # a compaction replaces the snapshot and truncates the journal, both must be read from the same state
+        with self._write_lock:
+            chat, seq, journal_size = self._read(chat_key)
+        with self._lock:
+            self._seq[chat_key] = max(seq, self._seq.get(chat_key, 0))
+            self._journal_size[chat_key] = journal_size
+        return chat
+
+    def _record(self, chat_key, operation):
+        with self._lock:
+            known = chat_key in self._seq
+        if not known:
+            # (same lock order as flush)
+            with self._write_lock, self._lock:
+                if chat_key not in self._seq:
+                    _, self._seq[chat_key], self._journal_size[chat_key] = self._read(chat_key)
+        with self._lock:
+            self._seq[chat_key] += 1
+            operation['seq'] = self._seq[chat_key]
+            self._pending.setdefault(chat_key, []).append(operation)
+
+    def append_message(self, chat_key, message):
+        self._record(chat_key, {'op': 'add', 'message': message})
+
+    def truncate_messages(self, chat_key, keep):
+        self._record(chat_key, {'op': 'keep', 'count': keep})
+
+    def update(self, chat_key, **fields):
+        self._record(chat_key, {'op': 'set', 'fields': fields})
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            start_time = time.perf_counter()
+            for chat_key, operations in pending.items():
+                filename = self._journal_filename(chat_key)
+                try:
+                    os.makedirs(self.directory, exist_ok=True)
+                    with open(filename, 'ab+') as file:
+                        data = "".join(json.dumps(operation) + "\n" for operation in operations).encode("utf-8")
+                        # terminate a torn last line, so it doesn't swallow the first new operation
+                        if file.seek(0, os.SEEK_END) > 0:
+                            file.seek(-1, os.SEEK_END)
+                            if file.read(1) != b"\n":
+                                data = b"\n" + data
+                        file.write(data)
+                        file.flush()
+                        os.fsync(file.fileno())
+                except (IOError, PermissionError) as e:
+                    print(f"Error saving chat '{chat_key}' to file '{filename}': {e}")
+                    # written again with the next flush (operations that were written in part are skipped by their seq on load)
+                    with self._lock:
+                        self._pending[chat_key] = operations + self._pending.get(chat_key, [])
+                    continue
+                with self._lock:
+                    self._journal_size[chat_key] = self._journal_size.get(chat_key, 0) + len(operations)
+                    needs_compaction = self._journal_size[chat_key] >= self.compact_after
+                if needs_compaction:
+                    self._compact(chat_key)
+            metrics.history_persist_seconds.observe(time.perf_counter() - start_time, backend="journal")
+
+    def _compact(self, chat_key):
+        """Fold the journal into a new snapshot. Must be called with self._write_lock held."""
+        chat, seq, _ = self._read(chat_key)
+        if chat is None:
+            return
+        chat['seq'] = seq
+        try:
+            _write_json_atomic(self._snapshot_filename(chat_key), chat)
+            # the snapshot is durable, so journal entries up to seq are not needed anymore
+            with open(self._journal_filename(chat_key), 'w') as file:
+                file.flush()
+                os.fsync(file.fileno())
+        except (IOError, PermissionError) as e:
+            print(f"Error compacting chat '{chat_key}': {e}")
+            return
+        with self._lock:
+            self._journal_size[chat_key] = 0
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing chat histories: {e}")
+
+    def close(self):
+        self._closed.set()
+        self.flush()
+
+
+class SQLiteHistoryStore(HistoryStore):
+    def __init__(self, database='chat_histories/chat_histories.sqlite3', flush_interval=1.0, legacy_directory='chat_histories'):
+        """
+        All chats in one SQLite database in WAL mode, one row per message. Several processes can share the database.
+
+        Changes are queued and committed in one short transaction by a background thread every flush_interval seconds
+        (0 commits every change), so the write lock is only held while committing.
+        Chats that only exist as JSON file in legacy_directory are imported on first load.
+        """
+        self.database = database
+        self.flush_interval = flush_interval
+        self.legacy_directory = legacy_directory
+        directory = os.path.dirname(database)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._connection = sqlite3.connect(database, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS chats (chat_key TEXT PRIMARY KEY, fields TEXT NOT NULL)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS messages (chat_key TEXT NOT NULL, seq INTEGER NOT NULL, "
+                                 "message TEXT NOT NULL, PRIMARY KEY (chat_key, seq))")
+        self._connection.commit()
+        self._closed = threading.Event()
+        if flush_interval > 0:
+            threading.Thread(target=self._flush_loop, daemon=True).start()
+        atexit.register(self.close)
+
+    def _write(self, operation):
+        """Queue operation(connection) for the next commit. Must be called with self._lock held."""
+        self._pending.append(operation)
+        if self.flush_interval <= 0:
+            self._commit()
+
+    def _commit(self):
+        # must be called with self._lock held
+        start_time = time.perf_counter()
+        with self._connection:
+            # take the write lock before reading, so other processes can't change the rows in between
+            self._connection.execute("BEGIN IMMEDIATE")
+            for operation in self._pending:
+                operation(self._connection)
+        # a failed transaction is rolled back and the operations stay queued for the next commit
+        self._pending = []
+        metrics.history_persist_seconds.observe(time.perf_counter() - start_time, backend="sqlite")
+
+    def load(self, chat_key):
+        with self._lock:
+            if self._pending:
+                self._commit()
+            row = self._connection.execute("SELECT fields FROM chats WHERE chat_key = ?", (chat_key,)).fetchone()
+            if row is None:
+                return self._import_legacy(chat_key)
+            chat = json.loads(row[0])
+            chat['messages'] = [json.loads(message) for (message,) in self._connection.execute(
+                "SELECT message FROM messages WHERE chat_key = ? ORDER BY seq", (chat_key,))]
+            return chat
+
+    def _import_legacy(self, chat_key):
+        # must be called with self._lock held
+        if self.legacy_directory is None:
+            return None
+        chat = JsonFileHistoryStore(self.legacy_directory).load(chat_key)
+        if chat is None:
+            return None
+        fields = {key: value for key, value in chat.items() if key not in ('messages', 'max_entries', 'seq')}
+        messages = [(chat_key, seq, json.dumps(message)) for seq, message in enumerate(chat.get('messages', []), start=1)]
+
+        def import_chat(connection):
+            connection.execute("INSERT OR REPLACE INTO chats (chat_key, fields) VALUES (?, ?)", (chat_key, json.dumps(fields)))
+            connection.execute("DELETE FROM messages WHERE chat_key = ?", (chat_key,))
+            connection.executemany("INSERT INTO messages (chat_key, seq, message) VALUES (?, ?, ?)", messages)
+
+        self._write(import_chat)
+        return chat
+
+    @staticmethod
+    def _ensure_chat(connection, chat_key):
+        connection.execute("INSERT OR IGNORE INTO chats (chat_key, fields) VALUES (?, ?)", (chat_key, json.dumps({"summary": ""})))
+
+    def append_message(self, chat_key, message):
+        def append(connection):
+            self._ensure_chat(connection, chat_key)
+            connection.execute(
+                "INSERT INTO messages (chat_key, seq, message) "
+                "VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM messages WHERE chat_key = ?), ?)",
+                (chat_key, chat_key, json.dumps(message)))
+
+        with self._lock:
+            self._write(append)
+
+    def truncate_messages(self, chat_key, keep):
+        def truncate(connection):
+            connection.execute(
+                "DELETE FROM messages WHERE chat_key = ? AND seq NOT IN "
+                "(SELECT seq FROM messages WHERE chat_key = ? ORDER BY seq DESC LIMIT ?)",
+                (chat_key, chat_key, max(keep, 0)))
+
+        with self._lock:
+            self._write(truncate)
+
+    def update(self, chat_key, **fields):
+        def update_fields(connection):
+            self._ensure_chat(connection, chat_key)
+            row = connection.execute("SELECT fields FROM chats WHERE chat_key = ?", (chat_key,)).fetchone()
+            stored_fields = json.loads(row[0])
+            stored_fields.update(fields)
+            connection.execute("UPDATE chats SET fields = ? WHERE chat_key = ?", (json.dumps(stored_fields), chat_key))
+
+        with self._lock:
+            self._write(update_fields)
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self._commit()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing chat histories: {e}")
+
+    def close(self):
+        self._closed.set()
+        self.flush()
+
+
+def create_history_store(backend='journal', directory='chat_histories', flush_interval=1.0):
+    """Create a HistoryStore by name ("json", "journal" or "sqlite")."""
+    if backend == 'json':
+        return JsonFileHistoryStore(directory)
+    if backend == 'journal':
+        return JournalHistoryStore(directory, flush_interval=flush_interval)
+    if backend == 'sqlite':
+        return SQLiteHistoryStore(os.path.join(directory, "chat_histories.sqlite3"), flush_interval=flush_interval,
+                                  legacy_directory=directory)
+    raise ValueError(f"unknown chat history backend '{backend}'")
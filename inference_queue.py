@@ -0,0 +1,266 @@
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+import weakref
+
+
+class QueueFullError(Exception):
+    """Raised when the inference queue has no room for another request."""
+
+
+class QueueTimeoutError(Exception):
+    """Raised when a request waited longer than its timeout for a free model slot."""
+
+
+class RequestCancelledError(Exception):
+    """Raised when a request was cancelled (see Cancellation) before it got the model."""
+
+
+# seconds between checks of the Cancellation of a waiting request
+CANCEL_POLL_INTERVAL = 0.1
+
+
+class Cancellation:
+    def __init__(self, deadline=None):
+        """
+        Cancellation of a single request, checked while it waits for the model and after every generated token.
+
+        cancel() is called when the client is gone. With deadline (seconds from now), the request
+        is cancelled once that time has passed.
+        """
+        self.deadline = time.monotonic() + deadline if deadline else None
+        self.reason = None
+        self._event = threading.Event()
+
+    def cancel(self, reason="disconnected"):
+        """Cancel the request. The first reason is kept."""
+        if self.reason is None:
+            self.reason = reason
+        self._event.set()
+
+    def is_cancelled(self):
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("deadline")
+        return self._event.is_set()
+
+
+class InferenceTicket:
+    def __init__(self, scheduler, priority=0, timeout=None):
+        """A place in the inference queue. Holds the model slot between wait() and release()."""
+        self.scheduler = scheduler
+        self.priority = priority
+        self.timeout = timeout
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.granted = False
+        self.cancelled = False
+
+    @property
+    def queue_wait(self):
+        """Seconds spent waiting for the model slot."""
+        end = self.started_at if self.started_at is not None else time.monotonic()
+        return end - self.enqueued_at
+
+    @property
+    def generation_time(self):
+        """Seconds the model slot was held."""
+        if self.started_at is None:
+            return 0.0
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    def wait(self, cancellation=None):
+        """
+        Block until the model slot is granted to this ticket.
+
+        Raises RequestCancelledError (and leaves the queue) if cancellation is cancelled first.
+        """
+        self.scheduler._wait(self, cancellation)
+        return self
+
+    def release(self):
+        """Give the model slot back (or leave the queue if it was never granted)."""
+        self.scheduler._release(self)
+
+    def __enter__(self):
+        return self.wait()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class InferenceScheduler:
+    def __init__(self, max_queue_size=16, max_concurrency=1, default_timeout=None):
+        """
+        Bounded priority queue in front of a shared model.
+
+        Higher priority is served first, equal priorities in FIFO order.
+        At most max_concurrency tickets hold the model at the same time.
+        """
+        self.max_queue_size = max_queue_size
+        self.max_concurrency = max_concurrency
+        self.default_timeout = default_timeout
+        self._cond = threading.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._active = 0
+
+    def submit(self, priority=0, timeout=None):
+        """Enqueue a new request. Raises QueueFullError if the queue is saturated."""
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._cond:
+            if len(self._heap) >= self.max_queue_size:
+                raise QueueFullError(f"inference queue is full ({self.max_queue_size} waiting requests)")
+            ticket = InferenceTicket(self, priority=priority, timeout=timeout)
+            heapq.heappush(self._heap, (-priority, next(self._counter), ticket))
+            self._dispatch()
+        return ticket
+
+    def queue_depth(self):
+        """Return the number of requests waiting for the model."""
+        with self._cond:
+            return len(self._heap)
+
+    def active_count(self):
+        """Return the number of requests currently holding the model."""
+        with self._cond:
+            return self._active
+
+    def _dispatch(self):
+        # must be called with self._cond held
+        granted = False
+        while self._active < self.max_concurrency and self._heap:
+            _, _, ticket = heapq.heappop(self._heap)
+            ticket.granted = True
+            ticket.started_at = time.monotonic()
+            self._active += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _remove(self, ticket):
+        # must be called with self._cond held
+        for index, entry in enumerate(self._heap):
+            if entry[2] is ticket:
+                self._heap.pop(index)
+                heapq.heapify(self._heap)
+                break
+        ticket.cancelled = True
+
+    def _wait(self, ticket, cancellation=None):
+        with self._cond:
+            deadline = None
+            if ticket.timeout is not None:
+                deadline = ticket.enqueued_at + ticket.timeout
+            while not ticket.granted:
+                if ticket.cancelled:
+                    raise QueueTimeoutError("request was removed from the inference queue")
+                if cancellation is not None and cancellation.is_cancelled():
+                    self._remove(ticket)
+                    raise RequestCancelledError(f"request was cancelled while waiting for the model ({cancellation.reason})")
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._remove(ticket)
+                        raise QueueTimeoutError(f"request waited more than {ticket.timeout}s for the model")
+                if cancellation is not None:
+                    remaining = min(remaining, CANCEL_POLL_INTERVAL) if remaining is not None else CANCEL_POLL_INTERVAL
+                self._cond.wait(remaining)
+
+    def _release(self, ticket):
+        with self._cond:
+            if ticket.granted:
+                if ticket.finished_at is None:
+                    ticket.finished_at = time.monotonic()
+                    self._active -= 1
+                    self._dispatch()
+            elif not ticket.cancelled:
+                self._remove(ticket)
+
+
+_STREAM_END = object()
+
+
+class ThreadStream:
+    def __init__(self, generator, on_unused=None):
+        """
+        Async iterator over generator that calls on_unused() if it is closed or dropped before the first item
+        was requested (the producer thread only starts on the first iteration, so it can't clean up then).
+        """
+        self._generator = generator
+        self._unused = weakref.finalize(self, on_unused) if on_unused is not None else None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._unused is not None:
+            self._unused.detach()
+            self._unused = None
+        return await self._generator.__anext__()
+
+    async def aclose(self):
+        if self._unused is not None:
+            # runs on_unused() once
+            self._unused()
+            self._unused = None
+        await self._generator.aclose()
+
+
+def stream_from_thread(producer, max_buffer=32, on_stop=None, on_unused=None):
+    """
+    Run producer(emit) on a dedicated thread and return an async iterator over everything it emits (see ThreadStream).
+
+    emit(item) blocks the producer while max_buffer items are waiting (backpressure) and
+    returns False once the consumer stopped listening, so the producer can end early.
+    on_stop() is called when the consumer stops listening before the end (also if the producer is not emitting at that time).
+    on_unused() is called instead if the stream is closed or dropped before it was iterated (the producer never runs then).
+    """
+    return ThreadStream(_stream_from_thread(producer, max_buffer, on_stop), on_unused)
+
+
+async def _stream_from_thread(producer, max_buffer, on_stop):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=max_buffer)
+    stopped = threading.Event()
+
+    def put(item):
+        if stopped.is_set():
+            return False
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=0.1)
+                return True
+            except concurrent.futures.TimeoutError:
+                if stopped.is_set():
+                    future.cancel()
+                    return False
+
+    def run():
+        try:
+            producer(put)
+        except Exception as e:
+            print(e)
+        finally:
+            put(_STREAM_END)
+
+    threading.Thread(target=run, daemon=True).start()
+    finished = False
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                finished = True
+                break
+            yield item
+    finally:
+        stopped.set()
+        if on_stop is not None and not finished:
+            on_stop()
@@ -0,0 +1,84 @@
+import threading
+import time
+
+
+class SubsystemDisabledError(Exception):
+    """Raised when a disabled subsystem is used."""
+
+
+class Subsystem:
+    def __init__(self, name, load, enabled=True, required=True):
+        """
+        A lazily initialized part of the server (like a model).
+
+        load() is called once, on first use (ensure_loaded) or by warmup().
+        Subsystems that are not required don't hold back readiness.
+        """
+        self.name = name
+        self.enabled = enabled
+        self.required = required
+        self._load = load
+        self._lock = threading.Lock()
+        self.state = "not_loaded" if enabled else "disabled"
+        self.load_seconds = None
+        self.error = None
+
+    def is_ready(self):
+        return self.state == "ready"
+
+    def ensure_loaded(self):
+        """Load the subsystem if that didn't happen yet. Blocks while another thread is loading it."""
+        if not self.enabled:
+            raise SubsystemDisabledError(f"{self.name} is disabled")
+        if self.state == "ready":
+            return
+        with self._lock:
+            if self.state == "ready":
+                return
+            self.state = "loading"
+            start_time = time.perf_counter()
+            try:
+                self._load()
+            except Exception as e:
+                self.state = "failed"
+                self.error = str(e)
+                raise
+            self.load_seconds = time.perf_counter() - start_time
+            self.error = None
+            self.state = "ready"
+            print(f"{self.name} loaded in {self.load_seconds:.2f}s")
+
+    def unload(self, unload=None):
+        """Call unload() and mark the subsystem as not loaded, so it is loaded again on next use."""
+        with self._lock:
+            if self.state != "ready":
+                return
+            if unload is not None:
+                unload()
+            self.state = "not_loaded"
+            self.load_seconds = None
+            print(f"{self.name} unloaded")
+
+    def warmup(self, background=True):
+        """Load the subsystem now, optionally on a background thread."""
+        if not self.enabled:
+            return
+
+        def run():
+            try:
+                self.ensure_loaded()
+            except Exception as e:
+                print(f"Error loading {self.name}: {e}")
+
+        if background:
+            threading.Thread(target=run, name=f"warmup-{self.name}", daemon=True).start()
+        else:
+            run()
+
+    def status(self):
+        return {
+            "state": self.state,
+            "required": self.required,
+            "load_seconds": self.load_seconds,
+            "error": self.error,
+        }
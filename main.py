@@ -1,106 +1,662 @@
-import os
-
-from fastapi import FastAPI, Header, HTTPException, Query
-from typing import Optional, Union, Dict, Annotated
-
-from fastapi.responses import Response, StreamingResponse
-import uvicorn
-from fastapi.middleware.cors import CORSMiddleware
-
-import chatbot
-import summary_generator
-
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-
-def validate_auth_token(auth_token: str) -> bool:
-    valid_tokens = os.getenv("AUTH_TOKEN", "").split(",")
-    valid_tokens = [token.strip() for token in valid_tokens]  # Remove leading and trailing spaces
-    return auth_token in valid_tokens
-
-
-@app.post("/chat")
-def chat_message(text_prompt: str,
-                 name: str = 'User',
-                 instruction_name: str = Query("_", description=f"Available instruction configs: {', '.join(chatbot.instructions.keys())}"),
-                 disable_history: bool = Query(False, description="Disable chat history and memory management.\n(Enabling does nothing if instruction config disables history)."),
-                 x_auth_token: Annotated[str | None, Header()] = None
-                 ):
-    """
-    Send a chat message to the chatbot.
-    """
-    if not validate_auth_token(x_auth_token):
-        return HTTPException(status_code=401, detail="Invalid x_auth_token")
-
-    if instruction_name not in chatbot.instructions.keys():
-        return HTTPException(status_code=400, detail="Invalid instruction name. instruction config not found.")
-
-    message = chatbot.message(text_prompt, name=name, instruction=instruction_name, disable_history=disable_history)
-
-    return Response(content=message, media_type="text/plain")
-
-
-@app.post("/chat_stream")
-async def chat_message_stream(text_prompt: str,
-                 name: str = 'User',
-                 instruction_name: str = Query("_", description=f"Available instruction configs: {', '.join(chatbot.instructions.keys())}"),
-                 disable_history: bool = Query(False, description="Disable chat history and memory management.\n(Enabling does nothing if instruction config disables history)."),
-                 x_auth_token: Annotated[str | None, Header()] = None
-                 ):
-    """
-    Send a chat message to the chatbot and stream the response.
-    Because it is streamed, it will not do any answer cleanup.
-    """
-    if not validate_auth_token(x_auth_token):
-        return HTTPException(status_code=401, detail="Invalid x_auth_token")
-
-    if instruction_name not in chatbot.instructions.keys():
-        return HTTPException(status_code=400, detail="Invalid instruction name. instruction config not found.")
-
-    message = chatbot.message_stream(text_prompt, name=name, instruction=instruction_name, disable_history=disable_history)
-
-    return StreamingResponse(message, media_type="text/event-stream")
-
-
-@app.post("/summary")
-def summary(text: str, max_length: int = 142, x_auth_token: Annotated[str | None, Header()] = None):
-    """
-    Generate a summary of the input text.
-    """
-    if not validate_auth_token(x_auth_token):
-        return HTTPException(status_code=401, detail="Invalid x_auth_token")
-
-    text = summary_generator.summarize(text, max_length=max_length)
-
-    return Response(content=text, media_type="text/plain")
-
-
-@app.post("/inject_memory")
-def inject_memory(text: str, user: str = 'AI', instruction_name: str = "_", x_auth_token: Annotated[str | None, Header()] = None):
-    """
-    Inject a memory entry into the instruction config.
-
-    If user == "AI", memory will be saved with bot username from the instructions.
-
-    Returns: "SUCCESS" string if successful.
-    """
-    if not validate_auth_token(x_auth_token):
-        return HTTPException(status_code=401, detail="Invalid x_auth_token")
-
-    message = chatbot.inject_memory(text, name=user, instruction=instruction_name)
-    if message is None:
-        return HTTPException(status_code=400, detail="could not inject memory into instruction set, Most likely the instruction has save_history disabled.")
-
-    return Response(content=message, media_type="text/plain")
-
-
-if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+import os
+import asyncio
+import functools
+import json
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Header, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from typing import Optional, Union, Dict, Annotated
+
+from fastapi.responses import Response, StreamingResponse, JSONResponse
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+import uvicorn
+from fastapi.middleware.cors import CORSMiddleware
+
+import_start_time = time.perf_counter()
+import chatbot
+import inference_queue
+import metrics
+import sentence_stream
+import summary_generator
+import_seconds = time.perf_counter() - import_start_time
+print(f"application modules imported in {import_seconds:.2f}s")
+
+# WARMUP selects when the models are loaded:
+# "background" (default): at startup on a background thread, the server accepts requests right away (see /ready).
+# "startup": at startup, the server only accepts requests once loading is done.
+# "lazy": on first use.
+WARMUP = os.environ.get('WARMUP', 'background')
+# other models of chatbot.registry are loaded on first use
+warmup_subsystems = [chatbot.model, summary_generator.subsystem]
+subsystems = chatbot.registry.subsystems() + [summary_generator.subsystem]
+if chatbot.long_term_memory is not None:
+    warmup_subsystems.append(chatbot.long_term_memory.subsystem)
+    subsystems.append(chatbot.long_term_memory.subsystem)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if WARMUP in ("background", "startup"):
+        for subsystem in warmup_subsystems:
+            subsystem.warmup(background=WARMUP == "background")
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, app):
+        """
+        Records the status code and the time until the response headers of every HTTP request.
+        (plain ASGI middleware, @app.middleware("http") would hide client disconnects from the endpoints)
+        """
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        recorded = False
+
+        def record(status):
+            nonlocal recorded
+            recorded = True
+            route = scope.get("route")
+            endpoint = route.path if route is not None else "unmatched"
+            metrics.http_requests.inc(endpoint=endpoint, status=status)
+            metrics.http_request_seconds.observe(time.perf_counter() - start_time, endpoint=endpoint)
+
+        async def send_and_record(message):
+            if message["type"] == "http.response.start":
+                record(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            if not recorded:
+                record(500)
+
+
+app.add_middleware(RequestMetricsMiddleware)
+
+
+def _model_gauge(function):
+    return lambda: {(name,): function(model) for name, model in chatbot.registry.models.items()}
+
+
+def _replica_gauge(function):
+    return lambda: {(name, str(replica.index)): function(replica)
+                    for name, model in chatbot.registry.models.items() for replica in model.replicas}
+
+
+def _response_cache_gauge(field):
+    return lambda: chatbot.answer_cache.stats()[field] if chatbot.answer_cache is not None else 0
+
+
+metrics.register(metrics.Gauge("llm_queue_depth", "Requests waiting for a model.", ("model",),
+                               function=_model_gauge(lambda model: model.scheduler.queue_depth())))
+metrics.register(metrics.Gauge("llm_active_requests", "Requests holding a model.", ("model",),
+                               function=_model_gauge(lambda model: model.scheduler.active_count())))
+metrics.register(metrics.Gauge("llm_model_loaded", "1 if the model is loaded.", ("model",),
+                               function=_model_gauge(lambda model: int(model.subsystem.is_ready()))))
+metrics.register(metrics.Gauge("prompt_cache_hits", "Prompt state cache hits.", ("model", "replica"),
+                               function=_replica_gauge(lambda replica: replica.prompt_cache.hits)))
+metrics.register(metrics.Gauge("prompt_cache_misses", "Prompt state cache misses.", ("model", "replica"),
+                               function=_replica_gauge(lambda replica: replica.prompt_cache.misses)))
+metrics.register(metrics.Gauge("prompt_cache_bytes", "Bytes held by the prompt state cache.", ("model", "replica"),
+                               function=_replica_gauge(lambda replica: replica.prompt_cache.size())))
+for field in ("hits", "disk_hits", "coalesced", "misses", "bytes", "hit_rate"):
+    metrics.register(metrics.Gauge(f"response_cache_{field}", f"Response cache {field.replace('_', ' ')}.",
+                                   function=_response_cache_gauge(field)))
+metrics.register(metrics.Gauge("summary_pending_chats", "Chats waiting for or running a summary.",
+                               function=chatbot.summary_scheduler.pending_count))
+
+
+# seconds between checks if the client of a running /chat request is still connected
+DISCONNECT_POLL_INTERVAL = 0.1
+# max. items of a /chat_batch or /summary_batch request
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 1000))
+
+
+async def run_until_disconnect(request: Request, cancellation, function, *args, **kwargs):
+    """Run function(*args, cancellation=cancellation, **kwargs) on the thread pool and cancel it if the client disconnects before it returns."""
+    task = asyncio.ensure_future(run_in_threadpool(function, *args, cancellation=cancellation, **kwargs))
+    while not task.done():
+        await asyncio.wait([task], timeout=DISCONNECT_POLL_INTERVAL)
+        if not task.done() and not cancellation.is_cancelled() and await request.is_disconnected():
+            cancellation.cancel("disconnected")
+    return task.result()
+
+
+@functools.lru_cache(maxsize=1)
+def parse_auth_tokens(auth_tokens: str) -> frozenset:
+    # Remove leading and trailing spaces
+    return frozenset(token.strip() for token in auth_tokens.split(","))
+
+
+def validate_auth_token(auth_token: str) -> bool:
+    # the parsed tokens are cached as long as AUTH_TOKEN doesn't change
+    return auth_token in parse_auth_tokens(os.getenv("AUTH_TOKEN", ""))
+
+
+@app.post("/chat")
+async def chat_message(request: Request,
+                 text_prompt: str,
+                 name: str = 'User',
+                 instruction_name: str = Query("_", description=f"Available instruction configs: {', '.join(chatbot.instructions.keys())}"),
+                 disable_history: bool = Query(False, description="Disable chat history and memory management.\n(Enabling does nothing if instruction config disables history)."),
+                 priority: int = Query(0, description="Scheduling priority. Requests with higher priority are served first."),
+                 timeout: Optional[float] = Query(None, description="Max. seconds to wait for the model before giving up. (Defaults to the server setting)"),
+                 deadline: Optional[float] = Query(None, description="Max. seconds for the whole request. Generation stops at the deadline and the answer so far is returned. (Defaults to the server setting)"),
+                 session_id: str = Query("", description="Keeps a separate chat history per session. (Empty shares the history of the instruction config)"),
+                 x_auth_token: Annotated[str | None, Header()] = None
+                 ):
+    """
+    Send a chat message to the chatbot.
+
+    The response headers X-Queue-Wait and X-Generation-Time contain the seconds spent waiting for the model and generating.
+    With the response cache enabled, X-Response-Cache tells if the answer was cached ("hit"), shared with an identical
+    request ("coalesced") or generated ("miss").
+    If the deadline was reached during generation, the answer is cut off and X-Cancelled is "deadline".
+    Generation also stops when the client disconnects.
+    """
+    if not validate_auth_token(x_auth_token):
+        raise HTTPException(status_code=401, detail="Invalid x_auth_token")
+
+    if instruction_name not in chatbot.instructions.keys():
+        raise HTTPException(status_code=400, detail="Invalid instruction name. instruction config not found.")
+
+    if not chatbot.is_valid_session_id(session_id):
+        raise HTTPException(status_code=400, detail="Invalid session_id. Only letters, digits, '_' and '-' are allowed (max. 64 characters).")
+
+    stats = {}
+    cancellation = inference_queue.Cancellation(deadline or chatbot.REQUEST_DEADLINE or None)
+    try:
+        message = await run_until_disconnect(request, cancellation, chatbot.message,
+                                             text_prompt, name=name, instruction=instruction_name, disable_history=disable_history,
+                                             priority=priority, timeout=timeout, stats=stats, session_id=session_id)
+    except inference_queue.QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except inference_queue.QueueTimeoutError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except inference_queue.RequestCancelledError as e:
+        # 499: the client closed the request (nobody reads this response)
+        raise HTTPException(status_code=504 if cancellation.reason == "deadline" else 499, detail=str(e))
+
+    headers = {
+        "X-Queue-Wait": f"{stats.get('queue_wait', 0.0):.3f}",
+        "X-Generation-Time": f"{stats.get('generation_time', 0.0):.3f}",
+    }
+    if 'response_cache' in stats:
+        headers["X-Response-Cache"] = stats['response_cache']
+    if 'cancelled' in stats:
+        headers["X-Cancelled"] = stats['cancelled']
+    return Response(content=message, media_type="text/plain", headers=headers)
+
+
+@app.post("/chat_stream")
+async def chat_message_stream(text_prompt: str,
+                 name: str = 'User',
+                 instruction_name: str = Query("_", description=f"Available instruction configs: {', '.join(chatbot.instructions.keys())}"),
+                 disable_history: bool = Query(False, description="Disable chat history and memory management.\n(Enabling does nothing if instruction config disables history)."),
+                 priority: int = Query(0, description="Scheduling priority. Requests with higher priority are served first."),
+                 timeout: Optional[float] = Query(None, description="Max. seconds to wait for the model before giving up. (Defaults to the server setting)"),
+                 deadline: Optional[float] = Query(None, description="Max. seconds for the whole request. Generation stops at the deadline and the answer so far is returned. (Defaults to the server setting)"),
+                 session_id: str = Query("", description="Keeps a separate chat history per session. (Empty shares the history of the instruction config)"),
+                 chunking: str = Query("token", description="\"token\": stream the answer text as it is generated.\n\"sentence\" or \"clause\": server-sent events with complete sentences (or clauses) for text to speech."),
+                 x_auth_token: Annotated[str | None, Header()] = None
+                 ):
+    """
+    Send a chat message to the chatbot and stream the response.
+    The answer is cleaned up like the /chat answer while it is streamed.
+    Generation stops when the client disconnects or the deadline is reached (the stream ends there).
+
+    With chunking "sentence" or "clause", the response is a stream of server-sent events:
+    "sentence" events (id and data index are the sequence number, data text the sentence) and a final "done" event
+    (data count, the full answer text and cancelled, the reason if the answer was cut off).
+    """
+    if not validate_auth_token(x_auth_token):
+        raise HTTPException(status_code=401, detail="Invalid x_auth_token")
+
+    if instruction_name not in chatbot.instructions.keys():
+        raise HTTPException(status_code=400, detail="Invalid instruction name. instruction config not found.")
+
+    if not chatbot.is_valid_session_id(session_id):
+        raise HTTPException(status_code=400, detail="Invalid session_id. Only letters, digits, '_' and '-' are allowed (max. 64 characters).")
+
+    if chunking not in ("token", "sentence", "clause"):
+        raise HTTPException(status_code=400, detail="Invalid chunking. Use token, sentence or clause.")
+
+    cancellation = inference_queue.Cancellation(deadline or chatbot.REQUEST_DEADLINE or None)
+    try:
+        message = chatbot.message_stream(text_prompt, name=name, instruction=instruction_name, disable_history=disable_history,
+                                         priority=priority, timeout=timeout, session_id=session_id, cancellation=cancellation)
+    except inference_queue.QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+    if chunking != "token":
+        return StreamingResponse(sentence_stream.sentence_events(message, chunking, cancellation), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    return StreamingResponse(message, media_type="text/event-stream")
+
+
+class ChatBatchItem(BaseModel):
+    text_prompt: str
+    id: Optional[Union[str, int]] = None
+    name: str = 'User'
+    # default: the instruction_name, session_id and disable_history of the request
+    instruction_name: Optional[str] = None
+    session_id: Optional[str] = None
+    disable_history: Optional[bool] = None
+
+
+class ChatBatch(BaseModel):
+    items: list[ChatBatchItem]
+
+
+class SummaryBatchItem(BaseModel):
+    text: str
+    id: Optional[Union[str, int]] = None
+
+
+class SummaryBatch(BaseModel):
+    items: list[SummaryBatchItem]
+
+
+async def ndjson_events(events, started):
+    """Newline delimited JSON of the events of a batch, followed by {"type": "done", "count", "errors", "seconds"}."""
+    count = errors = 0
+    try:
+        async for event in events:
+            count += 1
+            errors += event["type"] == "error"
+            yield json.dumps(event) + "\n"
+        yield json.dumps({"type": "done", "count": count, "errors": errors, "seconds": round(time.perf_counter() - started, 3)}) + "\n"
+    finally:
+        # stop the batch if the client disconnected
+        await events.aclose()
+
+
+@app.post("/chat_batch")
+async def chat_batch(batch: ChatBatch,
+                     instruction_name: str = Query("_", description=f"Available instruction configs: {', '.join(chatbot.instructions.keys())}"),
+                     session_id: str = Query("", description="Chat history of the items that don't set their own."),
+                     disable_history: bool = Query(False, description="Default of the items that don't set their own."),
+                     priority: int = Query(-1, description="Scheduling priority of the items. (Default below interactive requests)"),
+                     x_auth_token: Annotated[str | None, Header()] = None):
+    """
+    Answer many chat messages (JSON body {"items": [{"text_prompt": "...", "id": ...}, ...]}) and stream the answers
+    as newline delimited JSON as they are done, not in the order of the items:
+    {"type": "result", "index": i, "id": ..., "answer": "...", "queue_wait": s, "generation_time": s} or
+    {"type": "error", "index": i, "id": ..., "error": "..."}, and {"type": "done", "count": n, "errors": n, "seconds": s} at the end.
+
+    Items of the same chat history are answered in order, the others in parallel (batched with BATCH_ENGINE_SLOTS > 1).
+    """
+    if not validate_auth_token(x_auth_token):
+        raise HTTPException(status_code=401, detail="Invalid x_auth_token")
+
+    if not batch.items or len(batch.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"A batch needs 1 to {BATCH_MAX_ITEMS} items.")
+
+    items = []
+    for item in batch.items:
+        item_instruction = item.instruction_name or instruction_name
+        item_session_id = item.session_id if item.session_id is not None else session_id
+        item_disable_history = item.disable_history if item.disable_history is not None else disable_history
+        if item_instruction not in chatbot.instructions.keys():
+            raise HTTPException(status_code=400, detail=f"Invalid instruction name '{item_instruction}'. instruction config not found.")
+        if not chatbot.is_valid_session_id(item_session_id):
+            raise HTTPException(status_code=400, detail="Invalid session_id. Only letters, digits, '_' and '-' are allowed (max. 64 characters).")
+        if (chatbot.WORKER_COUNT > 1 and not item_disable_history and chatbot.instructions[item_instruction]['save_history']
+                and (item_instruction, item_session_id) != (instruction_name, session_id)):
+            # the dispatcher sends the batch to the worker of the session of the request
+            raise HTTPException(status_code=400, detail="With several workers, all items with chat history must use the instruction_name and session_id of the request.")
+        items.append({'id': item.id, 'text': item.text_prompt, 'name': item.name, 'instruction': item_instruction,
+                      'session_id': item_session_id, 'disable_history': item_disable_history})
+
+    cancellation = inference_queue.Cancellation()
+    events = inference_queue.stream_from_thread(
+        functools.partial(chatbot.message_batch, items, priority=priority, cancellation=cancellation),
+        max_buffer=len(items),
+        on_stop=functools.partial(cancellation.cancel, "disconnected"))
+    return StreamingResponse(ndjson_events(events, time.perf_counter()), media_type="application/x-ndjson")
+
+
+@app.get("/ready")
+def ready():
+    """
+    Readiness of the server and the load state of its models.
+
+    Returns status code 503 until all required models are loaded.
+    """
+    is_ready = all(subsystem.is_ready() for subsystem in subsystems if subsystem.required)
+    content = {
+        "ready": is_ready,
+        "import_seconds": import_seconds,
+        "subsystems": {subsystem.name: subsystem.status() for subsystem in subsystems},
+    }
+    return JSONResponse(content=content, status_code=200 if is_ready else 503)
+
+
+@app.get("/cache_stats")
+def cache_stats(x_auth_token: Annotated[str | None, Header()] = None):
+    """
+    Hit rates and size of the response cache and the prompt caches of the model replicas.
+    """
+    if not validate_auth_token(x_auth_token):
+        raise HTTPException(status_code=401, detail="Invalid x_auth_token")
+
+    prompt_caches = {}
+    for name, model in chatbot.registry.models.items():
+        for replica in model.replicas:
+            prompt_caches[f"{name}/{replica.index}"] = {
+                "bytes": replica.prompt_cache.size(),
+                "hits": replica.prompt_cache.hits,
+                "misses": replica.prompt_cache.misses,
+            }
+    return {
+        "response_cache": chatbot.answer_cache.stats() if chatbot.answer_cache is not None else None,
+        "prompt_caches": prompt_caches,
+    }
+
+
+@app.get("/metrics")
+def get_metrics():
+    """
+    Metrics in the Prometheus text format.
+    """
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/summary")
+def summary(text: str, max_length: int = 142,
+            mode: str = Query("concat", description="concat: summarize every chunk of the text and join the summaries.\n"
+                                                    "map_reduce: summarize chunks in parallel, then summarize the summaries until a single summary is left."),
+            x_auth_token: Annotated[str | None, Header()] = None):
+    """
+    Generate a summary of the input text.
+    """
+    if not validate_auth_token(x_auth_token):
+        raise HTTPException(status_code=401, detail="Invalid x_auth_token")
+
+    if not summary_generator.subsystem.enabled:
+        raise HTTPException(status_code=503, detail="Summarization is disabled on this server.")
+
+    start_time = time.perf_counter()
+    if mode == "map_reduce":
+        text = summary_generator.summarize_map_reduce(text, max_length=max_length)
+    elif mode == "concat":
+        text = summary_generator.summarize(text, max_length=max_length)
+    else:
+        raise HTTPException(status_code=400, detail="Invalid mode. Use 'concat' or 'map_reduce'.")
+    metrics.summary_seconds.observe(time.perf_counter() - start_time, kind=mode)
+
+    return Response(content=text, media_type="text/plain")
+
+
+@app.post("/summary_stream")
+def summary_stream(text: str, max_length: int = 142, x_auth_token: Annotated[str | None, Header()] = None):
+    """
+    Generate a map-reduce summary of the input text and stream the progress as newline delimited JSON.
+
+    Emits {"type": "partial", "index": i, "summary": "..."} whenever a chunk of the text is summarized
+    and {"type": "final", "summary": "..."} at the end.
+    """
+    if not validate_auth_token(x_auth_token):
+        raise HTTPException(status_code=401, detail="Invalid x_auth_token")
+
+    if not summary_generator.subsystem.enabled:
+        raise HTTPException(status_code=503, detail="Summarization is disabled on this server.")
+
+    events = (json.dumps(event) + "\n" for event in summary_generator.summarize_map_reduce_stream(text, max_length=max_length))
+
+    return StreamingResponse(events, media_type="application/x-ndjson")
+
+
+@app.post("/summary_batch")
+async def summary_batch(batch: SummaryBatch, max_length: int = 142,
+                        mode: str = Query("concat", description="concat: join the summaries of the chunks of a text.\n"
+                                                                "map_reduce: summarize them again until a single summary is left."),
+                        x_auth_token: Annotated[str | None, Header()] = None):
+    """
+    Summarize many texts (JSON body {"items": [{"text": "...", "id": ...}, ...]}) and stream the summaries
+    as newline delimited JSON as they are done: {"type": "result", "index": i, "id": ..., "summary": "..."}
+    ({"type": "error", "error": "..."} if summarizing failed) and {"type": "done", "count": n, "errors": n, "seconds": s} at the end.
+
+    The chunks of all texts are summarized in batches of similar length (see SUMMARY_BATCH_TOKENS).
+    """
+    if not validate_auth_token(x_auth_token):
+        raise HTTPException(status_code=401, detail="Invalid x_auth_token")
+
+    if not summary_generator.subsystem.enabled:
+        raise HTTPException(status_code=503, detail="Summarization is disabled on this server.")
+
+    if not batch.items or len(batch.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"A batch needs 1 to {BATCH_MAX_ITEMS} items.")
+
+    if mode not in ("concat", "map_reduce"):
+        raise HTTPException(status_code=400, detail="Invalid mode. Use 'concat' or 'map_reduce'.")
+
+    started = time.perf_counter()
+
+    def summarize(emit):
+        summaries = summary_generator.summarize_batch_stream([item.text for item in batch.items], max_length=max_length, mode=mode)
+        try:
+            for index, summary in summaries:
+                if not emit({"type": "result", "index": index, "id": batch.items[index].id, "summary": summary}):
+                    break
+        except Exception as e:
+            emit({"type": "error", "error": str(e)})
+        finally:
+            summaries.close()
+        metrics.summary_seconds.observe(time.perf_counter() - started, kind="batch")
+
+    events = inference_queue.stream_from_thread(summarize, max_buffer=len(batch.items))
+    return StreamingResponse(ndjson_events(events, started), media_type="application/x-ndjson")
+
+
+@app.post("/inject_memory")
+def inject_memory(text: str, user: str = 'AI', instruction_name: str = "_",
+                  session_id: str = Query("", description="Session to inject the memory into. (Empty uses the shared history of the instruction config)"),
+                  x_auth_token: Annotated[str | None, Header()] = None):
+    """
+    Inject a memory entry into the instruction config.
+
+    If user == "AI", memory will be saved with bot username from the instructions.
+
+    Returns: "SUCCESS" string if successful.
+    """
+    if not validate_auth_token(x_auth_token):
+        raise HTTPException(status_code=401, detail="Invalid x_auth_token")
+
+    if not chatbot.is_valid_session_id(session_id):
+        raise HTTPException(status_code=400, detail="Invalid session_id. Only letters, digits, '_' and '-' are allowed (max. 64 characters).")
+
+    message = chatbot.inject_memory(text, name=user, instruction=instruction_name, session_id=session_id)
+    if message is None:
+        raise HTTPException(status_code=400, detail="could not inject memory into instruction set, Most likely the instruction has save_history disabled.")
+
+    return Response(content=message, media_type="text/plain")
+
+
+# open /ws connections
+websocket_connections = set()
+metrics.register(metrics.Gauge("websocket_connections", "Open WebSocket connections.", function=lambda: len(websocket_connections)))
+
+
+class ChatConnection:
+    def __init__(self, websocket: WebSocket, instruction_name: str, session_id: str):
+        """A /ws connection, bound to an instruction config and a session. Runs one answer at a time."""
+        self.websocket = websocket
+        self.instruction_name = instruction_name
+        self.session_id = session_id
+        self.answer_task = None
+        self.cancellation = None
+        self._send_lock = asyncio.Lock()
+        self._prompt_count = 0
+
+    async def send(self, message):
+        async with self._send_lock:
+            await self.websocket.send_json(message)
+
+    def cancel_answer(self, reason="cancelled"):
+        if self.cancellation is not None:
+            self.cancellation.cancel(reason)
+
+    @staticmethod
+    def prompt_options(message):
+        """Return the validated options of a prompt message, raises ValueError with the reason if one is invalid."""
+        def number(name):
+            value = message.get(name)
+            if value is None:
+                return None
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f"Invalid {name}. Use a number of seconds.")
+            return value
+
+        chunking = message.get("chunking", "token")
+        if chunking not in ("token", "sentence", "clause"):
+            raise ValueError("Invalid chunking. Use token, sentence or clause.")
+        priority = message.get("priority", 0)
+        if isinstance(priority, bool) or not isinstance(priority, int):
+            raise ValueError("Invalid priority. Use an integer.")
+        name = message.get("name", "User")
+        if not isinstance(name, str):
+            raise ValueError("Invalid name. Use a string.")
+        return {"text": str(message.get("text", "")), "name": name, "chunking": chunking, "priority": priority,
+                "timeout": number("timeout"), "deadline": number("deadline"),
+                "disable_history": bool(message.get("disable_history", False))}
+
+    async def start_answer(self, message):
+        """Start answering a prompt message, an answer that is still running is cancelled first (barge-in)."""
+        self._prompt_count += 1
+        prompt_id = message.get("id", self._prompt_count)
+        try:
+            options = self.prompt_options(message)
+        except ValueError as e:
+            await self.send({"type": "error", "id": prompt_id, "status": 400, "detail": str(e)})
+            return
+        self.cancel_answer()
+        self.cancellation = inference_queue.Cancellation(options["deadline"] or chatbot.REQUEST_DEADLINE or None)
+        self.answer_task = asyncio.ensure_future(self._answer(prompt_id, options, self.cancellation, self.answer_task))
+
+    async def _answer(self, prompt_id, options, cancellation, previous_task):
+        if previous_task is not None:
+            # the previous answer ends within one token, it is written to the history before the next prompt is built
+            await asyncio.wait([previous_task])
+
+        chunking = options["chunking"]
+        try:
+            stream = chatbot.message_stream(options["text"], name=options["name"],
+                                            instruction=self.instruction_name, disable_history=options["disable_history"],
+                                            priority=options["priority"], timeout=options["timeout"],
+                                            session_id=self.session_id, cancellation=cancellation)
+        except inference_queue.QueueFullError as e:
+            await self.send({"type": "error", "id": prompt_id, "status": 429, "detail": str(e)})
+            return
+
+        chunker = sentence_stream.SentenceChunker(chunking) if chunking != "token" else None
+        index = 0
+        answer = ""
+        async for piece in stream:
+            answer += piece
+            if chunker is None:
+                await self.send({"type": "token", "id": prompt_id, "text": piece})
+                continue
+            for sentence in chunker.feed(piece):
+                await self.send({"type": "sentence", "id": prompt_id, "index": index, "text": sentence})
+                index += 1
+        if chunker is not None:
+            for sentence in chunker.finish():
+                await self.send({"type": "sentence", "id": prompt_id, "index": index, "text": sentence})
+                index += 1
+        await self.send({"type": "done", "id": prompt_id, "text": answer, "cancelled": cancellation.reason})
+
+    async def inject_memory(self, message):
+        result = await run_in_threadpool(chatbot.inject_memory, str(message.get("text", "")), name=message.get("user", "AI"),
+                                         instruction=self.instruction_name, session_id=self.session_id)
+        if result is None:
+            await self.send({"type": "error", "status": 400, "detail": "could not inject memory, the instruction config has save_history disabled."})
+        else:
+            await self.send({"type": "inject_memory", "result": result})
+
+    def close(self):
+        self.cancel_answer("disconnected")
+        if self.answer_task is not None:
+            self.answer_task.cancel()
+
+
+@app.websocket("/ws")
+async def chat_websocket(websocket: WebSocket,
+                         instruction_name: str = "_",
+                         session_id: str = "",
+                         x_auth_token: Annotated[str | None, Header()] = None):
+    """
+    Conversation over a single WebSocket connection, bound to an instruction config and a session.
+
+    Authenticate with the X-Auth-Token header or with {"type": "auth", "token": "..."} as the first message.
+    Messages (JSON):
+    {"type": "prompt", "text": "...", "id": ..., "name": "User", "chunking": "token" | "sentence" | "clause", "deadline": ..., "priority": ...}
+        is answered with "token" (or "sentence") messages and a final "done" message, all with the id of the prompt.
+        A new prompt cancels the answer that is still running.
+    {"type": "cancel"} stops the running answer. {"type": "inject_memory", "text": "...", "user": "AI"} adds a memory.
+    """
+    await websocket.accept()
+    if not validate_auth_token(x_auth_token):
+        try:
+            message = await websocket.receive_json()
+        except (WebSocketDisconnect, ValueError):
+            return
+        if not isinstance(message, dict) or message.get("type") != "auth" or not validate_auth_token(message.get("token")):
+            await websocket.close(code=1008, reason="Invalid auth token")
+            return
+
+    if instruction_name not in chatbot.instructions.keys():
+        await websocket.close(code=1008, reason="Invalid instruction name. instruction config not found.")
+        return
+    if not chatbot.is_valid_session_id(session_id):
+        await websocket.close(code=1008, reason="Invalid session_id. Only letters, digits, '_' and '-' are allowed (max. 64 characters).")
+        return
+
+    connection = ChatConnection(websocket, instruction_name, session_id)
+    websocket_connections.add(connection)
+    try:
+        await connection.send({"type": "ready", "instruction_name": instruction_name, "session_id": session_id})
+        while True:
+            try:
+                message = await websocket.receive_json()
+            except ValueError:
+                await connection.send({"type": "error", "status": 400, "detail": "Messages must be JSON objects."})
+                continue
+            message_type = message.get("type") if isinstance(message, dict) else None
+            if message_type == "prompt":
+                await connection.start_answer(message)
+            elif message_type == "cancel":
+                connection.cancel_answer()
+            elif message_type == "inject_memory":
+                await connection.inject_memory(message)
+            else:
+                await connection.send({"type": "error", "status": 400, "detail": f"Unknown message type: {message_type}"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        connection.close()
+        websocket_connections.discard(connection)
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=8000)
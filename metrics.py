@@ -0,0 +1,178 @@
+import bisect
+import json
+import threading
+import time
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# tokens per second
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200, 500)
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            lines += self._render_samples()
+        return lines
+
+    def _render_samples(self):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                for key, value in sorted(self._values.items())]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        """function() can return the current value, or a dict of {label values tuple: value}."""
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _render_samples(self):
+        if self.function is not None:
+            try:
+                values = self.function()
+            except Exception as e:
+                print(f"Error collecting metric {self.name}: {e}")
+                return []
+            self._values = values if isinstance(values, dict) else {(): values}
+        return super()._render_samples()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def _render_samples(self):
+        lines = []
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+_metrics = []
+
+
+def register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def merge(expositions, label="worker"):
+    """
+    Merge Prometheus text expositions of several processes ({label value: text}) into one,
+    every sample gets label (like worker="0"), so every process is its own series.
+    """
+    families = {}
+    for label_value, text in expositions.items():
+        family = None
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith("#"):
+                parts = line.split(" ", 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = families.setdefault(parts[2], {"header": [], "samples": []})
+                    if line not in family["header"]:
+                        family["header"].append(line)
+                continue
+            if family is None:
+                family = families.setdefault("", {"header": [], "samples": []})
+            name_end = min(index for index in (line.find("{"), line.find(" "), len(line)) if index >= 0)
+            extra = _format_labels((label,), (label_value,))
+            if line[name_end:name_end + 1] == "{":
+                # add the label in front of the others
+                sample = line[:name_end] + extra[:-1] + "," + line[name_end + 1:]
+                if line[name_end + 1:name_end + 2] == "}":
+                    sample = line[:name_end] + extra + line[name_end + 2:]
+            else:
+                sample = line[:name_end] + extra + line[name_end:]
+            family["samples"].append(sample)
+    lines = []
+    for family in families.values():
+        lines += family["header"] + family["samples"]
+    return "\n".join(lines) + "\n"
+
+
+def log_event(event, **fields):
+    """Print a structured (single line JSON) log entry."""
+    print(json.dumps({"event": event, "time": round(time.time(), 3), **fields}, default=str))
+
+
+http_requests = register(Counter("http_requests_total", "HTTP requests by endpoint and status code.", ("endpoint", "status")))
+http_request_seconds = register(Histogram("http_request_seconds", "Time until the response (headers) of a HTTP request.", ("endpoint",)))
+
+queue_wait_seconds = register(Histogram("llm_queue_wait_seconds", "Time requests waited for a model.", ("model", "instruction")))
+generation_seconds = register(Histogram("llm_generation_seconds", "Time a request held the model (prompt evaluation and generation).", ("model", "instruction")))
+prompt_eval_seconds = register(Histogram("llm_prompt_eval_seconds", "Time spent evaluating prompts.", ("model",)))
+time_to_first_token_seconds = register(Histogram("llm_time_to_first_token_seconds", "Time from getting the model to the first streamed token.", ("model", "instruction")))
+tokens_per_second = register(Histogram("llm_tokens_per_second", "Generated tokens per second of a request.", ("model",), buckets=RATE_BUCKETS))
+prompt_tokens = register(Counter("llm_prompt_tokens_total", "Prompt tokens of all requests.", ("model",)))
+generated_tokens = register(Counter("llm_generated_tokens_total", "Generated tokens of all requests.", ("model",)))
+cancelled_requests = register(Counter("llm_cancelled_requests_total", "Generations that were cut off, by reason (disconnected or deadline).", ("model", "reason")))
+
+summary_seconds = register(Histogram("summary_seconds", "Duration of summaries.", ("kind",)))
+history_persist_seconds = register(Histogram("history_persist_seconds", "Duration of durable chat history writes (one batch).", ("backend",)))
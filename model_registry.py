@@ -0,0 +1,260 @@
+import contextlib
+import os
+import threading
+import time
+
+import autotune
+import batch_engine
+import inference_queue
+import lifecycle
+import prompt_cache
+
+# layers offloaded to the GPU without a gpu_layers setting or autotune profile
+DEFAULT_GPU_LAYERS = 30
+
+
+def _first_set(*values):
+    return next((value for value in values if value is not None), None)
+
+
+def get_profile(model):
+    """
+    Return the autotune profile of model on this host ({} if there is none).
+    With registry.autotune_on_load, the model is tuned first if it has no profile yet.
+    Must be called on the cores of the replica (see ModelReplica.pinned), the profile depends on their number.
+    """
+    profiles = model.registry.profiles
+    if profiles is None:
+        return {}
+    profile = profiles.get(model.path)
+    if profile is None and model.registry.autotune_on_load:
+        print(f"tuning llama.cpp settings of {model.path}, this takes a few minutes ...")
+        profile = autotune.tune(model.path, quick=True)
+        profiles.put(model.path, profile)
+    return profile or {}
+
+
+def load_llama(model, replica):
+    """
+    Default loader: create the llama_cpp.Llama of a replica.
+    Settings of the model that are None are taken from its autotune profile, or the llama.cpp defaults.
+    """
+    from llama_cpp import Llama
+
+    if model.path is None:
+        raise FileNotFoundError(f".gguf file of model '{model.name}' not found in any of the specified directories.")
+
+    profile = get_profile(model)
+    cores = len(replica.cpus) or None
+    n_threads = _first_set(model.threads, profile.get('threads'), cores)
+    n_threads_batch = _first_set(model.threads_batch, profile.get('threads_batch'), n_threads)
+    if cores:
+        # a profile tuned on more cores than the replica has
+        n_threads = min(n_threads, cores)
+        n_threads_batch = min(n_threads_batch, cores)
+    n_batch = _first_set(model.batch_size, profile.get('batch_size'), autotune.DEFAULT_BATCH_SIZE)
+    n_gpu_layers = _first_set(model.gpu_layers, profile.get('gpu_layers'), DEFAULT_GPU_LAYERS)
+    print(f"loading {model.path} (replica {replica.index}) ... using {n_threads} threads ({n_threads_batch} for prompts), "
+          f"batch size {n_batch}, {n_gpu_layers} GPU layers{' (autotuned)' if profile else ''}.")
+    # weights are memory mapped, so replicas of a model share them in the page cache
+    return Llama(model_path=model.path, n_gpu_layers=n_gpu_layers, n_threads=n_threads, n_threads_batch=n_threads_batch,
+                 n_batch=n_batch, n_ctx=model.context_length * max(1, model.batch_slots), use_mmap=True)
+
+
+def split_cpus(count):
+    """Split the cores this process may use into count sets (empty sets if affinity is not supported)."""
+    if count <= 1 or not hasattr(os, "sched_getaffinity"):
+        return [[] for _ in range(count)]
+    cpus = sorted(os.sched_getaffinity(0))
+    size = max(1, len(cpus) // count)
+    return [cpus[index * size:(index + 1) * size] or cpus for index in range(count)]
+
+
+class ModelReplica:
+    def __init__(self, model, index, cpus, prompt_cache_bytes=0):
+        """A loaded instance of a model with its own prompt cache (and batch engine)."""
+        self.model = model
+        self.index = index
+        self.cpus = cpus
+        self.llm = None
+        self.engine = None
+        self.prompt_cache = prompt_cache.PromptStateCache(capacity_bytes=prompt_cache_bytes)
+        self.state_size = 0
+        self.in_use = 0
+
+    @contextlib.contextmanager
+    def pinned(self):
+        """Run the calling thread (and the threads llama.cpp starts from it) on the cores of this replica."""
+        if not self.cpus or not hasattr(os, "sched_setaffinity"):
+            yield
+            return
+        previous_cpus = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, self.cpus)
+        try:
+            yield
+        finally:
+            os.sched_setaffinity(0, previous_cpus)
+
+    def reset_timings(self):
+        """Reset the llama.cpp performance counters (see prompt_eval_seconds)."""
+        try:
+            import llama_cpp
+            llama_cpp.llama_reset_timings(self.llm.ctx)
+        except Exception:
+            pass
+
+    def prompt_eval_seconds(self):
+        """Return the prompt evaluation time since the last reset_timings() (None if unavailable)."""
+        try:
+            import llama_cpp
+            return llama_cpp.llama_get_timings(self.llm.ctx).t_p_eval_ms / 1000
+        except Exception:
+            return None
+
+    def load(self, loader):
+        with self.pinned():
+            self.llm = loader(self.model, self)
+        try:
+            import llama_cpp
+            self.state_size = llama_cpp.llama_get_state_size(self.llm.ctx)
+        except Exception:
+            self.state_size = 0
+        if self.model.batch_slots > 1:
+            self.engine = batch_engine.BatchEngine(self.llm, n_slots=self.model.batch_slots, cpus=self.cpus)
+
+    def unload(self):
+        if self.engine is not None:
+            self.engine.close()
+        self.engine = None
+        self.llm = None
+        self.state_size = 0
+        self.prompt_cache.clear()
+
+
+class Model:
+    def __init__(self, registry, name, path, context_length=3072, threads=None, threads_batch=None, batch_size=None,
+                 gpu_layers=None, replicas=1, batch_slots=1, max_queue_size=16, queue_timeout=None, prompt_cache_bytes=0,
+                 required=False):
+        """
+        A model of the registry, served by one or more replicas.
+        threads (decode), threads_batch (prompt evaluation), batch_size and gpu_layers of None come from the autotune profile.
+
+        Requests for the model wait in its own scheduler, so models don't queue behind each other.
+        The scheduler grants as many requests at once as the replicas (and their batch slots) can run.
+        """
+        self.registry = registry
+        self.name = name
+        self.path = path
+        self.context_length = context_length
+        self.threads = threads
+        self.threads_batch = threads_batch
+        self.batch_size = batch_size
+        self.gpu_layers = gpu_layers
+        self.batch_slots = batch_slots
+        self.replicas = [ModelReplica(self, index, cpus, prompt_cache_bytes)
+                         for index, cpus in enumerate(split_cpus(replicas))]
+        self.scheduler = inference_queue.InferenceScheduler(max_queue_size=max_queue_size,
+                                                            max_concurrency=len(self.replicas) * max(1, batch_slots),
+                                                            default_timeout=queue_timeout)
+        self.subsystem = lifecycle.Subsystem(f"llm:{name}", self._load, required=required)
+        self.last_used = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        self.registry._make_room(self)
+        try:
+            for replica in self.replicas:
+                replica.load(self.registry.loader)
+        except Exception:
+            self.unload()
+            raise
+
+    def unload(self):
+        for replica in self.replicas:
+            replica.unload()
+
+    def is_idle(self):
+        return self.scheduler.active_count() == 0 and self.scheduler.queue_depth() == 0
+
+    def memory_bytes(self):
+        """Estimated memory of the loaded model (the weights once, the replicas share them, and the context state of every replica)."""
+        if self.path is None or not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) + sum(replica.state_size for replica in self.replicas)
+
+    def tokenize(self, text, add_bos=True):
+        self.subsystem.ensure_loaded()
+        return self.replicas[0].llm.tokenize(text.encode("utf-8"), add_bos=add_bos)
+
+    @contextlib.contextmanager
+    def use(self):
+        """
+        Load the model if needed and yield its least busy replica.
+        Must be called while holding a ticket of the model scheduler.
+        """
+        self.subsystem.ensure_loaded()
+        with self._lock:
+            replica = min(self.replicas, key=lambda r: r.in_use)
+            replica.in_use += 1
+            self.last_used = time.monotonic()
+        try:
+            yield replica
+        finally:
+            with self._lock:
+                replica.in_use -= 1
+
+
+class ModelRegistry:
+    def __init__(self, memory_budget_bytes=0, loader=load_llama, profiles=None, autotune_on_load=False):
+        """
+        Models by name, loaded on first use.
+
+        With a memory_budget_bytes (0 = unlimited), the least recently used idle models are unloaded
+        before a model is loaded that would exceed it.
+        loader(model, replica) creates the Llama of a replica. (benchmarks replace it with a stub)
+        profiles is the autotune.ProfileStore of tuned settings (None = not used),
+        with autotune_on_load models without a profile are tuned when they are loaded.
+        """
+        self.memory_budget_bytes = memory_budget_bytes
+        self.loader = loader
+        self.profiles = profiles
+        self.autotune_on_load = autotune_on_load
+        self.models = {}
+        self._aliases = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, path, **settings):
+        """Add a model. (see Model for the settings)"""
+        self.models[name] = Model(self, name, path, **settings)
+        return self.models[name]
+
+    def alias(self, name, target):
+        """Serve requests for model name with the model target."""
+        self._aliases[name] = target
+
+    def get(self, name):
+        return self.models[self._aliases.get(name, name)]
+
+    def subsystems(self):
+        return [model.subsystem for model in self.models.values()]
+
+    def loaded_bytes(self):
+        return sum(model.memory_bytes() for model in self.models.values() if model.subsystem.is_ready())
+
+    def _make_room(self, model):
+        """Unload least recently used idle models until model fits into the memory budget."""
+        if self.memory_budget_bytes <= 0:
+            return
+        with self._lock:
+            needed = model.memory_bytes()
+            candidates = sorted((other for other in self.models.values() if other is not model and other.subsystem.is_ready()),
+                                key=lambda other: other.last_used)
+            for other in candidates:
+                if self.loaded_bytes() + needed <= self.memory_budget_bytes:
+                    break
+                if not other.is_idle():
+                    continue
+                print(f"unloading model '{other.name}' to stay within the memory budget")
+                other.subsystem.unload(other.unload)
+            if self.loaded_bytes() + needed > self.memory_budget_bytes:
+                print(f"loading model '{model.name}' exceeds the memory budget ({self.memory_budget_bytes} bytes)")
@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+
+def longest_token_prefix(a, b):
+    """Return the number of leading tokens a and b have in common."""
+    longest = 0
+    for _a, _b in zip(a, b):
+        if _a != _b:
+            break
+        longest += 1
+    return longest
+
+
+class PromptStateCache:
+    def __init__(self, capacity_bytes=1 << 30):
+        """
+        LRU cache of llama.cpp model states (KV cache + evaluated tokens).
+
+        Entries are keyed by an arbitrary key (instruction name, conversation, ...),
+        so unrelated prompts can't evict each other's prefix on the single model context.
+        The summed state size never exceeds capacity_bytes.
+        """
+        self.capacity_bytes = capacity_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def size(self):
+        """Return the number of bytes held by cached states."""
+        return self._size
+
+    def _get(self, key):
+        with self._lock:
+            state = self._entries.get(key)
+            if state is not None:
+                self._entries.move_to_end(key)
+            return state
+
+    def restore(self, llm, key, prompt_tokens):
+        """
+        Load the state cached under key into llm if it shares a longer prefix with prompt_tokens
+        than what llm has currently evaluated. Returns the number of tokens that don't need evaluation.
+        """
+        current_prefix = longest_token_prefix(llm.input_ids[:llm.n_tokens].tolist(), prompt_tokens)
+        state = self._get(key)
+        if state is None:
+            self.misses += 1
+            return current_prefix
+
+        cached_prefix = longest_token_prefix(state.input_ids.tolist(), prompt_tokens)
+        if cached_prefix <= current_prefix:
+            self.hits += 1
+            return current_prefix
+
+        llm.load_state(state)
+        self.hits += 1
+        return cached_prefix
+
+    def store(self, llm, key):
+        """Save the current state of llm under key, evicting least recently used states if needed."""
+        if self.capacity_bytes <= 0:
+            return
+        state = llm.save_state()
+        state_size = state.llama_state_size
+        if state_size > self.capacity_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key).llama_state_size
+            self._entries[key] = state
+            self._size += state_size
+            while self._size > self.capacity_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.llama_state_size
+
+    def remove(self, key):
+        """Drop the state cached under key."""
+        with self._lock:
+            state = self._entries.pop(key, None)
+            if state is not None:
+                self._size -= state.llama_state_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import inference_queue
+
+
+def make_key(*parts):
+    """Return a cache key (sha256 hex digest) of JSON serializable parts."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# errors of compute() that concern the request that called it, not the identical requests waiting for it
+LEADER_ERRORS = (inference_queue.RequestCancelledError, inference_queue.QueueTimeoutError, inference_queue.QueueFullError)
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    def __init__(self, ttl=300, capacity_bytes=16 << 20, directory=None):
+        """
+        Cache of generated answers with a time to live, in memory (LRU, at most capacity_bytes)
+        and optionally on disk (one JSON file per entry in directory).
+
+        Identical requests that arrive while the answer is generated wait for that generation
+        instead of starting their own.
+        """
+        self.ttl = ttl
+        self.capacity_bytes = capacity_bytes
+        self.directory = directory
+        self._entries = OrderedDict()  # key -> (expires at, value)
+        self._size = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _entry_size(key, value):
+        return len(key) + len(value.encode("utf-8"))
+
+    def size(self):
+        """Return the number of bytes held in memory."""
+        return self._size
+
+    def _disk_filename(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _get_from_disk(self, key):
+        filename = self._disk_filename(key)
+        try:
+            with open(filename, 'r') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if entry['expires'] < time.time():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return None
+        return entry['value']
+
+    def _put_on_disk(self, key, value):
+        filename = self._disk_filename(key)
+        tmp_filename = filename + ".tmp"
+        try:
+            with open(tmp_filename, 'w') as file:
+                json.dump({'expires': time.time() + self.ttl, 'value': value}, file)
+            os.replace(tmp_filename, filename)
+        except OSError as e:
+            print(f"Error writing response cache entry: {e}")
+
+    def _get_from_memory(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self._size -= self._entry_size(key, value)
+
+    def _put_in_memory(self, key, value):
+        entry_size = self._entry_size(key, value)
+        if entry_size > self.capacity_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._size += entry_size
+        while self._size > self.capacity_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def get(self, key):
+        """Return the cached value of key or None."""
+        with self._lock:
+            value = self._get_from_memory(key)
+        if value is None and self.directory:
+            value = self._get_from_disk(key)
+            if value is not None:
+                with self._lock:
+                    self._put_in_memory(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._put_in_memory(key, value)
+        if self.directory:
+            self._put_on_disk(key, value)
+
+    def get_or_compute(self, key, compute, cancellation=None):
+        """
+        Return (value, source) of key. source is "hit", "coalesced" (waited for an identical request) or "miss".
+        On a miss, compute() is called and its result is cached unless it is None.
+        Errors of compute() are raised in the identical requests as well, except errors that only concern the request
+        that computed it (LEADER_ERRORS, like its cancellation), then the next identical request computes the value.
+        Raises inference_queue.RequestCancelledError if cancellation is cancelled while waiting for an identical request.
+        """
+        while True:
+            with self._lock:
+                value = self._get_from_memory(key)
+                if value is not None:
+                    self.hits += 1
+                    return value, "hit"
+                in_flight = self._in_flight.get(key)
+                leader = in_flight is None
+                if leader:
+                    in_flight = self._in_flight[key] = _InFlight()
+            if leader:
+                break
+
+            while not in_flight.done.wait(inference_queue.CANCEL_POLL_INTERVAL):
+                if cancellation is not None and cancellation.is_cancelled():
+                    raise inference_queue.RequestCancelledError(
+                        f"request was cancelled while waiting for an identical request ({cancellation.reason})")
+            if isinstance(in_flight.error, LEADER_ERRORS):
+                # the request this one waited for was cancelled or didn't get the model, try again
+                continue
+            with self._lock:
+                self.coalesced += 1
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.value, "coalesced"
+
+        try:
+            value = self._get_from_disk(key) if self.directory else None
+            if value is not None:
+                with self._lock:
+                    self._put_in_memory(key, value)
+                    self.disk_hits += 1
+                source = "hit"
+            else:
+                with self._lock:
+                    self.misses += 1
+                value = compute()
+                if value is not None:
+                    self.put(key, value)
+                source = "miss"
+            in_flight.value = value
+            return value, source
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.disk_hits + self.coalesced + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "capacity_bytes": self.capacity_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "coalesced": self.coalesced,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits + self.coalesced) / requests if requests else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
@@ -0,0 +1,91 @@
+import json
+import re
+
+# a sentence ends at . ! ? (or …) followed by whitespace, closing quotes and brackets stay with the sentence
+SENTENCE_END = re.compile(r"[.!?…]+[\"')\]]*(?=\s)|\n+")
+# clauses also end at , ; : and dashes followed by whitespace
+CLAUSE_END = re.compile(r"[.!?…,;:]+[\"')\]]*(?=\s)|\s[-–—](?=\s)|\n+")
+# words in front of a '.' that don't end a sentence
+ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "prof", "sr", "jr", "vs", "e.g", "i.e", "approx"}
+
+
+class SentenceChunker:
+    def __init__(self, mode="sentence", min_clause_chars=24):
+        """
+        Split streamed text into complete sentences (mode "sentence") or clauses (mode "clause").
+
+        Clauses are only split off once they have min_clause_chars, so text to speech doesn't get tiny fragments.
+        """
+        if mode not in ("sentence", "clause"):
+            raise ValueError(f"unknown chunking mode: {mode}")
+        self.mode = mode
+        self.min_clause_chars = min_clause_chars
+        self._pattern = SENTENCE_END if mode == "sentence" else CLAUSE_END
+        self._buffer = ""
+
+    def _is_boundary(self, match):
+        end_text = match.group()
+        if end_text.startswith("."):
+            # abbreviations and initials (like "Dr." or "J. R. R.")
+            word = re.search(r"[\w.]*$", self._buffer[:match.start()]).group().lower()
+            if word in ABBREVIATIONS or (len(word) == 1 and word.isalpha()):
+                return False
+        if not re.search(r"[.!?…\n]", end_text):
+            # only a clause separator, split if the clause is long enough
+            return len(self._buffer[:match.end()].strip()) >= self.min_clause_chars
+        return True
+
+    def feed(self, text):
+        """Add streamed text, returns the list of chunks that are complete."""
+        self._buffer += text
+        chunks = []
+        position = 0
+        while True:
+            match = self._pattern.search(self._buffer, position)
+            # the end of a chunk is certain once the whitespace after it was generated
+            if match is None or match.end() >= len(self._buffer):
+                break
+            position = match.end()
+            if self._is_boundary(match):
+                chunk = self._buffer[:position].strip()
+                self._buffer = self._buffer[position:]
+                position = 0
+                if chunk:
+                    chunks.append(chunk)
+        return chunks
+
+    def finish(self):
+        """Return the rest of the text as the last chunks."""
+        rest, self._buffer = self._buffer.strip(), ""
+        return [rest] if rest else []
+
+
+def format_event(event, data, event_id=None):
+    """Return a server-sent event with JSON data."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+async def sentence_events(pieces, mode="sentence", cancellation=None):
+    """
+    Turn an async iterator of streamed answer text into server-sent events:
+    a "sentence" event ({"index", "text"}, the id is the index) per complete sentence or clause
+    and a final "done" event ({"count", "text", "cancelled"}).
+    """
+    chunker = SentenceChunker(mode)
+    index = 0
+    answer = ""
+    async for piece in pieces:
+        answer += piece
+        for chunk in chunker.feed(piece):
+            yield format_event("sentence", {"index": index, "text": chunk}, event_id=index)
+            index += 1
+    for chunk in chunker.finish():
+        yield format_event("sentence", {"index": index, "text": chunk}, event_id=index)
+        index += 1
+    cancelled = cancellation.reason if cancellation is not None else None
+    yield format_event("done", {"count": index, "text": answer, "cancelled": cancelled})
@@ -0,0 +1,76 @@
+# Loaders of the summarization model (SUMMARY_BACKEND):
+# - torch: the float32 PyTorch model
+# - int8: the PyTorch model with dynamically quantized int8 Linear layers (about a quarter of the weight memory, faster on CPU)
+# - onnx: the model exported to ONNX and run with ONNX Runtime (needs optimum[onnxruntime], the export is saved and reused)
+#
+# Every loader returns a model with generate() and device, so summary_generator works the same with all of them.
+import os
+
+BACKENDS = ("torch", "int8", "onnx")
+ONNX_ENCODER_FILE = "encoder_model.onnx"
+
+
+def set_torch_threads(threads):
+    """Limit the threads torch uses for one operation (0 = torch default, all cores)."""
+    import torch
+
+    if threads > 0:
+        torch.set_num_threads(threads)
+
+
+def load_torch(model_path, threads=0):
+    from transformers import AutoModelForSeq2SeqLM
+
+    set_torch_threads(threads)
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
+    model.eval()
+    return model
+
+
+def load_int8(model_path, threads=0):
+    import torch
+
+    model = load_torch(model_path, threads)
+    try:
+        quantize_dynamic = torch.ao.quantization.quantize_dynamic
+    except AttributeError:
+        # torch < 1.10
+        quantize_dynamic = torch.quantization.quantize_dynamic
+    # in place, so the float32 weights of the Linear layers are freed instead of kept next to the int8 copy
+    return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def load_onnx(model_path, threads=0, onnx_path=None):
+    """
+    Load the ONNX export of model_path from onnx_path (default: model_path/onnx), the first load exports and saves it.
+    ONNX Runtime runs one operation with threads (0 = all cores) and doesn't spin waiting for work between operations,
+    so idle summarizer threads don't take cores from llama.cpp.
+    """
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+
+    onnx_path = onnx_path or os.path.join(model_path, "onnx")
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = threads
+    session_options.inter_op_num_threads = 1
+    session_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    session_options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+
+    if os.path.exists(os.path.join(onnx_path, ONNX_ENCODER_FILE)):
+        return ORTModelForSeq2SeqLM.from_pretrained(onnx_path, session_options=session_options)
+
+    print(f"Exporting the summarization model to ONNX ({onnx_path})...")
+    model = ORTModelForSeq2SeqLM.from_pretrained(model_path, export=True, session_options=session_options)
+    model.save_pretrained(onnx_path)
+    return model
+
+
+def load_model(backend, model_path, threads=0, onnx_path=None):
+    """Return the summarization model of model_path, loaded with backend (one of BACKENDS)."""
+    if backend == "torch":
+        return load_torch(model_path, threads)
+    if backend == "int8":
+        return load_int8(model_path, threads)
+    if backend == "onnx":
+        return load_onnx(model_path, threads, onnx_path)
+    raise ValueError(f"unknown summary backend: {backend} (use one of {', '.join(BACKENDS)})")
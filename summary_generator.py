@@ -1,89 +1,320 @@
-import os
-import torch
-import nltk
-from transformers import pipeline, AutoTokenizer
-
-# model: https://huggingface.co/kabita-choudhary/finetuned-bart-for-conversation-summary
-# code: https://huggingface.co/knkarthick/MEETING-SUMMARY-BART-LARGE-XSUM-SAMSUM-DIALOGSUM-AMI
-
-nltk.download('punkt')
-
-model_file = "pytorch_model.bin"
-
-transformer_model_path = "/root/.cache/summary/"
-# check if model path exists
-if not os.path.exists(transformer_model_path + model_file):
-    transformer_model_path = "cache/summary/"
-
-#summarizer = pipeline("summarization", model="kabita-choudhary/finetuned-bart-for-conversation-summary", device="cpu")
-#summarizer = pipeline("summarization", model=transformer_model_path, device_map="auto", torch_dtype=torch.bfloat16)
-summarizer = pipeline("summarization", model=transformer_model_path, device_map="cpu")
-
-# Initialize the tokenizer based on the model
-tokenizer = AutoTokenizer.from_pretrained(transformer_model_path)
-
-max_token_length = 512 # 512 for most BART models, 1024 for T5 or GPT-2 models
-
-# Function to chunk text
-def chunk_text(text, max_length):
-    total_length = len(tokenizer.encode(text))
-
-    if total_length <= max_length:
-        return [text]
-
-    sentences = nltk.sent_tokenize(text)
-    chunks = []
-    chunk = ""
-    chunk_length = 0
-
-    for sentence in sentences:
-        sentence_length = len(tokenizer.encode(sentence))
-
-        # Special case: if a single sentence is too long
-        if sentence_length > max_length:
-            print("Warning: A sentence exceeded the model's maximum token limit and will be split.")
-            sub_sentences = sentence.split(", ")
-            
-            for sub_sentence in sub_sentences:
-                sub_sentence_length = len(tokenizer.encode(sub_sentence))
-
-                if chunk_length + sub_sentence_length > max_length:
-                    chunks.append(chunk.strip())
-                    chunk = ""
-                    chunk_length = 0
-
-                if sub_sentence_length > max_length:
-                    print("Warning: A sub-sentence still exceeds the model's maximum token limit and will be truncated.")
-                    sub_sentence = tokenizer.decode(tokenizer.encode(sub_sentence)[:max_length])
-                    sub_sentence_length = len(tokenizer.encode(sub_sentence))
-
-                chunk += sub_sentence + ", "
-                chunk_length += sub_sentence_length
-
-            continue
-
-        if chunk_length + sentence_length > max_length:
-            chunks.append(chunk.strip())
-            chunk = ""
-            chunk_length = 0
-
-        chunk += sentence + " "
-        chunk_length += sentence_length
-
-    if chunk:
-        chunks.append(chunk.strip())
-
-    return chunks
-
-
-def summarize(text, max_length=142):
-    # Chunk the text
-    text_chunks = chunk_text(text, tokenizer.model_max_length)
-
-    # Summarize each chunk
-    summarizations = summarizer(text_chunks, max_length=max_length)
-    
-    # Combine the summaries
-    summary_text = ". ".join([summ['summary_text'] for summ in summarizations])
-    
-    return summary_text.strip()
+import collections
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+import lifecycle
+import summary_backends
+
+# model: https://huggingface.co/kabita-choudhary/finetuned-bart-for-conversation-summary
+# code: https://huggingface.co/knkarthick/MEETING-SUMMARY-BART-LARGE-XSUM-SAMSUM-DIALOGSUM-AMI
+
+# SUMMARY_ENABLED=0 starts the server without the summarizer (/summary is unavailable and chat histories are not summarized)
+SUMMARY_ENABLED = os.environ.get('SUMMARY_ENABLED', '1') not in ('0', 'false', 'False')
+
+model_file = "pytorch_model.bin"
+
+transformer_model_path = "/root/.cache/summary/"
+# check if model path exists
+if not os.path.exists(transformer_model_path + model_file):
+    transformer_model_path = "cache/summary/"
+
+# torch (float32), int8 (dynamically quantized torch) or onnx (ONNX Runtime), see summary_backends.py
+SUMMARY_BACKEND = os.environ.get('SUMMARY_BACKEND', 'torch')
+# threads of one summarizer operation (0 = all cores), fewer leave more cores to llama.cpp while chat histories are summarized
+SUMMARY_THREADS = int(os.environ.get('SUMMARY_THREADS', 0))
+# where SUMMARY_BACKEND=onnx saves (and loads) the ONNX export of the model
+SUMMARY_ONNX_PATH = os.environ.get('SUMMARY_ONNX_PATH', os.path.join(transformer_model_path, "onnx"))
+
+# torch, transformers and the models are only loaded on first use (or by warmup at server startup)
+# (summarizer is the seq2seq model of SUMMARY_BACKEND)
+summarizer = None
+tokenizer = None
+sentence_splitter = None
+
+max_token_length = 512 # 512 for most BART models, 1024 for T5 or GPT-2 models
+
+# number of chunks that are summarized together in one model.generate() call
+SUMMARY_BATCH_SIZE = int(os.environ.get('SUMMARY_BATCH_SIZE', 4))
+# map-reduce summaries run this many batches in parallel (torch releases the GIL while generating)
+SUMMARY_PARALLEL_BATCHES = int(os.environ.get('SUMMARY_PARALLEL_BATCHES', 2))
+# stop reducing after this many rounds and join the remaining partial summaries
+SUMMARY_MAX_REDUCE_ROUNDS = 4
+# batch jobs (summarize_batch_stream) put chunks of similar length into one model.generate() call,
+# with at most SUMMARY_BATCH_TOKENS input tokens (including padding), so many short texts are summarized at once.
+SUMMARY_BATCH_TOKENS = int(os.environ.get('SUMMARY_BATCH_TOKENS', 4096))
+SUMMARY_MAX_BATCH_CHUNKS = 64
+
+map_executor = ThreadPoolExecutor(max_workers=SUMMARY_PARALLEL_BATCHES, thread_name_prefix="summary-map")
+
+
+def _load_sentence_splitter():
+    import nltk
+
+    try:
+        # nltk >= 3.8.2
+        return nltk.tokenize.PunktTokenizer()
+    except AttributeError:
+        pass
+    except LookupError:
+        nltk.download('punkt_tab')
+        return nltk.tokenize.PunktTokenizer()
+
+    try:
+        return nltk.data.load('tokenizers/punkt/english.pickle')
+    except LookupError:
+        # only download if the model is not available (so it works offline)
+        nltk.download('punkt')
+        return nltk.data.load('tokenizers/punkt/english.pickle')
+
+
+def _load():
+    global summarizer, tokenizer, sentence_splitter
+    from transformers import AutoTokenizer
+
+    sentence_splitter = _load_sentence_splitter()
+
+    #summarizer = pipeline("summarization", model="kabita-choudhary/finetuned-bart-for-conversation-summary", device="cpu")
+    summarizer = summary_backends.load_model(SUMMARY_BACKEND, transformer_model_path, threads=SUMMARY_THREADS,
+                                             onnx_path=SUMMARY_ONNX_PATH)
+
+    # Initialize the tokenizer based on the model
+    tokenizer = AutoTokenizer.from_pretrained(transformer_model_path)
+
+
+subsystem = lifecycle.Subsystem("summarizer", _load, enabled=SUMMARY_ENABLED, required=False)
+
+
+def _find_comma_cut(text, offsets, start, end):
+    """Return the token index after the last comma in offsets[start:end], only looking at the second half."""
+    for index in range(end - 1, start + (end - start) // 2, -1):
+        token_start, token_end = offsets[index]
+        if token_end > token_start and text[token_end - 1] == ",":
+            return index + 1
+    return end
+
+
+# Function to chunk text
+def chunk_token_ids(text, max_length):
+    """
+    Tokenize text once and split the token ids into chunks of at most max_length tokens (including special tokens).
+
+    Chunks end on sentence boundaries. Sentences that are too long on their own are split after a comma
+    or, if there is none, at the token limit. Runs in linear time over the number of tokens.
+    """
+    subsystem.ensure_loaded()
+
+    # cut the text right after each sentence, so the whitespace in front of a sentence stays attached to it.
+    # (byte-level BPE then produces the same tokens as for the whole text, but the sentences are tokenized as one parallel batch)
+    cuts = [sentence_end for _, sentence_end in sentence_splitter.span_tokenize(text)][:-1]
+    segment_starts = [0] + cuts
+    segments = [text[start:end] for start, end in zip(segment_starts, cuts + [len(text)])]
+    encodings = tokenizer(segments, add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+
+    input_ids = []
+    offsets = []
+    boundaries = []  # token index where each sentence ends
+    for segment_start, segment_ids, segment_offsets in zip(segment_starts, encodings['input_ids'], encodings['offset_mapping']):
+        input_ids += segment_ids
+        offsets += [(segment_start + start, segment_start + end) for start, end in segment_offsets]
+        boundaries.append(len(input_ids))
+
+    # leave room for the special tokens added by build_inputs_with_special_tokens()
+    budget = max_length - tokenizer.num_special_tokens_to_add()
+    if len(input_ids) <= budget:
+        return [input_ids]
+
+    chunks = []
+    chunk_start = 0
+    last_boundary = 0
+    for boundary in boundaries:
+        if boundary - chunk_start > budget and last_boundary > chunk_start:
+            chunks.append(input_ids[chunk_start:last_boundary])
+            chunk_start = last_boundary
+
+        # Special case: if a single sentence is too long
+        while boundary - chunk_start > budget:
+            cut = _find_comma_cut(text, offsets, chunk_start, chunk_start + budget)
+            chunks.append(input_ids[chunk_start:cut])
+            chunk_start = cut
+
+        last_boundary = boundary
+
+    if chunk_start < len(input_ids):
+        chunks.append(input_ids[chunk_start:])
+
+    return chunks
+
+
+def chunk_text(text, max_length):
+    """Split text into chunks of at most max_length tokens. (see chunk_token_ids)"""
+    subsystem.ensure_loaded()
+    return [tokenizer.decode(chunk).strip() for chunk in chunk_token_ids(text, max_length)]
+
+
+def generation_settings(model, max_length):
+    """
+    Return the model.generate() settings for summaries of up to max_length tokens: the task_specific_params['summarization']
+    of the model config (like num_beams, length_penalty, no_repeat_ngram_size), which the summarization pipeline applied.
+    """
+    task_params = getattr(getattr(model, 'config', None), 'task_specific_params', None) or {}
+    # (the prefix is part of the input text, not a generate() setting)
+    settings = {key: value for key, value in task_params.get('summarization', {}).items() if key != 'prefix'}
+    settings['max_length'] = max_length
+    if settings.get('min_length', 0) > max_length:
+        settings['min_length'] = max_length
+    return settings
+
+
+def summarize_token_chunks(chunks, max_length=142, batch_size=None):
+    """
+    Summarize already tokenized chunks (see chunk_token_ids) without tokenizing them again.
+    batch_size chunks (default SUMMARY_BATCH_SIZE) are summarized together in one model.generate() call.
+    """
+    import torch
+
+    subsystem.ensure_loaded()
+    model = summarizer
+    batch_size = batch_size or SUMMARY_BATCH_SIZE
+    settings = generation_settings(model, max_length)
+    summaries = []
+    for batch_start in range(0, len(chunks), batch_size):
+        batch = [tokenizer.build_inputs_with_special_tokens(chunk) for chunk in chunks[batch_start:batch_start + batch_size]]
+        inputs = tokenizer.pad({'input_ids': batch}, return_tensors="pt").to(model.device)
+        with torch.no_grad():
+            output_ids = model.generate(**inputs, **settings)
+        summaries += tokenizer.batch_decode(output_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+    return [summary.strip() for summary in summaries]
+
+
+def summarize(text, max_length=142):
+    subsystem.ensure_loaded()
+
+    # Chunk the text
+    token_chunks = chunk_token_ids(text, tokenizer.model_max_length)
+
+    # Summarize each chunk
+    summarizations = summarize_token_chunks(token_chunks, max_length=max_length)
+
+    # Combine the summaries
+    summary_text = ". ".join(summarizations)
+
+    return summary_text.strip()
+
+
+def _map_chunks(chunks, max_length):
+    """Summarize chunks in parallel batches and yield (chunk index, summary) in order of completion."""
+    futures = {}
+    for batch_start in range(0, len(chunks), SUMMARY_BATCH_SIZE):
+        future = map_executor.submit(summarize_token_chunks, chunks[batch_start:batch_start + SUMMARY_BATCH_SIZE], max_length)
+        futures[future] = batch_start
+    for future in as_completed(futures):
+        for offset, summary in enumerate(future.result()):
+            yield futures[future] + offset, summary
+
+
+def summarize_map_reduce_stream(text, max_length=142):
+    """
+    Map-reduce summary of text, yielding progress as dicts.
+
+    The chunks of the text are summarized in parallel ({"type": "partial", "index": i, "summary": ...} per chunk),
+    then the partial summaries are joined, chunked and summarized again until everything fits into a single chunk,
+    which gives the final summary ({"type": "final", "summary": ...}).
+    """
+    subsystem.ensure_loaded()
+    chunks = chunk_token_ids(text, tokenizer.model_max_length)
+    reduce_round = 0
+    while True:
+        summaries = [""] * len(chunks)
+        for index, summary in _map_chunks(chunks, max_length):
+            summaries[index] = summary
+            if reduce_round == 0 and len(chunks) > 1:
+                yield {"type": "partial", "index": index, "summary": summary}
+
+        if len(chunks) == 1:
+            final_summary = summaries[0]
+            break
+        reduce_round += 1
+        if reduce_round > SUMMARY_MAX_REDUCE_ROUNDS:
+            final_summary = ". ".join(summaries)
+            break
+        chunks = chunk_token_ids("\n".join(summaries), tokenizer.model_max_length)
+
+    yield {"type": "final", "summary": final_summary.strip()}
+
+
+def summarize_map_reduce(text, max_length=142):
+    """Summarize text in parallel chunks and reduce the partial summaries into a single summary of max_length tokens."""
+    summary_text = ""
+    for event in summarize_map_reduce_stream(text, max_length=max_length):
+        if event["type"] == "final":
+            summary_text = event["summary"]
+    return summary_text
+
+
+def _length_batches(entries):
+    """
+    Split entries ((key, token ids) pairs) into batches of similar length, the shortest first.
+    A batch has at most SUMMARY_BATCH_TOKENS tokens when padded to its longest chunk.
+    """
+    special_tokens = tokenizer.num_special_tokens_to_add()
+    batches = []
+    batch = []
+    for entry in sorted(entries, key=lambda entry: len(entry[1])):
+        # sorted by length, so the new chunk is the longest of the batch
+        padded_tokens = (len(batch) + 1) * (len(entry[1]) + special_tokens)
+        if batch and (padded_tokens > SUMMARY_BATCH_TOKENS or len(batch) >= SUMMARY_MAX_BATCH_CHUNKS):
+            batches.append(batch)
+            batch = []
+        batch.append(entry)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def summarize_batch_stream(texts, max_length=142, mode="concat"):
+    """
+    Summarize many texts and yield (index, summary) as the texts are done.
+
+    The chunks of all texts are batched by length (see _length_batches), at most SUMMARY_PARALLEL_BATCHES batches
+    are summarized at a time, so other summaries get their turn on map_executor in between.
+    mode "concat" joins the summaries of the chunks of a text, "map_reduce" summarizes them again (like summarize_map_reduce).
+    """
+    subsystem.ensure_loaded()
+    items = []
+    entries = []
+    for index, text in enumerate(texts):
+        if not text.strip():
+            items.append(None)
+            yield index, ""
+            continue
+        chunks = chunk_token_ids(text, tokenizer.model_max_length)
+        items.append({"summaries": [None] * len(chunks), "remaining": len(chunks), "round": 0})
+        entries += [((index, chunk_index), chunk) for chunk_index, chunk in enumerate(chunks)]
+
+    batches = collections.deque(_length_batches(entries))
+    futures = {}
+    while batches or futures:
+        while batches and len(futures) < SUMMARY_PARALLEL_BATCHES:
+            batch = batches.popleft()
+            futures[map_executor.submit(summarize_token_chunks, [chunk for _, chunk in batch], max_length, len(batch))] = batch
+
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        entries = []
+        for future in done:
+            batch = futures.pop(future)
+            for ((index, chunk_index), _), summary in zip(batch, future.result()):
+                item = items[index]
+                item["summaries"][chunk_index] = summary
+                item["remaining"] -= 1
+                if item["remaining"] > 0:
+                    continue
+                summaries = item["summaries"]
+                if mode == "map_reduce" and len(summaries) > 1 and item["round"] < SUMMARY_MAX_REDUCE_ROUNDS:
+                    # reduce: summarize the joined summaries again
+                    chunks = chunk_token_ids("\n".join(summaries), tokenizer.model_max_length)
+                    item.update(summaries=[None] * len(chunks), remaining=len(chunks), round=item["round"] + 1)
+                    entries += [((index, chunk_index), chunk) for chunk_index, chunk in enumerate(chunks)]
+                    continue
+                yield index, ". ".join(summaries).strip()
+        if entries:
+            batches.extend(_length_batches(entries))
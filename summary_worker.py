@@ -0,0 +1,55 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SummaryWorker:
+    def __init__(self, summarize_chat, max_workers=1):
+        """
+        Run summarize_chat(chat_key) on a bounded thread pool.
+
+        A chat is summarized by at most one worker at a time. Requests for a chat that is already
+        queued are dropped, requests for a chat that is currently being summarized are coalesced
+        into a single follow-up run.
+        """
+        self.summarize_chat = summarize_chat
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summary")
+        self._lock = threading.Lock()
+        self._queued = set()
+        self._running = set()
+        self._rerun = set()
+
+    def request(self, chat_key):
+        """Ask for a summary of chat_key. Returns False if the request was coalesced with a pending one."""
+        with self._lock:
+            if chat_key in self._queued:
+                return False
+            if chat_key in self._running:
+                self._rerun.add(chat_key)
+                return False
+            self._queued.add(chat_key)
+        self._executor.submit(self._run, chat_key)
+        return True
+
+    def pending_count(self):
+        """Return the number of chats waiting for or running a summary."""
+        with self._lock:
+            return len(self._queued | self._running)
+
+    def _run(self, chat_key):
+        with self._lock:
+            self._queued.discard(chat_key)
+            self._running.add(chat_key)
+        try:
+            self.summarize_chat(chat_key)
+        except Exception as e:
+            print(f"Error summarizing chat '{chat_key}': {e}")
+        finally:
+            with self._lock:
+                self._running.discard(chat_key)
+                rerun = chat_key in self._rerun
+                self._rerun.discard(chat_key)
+            if rerun:
+                self.request(chat_key)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+REPOSITORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPOSITORY_DIR)
+sys.path.insert(0, os.path.join(REPOSITORY_DIR, "benchmarks"))
+
+
+@pytest.fixture(scope="session")
+def chatbot(tmp_path_factory):
+    """chatbot with the stub models (see benchmarks/stub_backends.py), histories in a temporary directory."""
+    os.environ.update(AUTH_TOKEN="test", WARMUP="lazy", SUMMARY_ENABLED="0", LONG_TERM_MEMORY="0")
+    working_directory = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("chatbot"))
+    import stub_backends
+    stub_backends.install(token_latency=0.0, prompt_token_latency=0.0, answer_tokens=8)
+    import chatbot
+    yield chatbot
+    os.chdir(working_directory)
@@ -0,0 +1,41 @@
+import threading
+import time
+
+import chat_history
+import history_store
+
+
+def test_lock_of_an_evicted_chat_is_shared_until_unused(tmp_path):
+    manager = chat_history.ChatManager(max_resident_chats=1, store=history_store.JsonFileHistoryStore(str(tmp_path)))
+    manager.add_message("a", "user", "hello")
+    holding, release = threading.Event(), threading.Event()
+    inside, seen_by_waiter = [], []
+
+    def hold():
+        with manager._get_lock("a"):
+            inside.append("holder")
+            holding.set()
+            release.wait(5)
+            inside.remove("holder")
+
+    def wait_for_lock():
+        with manager._get_lock("a"):
+            seen_by_waiter.append(list(inside))
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    holding.wait(5)
+    waiter = threading.Thread(target=wait_for_lock)
+    waiter.start()
+    time.sleep(0.05)
+    # evict chat "a" while its lock is held and waited for (writing it back would wait for the lock)
+    manager.save_history = lambda chat_key: None
+    manager.add_message("b", "user", "hello")
+    assert not manager.is_resident("a")
+    assert "a" in manager.locks
+
+    release.set()
+    holder.join()
+    waiter.join()
+    assert seen_by_waiter == [[]]
+    assert "a" not in manager.locks
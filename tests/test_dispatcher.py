@@ -0,0 +1,52 @@
+import asyncio
+import gc
+import subprocess
+import sys
+
+import conftest
+import dispatcher
+
+
+def test_history_instructions_does_not_import_chatbot():
+    # importing chatbot would open the chat histories and start its threads in the dispatcher process
+    code = "import sys, dispatcher; print(sorted(dispatcher.history_instructions())); print('chatbot' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=conftest.REPOSITORY_DIR, check=True)
+    assert output.stdout.strip().splitlines()[-1] == "False"
+
+
+
+def test_worker_override_is_ignored_for_chat_history_requests():
+    d = dispatcher.Dispatcher(3, history_instructions={"chat"})
+    chat_worker = d.route("/chat?instruction_name=chat&session_id=alice")
+    other = (chat_worker.index + 1) % 3
+    assert d.route(f"/chat?instruction_name=chat&session_id=alice&worker={other}") is chat_worker
+    assert d.route(f"/ready?worker={other}").index == other
+    assert d.route(f"/chat?instruction_name=chat&disable_history=1&worker={other}").index == other
+
+
+def test_half_closed_client_gets_the_response():
+    async def run():
+        async def worker(reader, writer):
+            await reader.readuntil(b"\r\n\r\n")
+            # the answer takes a while, the client has shut down its sending side meanwhile
+            await asyncio.sleep(0.2)
+            # (the dispatcher must keep its connection alive meanwhile)
+            gc.collect()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 6\r\nConnection: close\r\n\r\nanswer")
+            await writer.drain()
+            writer.close()
+
+        worker_server = await asyncio.start_server(worker, "127.0.0.1", 0)
+        d = dispatcher.Dispatcher(1, base_port=worker_server.sockets[0].getsockname()[1])
+        dispatcher_server = await asyncio.start_server(d.handle, "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", dispatcher_server.sockets[0].getsockname()[1])
+        writer.write(b"GET /chat?text_prompt=hi HTTP/1.1\r\nHost: x\r\n\r\n")
+        writer.write_eof()
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        dispatcher_server.close()
+        worker_server.close()
+        return response
+
+    response = asyncio.run(run())
+    assert response.startswith(b"HTTP/1.1 200 OK") and response.endswith(b"answer")
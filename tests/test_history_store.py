@@ -0,0 +1,44 @@
+import os
+import sqlite3
+
+import pytest
+
+import history_store
+
+
+def test_journal_keeps_operations_when_writing_fails(tmp_path):
+    directory = tmp_path / "histories"
+    # a file in place of the directory makes every write fail
+    directory.write_text("")
+    store = history_store.JournalHistoryStore(str(directory), flush_interval=3600)
+    store.append_message("chat", {"content": "first"})
+    store.flush()
+    store.append_message("chat", {"content": "second"})
+
+    os.remove(directory)
+    store.flush()
+    store.close()
+
+    chat = history_store.JournalHistoryStore(str(directory), flush_interval=3600).load("chat")
+    assert [message["content"] for message in chat["messages"]] == ["first", "second"]
+
+
+def test_sqlite_keeps_operations_when_the_commit_fails(tmp_path):
+    store = history_store.SQLiteHistoryStore(str(tmp_path / "chats.sqlite3"), flush_interval=3600, legacy_directory=None)
+    failures = [sqlite3.OperationalError("disk I/O error")]
+
+    def fails_once(connection):
+        if failures:
+            raise failures.pop()
+
+    store.append_message("chat", {"content": "first"})
+    with store._lock:
+        store._write(fails_once)
+    store.append_message("chat", {"content": "second"})
+    with pytest.raises(sqlite3.OperationalError):
+        store.flush()
+
+    store.flush()
+    chat = store.load("chat")
+    assert [message["content"] for message in chat["messages"]] == ["first", "second"]
+    store.close()
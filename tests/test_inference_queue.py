@@ -0,0 +1,113 @@
+import asyncio
+import gc
+import threading
+
+import pytest
+
+import inference_queue
+
+
+def test_release_frees_the_slot_for_the_next_request():
+    scheduler = inference_queue.InferenceScheduler(max_queue_size=4, max_concurrency=1)
+    first = scheduler.submit().wait()
+    second = scheduler.submit()
+    assert not second.granted
+    first.release()
+    assert second.granted
+    second.release()
+    assert scheduler.active_count() == 0
+
+
+def test_release_after_an_error_in_the_context_manager():
+    scheduler = inference_queue.InferenceScheduler(max_concurrency=1)
+    with pytest.raises(RuntimeError):
+        with scheduler.submit():
+            raise RuntimeError("generation failed")
+    assert scheduler.active_count() == 0
+
+
+def test_release_is_idempotent():
+    scheduler = inference_queue.InferenceScheduler(max_concurrency=1)
+    ticket = scheduler.submit().wait()
+    ticket.release()
+    ticket.release()
+    assert scheduler.active_count() == 0
+    assert scheduler.submit().granted
+
+
+def test_waiting_ticket_leaves_the_queue_when_cancelled():
+    scheduler = inference_queue.InferenceScheduler(max_concurrency=1)
+    holder = scheduler.submit().wait()
+    cancellation = inference_queue.Cancellation()
+    waiting = scheduler.submit()
+    threading.Timer(0.05, cancellation.cancel).start()
+    with pytest.raises(inference_queue.RequestCancelledError):
+        waiting.wait(cancellation)
+    assert scheduler.queue_depth() == 0
+    holder.release()
+    assert scheduler.active_count() == 0
+
+
+def test_waiting_ticket_times_out():
+    scheduler = inference_queue.InferenceScheduler(max_concurrency=1)
+    holder = scheduler.submit().wait()
+    with pytest.raises(inference_queue.QueueTimeoutError):
+        scheduler.submit(timeout=0.05).wait()
+    assert scheduler.queue_depth() == 0
+    holder.release()
+
+
+def test_full_queue_is_rejected():
+    scheduler = inference_queue.InferenceScheduler(max_queue_size=1, max_concurrency=1)
+    scheduler.submit().wait()
+    scheduler.submit()
+    with pytest.raises(inference_queue.QueueFullError):
+        scheduler.submit()
+
+
+def test_stream_that_is_never_iterated_calls_on_unused():
+    released = []
+
+    async def main():
+        stream = inference_queue.stream_from_thread(lambda emit: emit(1), on_unused=lambda: released.append("dropped"))
+        del stream
+        gc.collect()
+        stream = inference_queue.stream_from_thread(lambda emit: emit(1), on_unused=lambda: released.append("closed"))
+        await stream.aclose()
+        stream = inference_queue.stream_from_thread(lambda emit: emit(1), on_unused=lambda: released.append("iterated"))
+        assert [item async for item in stream] == [1]
+
+    asyncio.run(main())
+    assert released == ["dropped", "closed"]
+
+
+def _consume(stream):
+    async def main():
+        return [item async for item in stream]
+    return asyncio.run(main())
+
+
+def test_stream_releases_the_ticket_when_the_prompt_can_not_be_built(chatbot, monkeypatch):
+    def broken_build_prompt(*args, **kwargs):
+        raise OSError("history store is not available")
+
+    monkeypatch.setattr(chatbot, "build_prompt", broken_build_prompt)
+    scheduler = chatbot.get_model("_").scheduler
+    assert _consume(chatbot.message_stream("hello", disable_history=True)) == []
+    assert scheduler.active_count() == 0
+    assert scheduler.queue_depth() == 0
+
+
+def test_stream_that_is_never_iterated_releases_the_ticket(chatbot):
+    scheduler = chatbot.get_model("_").scheduler
+
+    async def main():
+        stream = chatbot.message_stream("hello", disable_history=True)
+        assert scheduler.active_count() + scheduler.queue_depth() == 1
+        del stream
+        gc.collect()
+
+    asyncio.run(main())
+    assert scheduler.active_count() == 0
+    assert scheduler.queue_depth() == 0
+    assert chatbot.message("hello", disable_history=True, timeout=3) != ""
@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+import inference_queue
+import response_cache
+
+
+def start_leader(cache, compute):
+    """Run get_or_compute(compute) on a thread, return the thread and a list that gets its result or error."""
+    result = []
+
+    def run():
+        try:
+            result.append(cache.get_or_compute("key", compute))
+        except Exception as e:
+            result.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    # let the leader register its computation
+    time.sleep(0.05)
+    return thread, result
+
+
+def slow(value=None, error=None, seconds=0.2):
+    def compute():
+        time.sleep(seconds)
+        if error is not None:
+            raise error
+        return value
+    return compute
+
+
+def test_identical_request_gets_the_value_of_the_leader():
+    cache = response_cache.ResponseCache(capacity_bytes=1 << 20)
+    thread, result = start_leader(cache, slow("answer"))
+    assert cache.get_or_compute("key", lambda: pytest.fail("computed twice")) == ("answer", "coalesced")
+    thread.join()
+    assert result == [("answer", "miss")]
+    assert cache.get_or_compute("key", lambda: None) == ("answer", "hit")
+
+
+def test_generation_errors_are_shared():
+    cache = response_cache.ResponseCache(capacity_bytes=1 << 20)
+    thread, _ = start_leader(cache, slow(error=ValueError("invalid prompt")))
+    with pytest.raises(ValueError):
+        cache.get_or_compute("key", lambda: pytest.fail("computed twice"))
+    thread.join()
+
+
+@pytest.mark.parametrize("error", [inference_queue.RequestCancelledError("deadline"),
+                                   inference_queue.QueueTimeoutError("timeout")])
+def test_identical_request_computes_itself_if_the_leader_was_cancelled(error):
+    cache = response_cache.ResponseCache(capacity_bytes=1 << 20)
+    thread, result = start_leader(cache, slow(error=error))
+    assert cache.get_or_compute("key", lambda: "own answer") == ("own answer", "miss")
+    thread.join()
+    assert result == [error]
+    assert cache.get_or_compute("key", lambda: None) == ("own answer", "hit")
+
+
+def test_waiting_request_honors_its_cancellation():
+    cache = response_cache.ResponseCache(capacity_bytes=1 << 20)
+    thread, result = start_leader(cache, slow("answer", seconds=1.0))
+    start_time = time.monotonic()
+    with pytest.raises(inference_queue.RequestCancelledError):
+        cache.get_or_compute("key", lambda: "other", inference_queue.Cancellation(0.2))
+    assert time.monotonic() - start_time < 0.6
+    thread.join()
+    assert result == [("answer", "miss")]
+
+
+def test_uncacheable_value_is_not_stored():
+    cache = response_cache.ResponseCache(capacity_bytes=1 << 20)
+    assert cache.get_or_compute("key", lambda: None) == (None, "miss")
+    assert cache.get_or_compute("key", lambda: "answer") == ("answer", "miss")
@@ -0,0 +1,22 @@
+import types
+
+import summary_generator
+
+
+def model_with(task_specific_params):
+    return types.SimpleNamespace(config=types.SimpleNamespace(task_specific_params=task_specific_params))
+
+
+def test_generation_settings_use_the_summarization_params_of_the_model():
+    model = model_with({'summarization': {'num_beams': 4, 'length_penalty': 2.0, 'min_length': 56, 'max_length': 142,
+                                          'no_repeat_ngram_size': 3, 'prefix': ""},
+                        'translation_en_to_de': {'num_beams': 8}})
+    assert summary_generator.generation_settings(model, 200) == {
+        'num_beams': 4, 'length_penalty': 2.0, 'min_length': 56, 'max_length': 200, 'no_repeat_ngram_size': 3}
+    # a shorter max_length than min_length would never end a summary in time
+    assert summary_generator.generation_settings(model, 32)['min_length'] == 32
+
+
+def test_generation_settings_without_summarization_params():
+    assert summary_generator.generation_settings(model_with(None), 142) == {'max_length': 142}
+    assert summary_generator.generation_settings(object(), 142) == {'max_length': 142}
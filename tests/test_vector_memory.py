@@ -0,0 +1,31 @@
+import os
+
+import vector_memory
+
+
+def test_embedder_falls_back_to_hashing_if_the_model_can_not_be_loaded(monkeypatch):
+    def offline(model_name):
+        raise OSError(f"can't download {model_name}")
+
+    monkeypatch.setattr(vector_memory, "SentenceTransformerEmbedder", offline)
+    assert isinstance(vector_memory.load_embedder("all-MiniLM-L6-v2"), vector_memory.HashingEmbedder)
+
+
+def test_torn_last_line_is_cut_off_on_open(tmp_path):
+    embedder = vector_memory.HashingEmbedder()
+    index = vector_memory.MemoryIndex(str(tmp_path), embedder)
+    memories = [{"name": "User", "text": f"first memory {i}", "time": i} for i in range(3)]
+    index.append(memories, embedder.encode([memory['text'] for memory in memories]))
+    index.save()
+    # a crash while appending
+    with open(os.path.join(tmp_path, "memories.jsonl"), "a") as file:
+        file.write('{"name": "User", "te')
+
+    index = vector_memory.MemoryIndex(str(tmp_path), embedder)
+    memories = [{"name": "User", "text": "after the crash", "time": 3}]
+    index.append(memories, embedder.encode(["after the crash"]))
+    index.save()
+
+    index = vector_memory.MemoryIndex(str(tmp_path), embedder)
+    assert [memory['text'] for memory in index.memories][-1] == "after the crash"
+    assert index.count == len(index.memories) == 4
@@ -0,0 +1,339 @@
+import atexit
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import lifecycle
+
+# rows of the vector file scored at once by the exact search (without hnswlib)
+EXACT_SEARCH_CHUNK = 65536
+# HNSW search breadth (higher finds the true nearest memories more often, but is slower)
+HNSW_EF_SEARCH = 128
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class SentenceTransformerEmbedder:
+    def __init__(self, model_name):
+        """CPU embeddings with sentence-transformers (like all-MiniLM-L6-v2, 384 dimensions)."""
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.name = model_name
+        self.dimension = self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts):
+        return self.model.encode(texts, batch_size=32, convert_to_numpy=True, normalize_embeddings=True).astype(np.float32)
+
+
+class HashingEmbedder:
+    def __init__(self, dimension=384):
+        """
+        Fallback without sentence-transformers: signed feature hashing of the words and word pairs of a text.
+        Only finds memories that share words with the query.
+        """
+        self.name = f"hashing-{dimension}"
+        self.dimension = dimension
+
+    def encode(self, texts):
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            # short words are mostly stop words
+            words = [word for word in re.findall(r"\w+", text.lower()) if len(word) > 2]
+            for feature in words + [a + " " + b for a, b in zip(words, words[1:])]:
+                value = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+                vectors[row, value % self.dimension] += 1.0 if value >> 63 else -1.0
+        return _normalize(vectors)
+
+
+def load_embedder(model_name):
+    """
+    Return a SentenceTransformerEmbedder of model_name, or the HashingEmbedder if sentence-transformers is not installed
+    or the model can't be loaded (like on an offline host without the model in the cache).
+    """
+    try:
+        return SentenceTransformerEmbedder(model_name)
+    except ImportError:
+        print("sentence-transformers is not installed, long-term memory uses hashed word features.")
+    except Exception as e:
+        print(f"Error loading embedding model {model_name} ({e}), long-term memory uses hashed word features.")
+    return HashingEmbedder()
+
+
+class MemoryIndex:
+    def __init__(self, directory, embedder, use_ann=True):
+        """
+        Long-term memories of one chat in directory: the texts in memories.jsonl, their vectors (float16)
+        in the memory-mapped vectors.f16 and, if hnswlib is installed, an HNSW index in index.hnsw.
+
+        Memories without a vector (written before a crash, or embedded with another model) are embedded on open.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.embedder = embedder
+        self.dimension = embedder.dimension
+        self.lock = threading.Lock()
+
+        meta = {}
+        try:
+            with open(self._path("meta.json"), "r") as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            pass
+        self.memories = self._read_memories()
+        self.count = 0
+        if meta.get("model") == embedder.name and meta.get("dimension") == self.dimension:
+            self.count = min(meta.get("count", 0), len(self.memories))
+
+        self.capacity = 0
+        self.vectors = None
+        self.ann = None
+        self._ensure_capacity(max(len(self.memories), 1024))
+
+        if use_ann:
+            self._open_ann(meta.get("ann_count", 0) if self.count else 0)
+
+        # embed the memories that have no vector yet
+        missing = self.memories[self.count:]
+        for start in range(0, len(missing), 256):
+            batch = missing[start:start + 256]
+            self._add_vectors(embedder.encode([memory['text'] for memory in batch]))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_memories(self):
+        """Read memories.jsonl, a partially written last line (a crash while appending) is cut off, so appends start on a new line."""
+        memories = []
+        try:
+            with open(self._path("memories.jsonl"), "rb+") as file:
+                data = file.read()
+                end = 0
+                for line in data.splitlines(keepends=True):
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("incomplete line")
+                        memories.append(json.loads(line))
+                    except ValueError:
+                        break
+                    end += len(line)
+                if end < len(data):
+                    file.truncate(end)
+        except OSError:
+            pass
+        return memories
+
+    def _ensure_capacity(self, needed):
+        if needed <= self.capacity:
+            return
+        capacity = max(needed, self.capacity * 2)
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        filename = self._path("vectors.f16")
+        with open(filename, "ab") as file:
+            file.truncate(capacity * self.dimension * 2)
+        self.vectors = np.memmap(filename, dtype=np.float16, mode="r+", shape=(capacity, self.dimension))
+        self.capacity = capacity
+        if self.ann is not None and self.ann.get_max_elements() < capacity:
+            self.ann.resize_index(capacity)
+
+    def _open_ann(self, ann_count):
+        try:
+            import hnswlib
+        except ImportError:
+            return
+        self.ann = hnswlib.Index(space="ip", dim=self.dimension)
+        filename = self._path("index.hnsw")
+        if 0 < ann_count <= self.count and os.path.exists(filename):
+            try:
+                self.ann.load_index(filename, max_elements=self.capacity)
+            except RuntimeError as e:
+                print(f"Error loading memory index {filename}: {e}")
+                ann_count = 0
+        else:
+            ann_count = 0
+        if ann_count == 0:
+            self.ann.init_index(max_elements=self.capacity, ef_construction=200, M=16)
+        # add the vectors that are not in the saved index yet
+        for start in range(ann_count, self.count, EXACT_SEARCH_CHUNK):
+            end = min(start + EXACT_SEARCH_CHUNK, self.count)
+            self.ann.add_items(np.asarray(self.vectors[start:end], dtype=np.float32), np.arange(start, end))
+
+    def _add_vectors(self, vectors):
+        start = self.count
+        end = start + len(vectors)
+        self._ensure_capacity(end)
+        self.vectors[start:end] = vectors
+        if self.ann is not None:
+            self.ann.add_items(vectors, np.arange(start, end))
+        self.count = end
+
+    def append(self, memories, vectors):
+        """Add memories (dicts with name, text and time) and their normalized vectors."""
+        with self.lock:
+            with open(self._path("memories.jsonl"), "a", encoding="utf-8") as file:
+                for memory in memories:
+                    file.write(json.dumps(memory) + "\n")
+            self.memories += memories
+            self._add_vectors(vectors)
+
+    def search(self, query_vector, candidates):
+        """Return up to candidates (score, memory) pairs, the most similar first."""
+        with self.lock:
+            count = self.count
+            candidates = min(candidates, count)
+            if candidates == 0:
+                return []
+            if self.ann is not None:
+                self.ann.set_ef(max(HNSW_EF_SEARCH, candidates))
+                labels, distances = self.ann.knn_query(query_vector, k=candidates)
+                # inner product space: distance = 1 - similarity
+                return [(1.0 - float(distance), self.memories[label]) for label, distance in zip(labels[0], distances[0])]
+
+            scores = np.empty(count, dtype=np.float32)
+            for start in range(0, count, EXACT_SEARCH_CHUNK):
+                end = min(start + EXACT_SEARCH_CHUNK, count)
+                scores[start:end] = np.asarray(self.vectors[start:end], dtype=np.float32) @ query_vector
+            best = np.argpartition(-scores, candidates - 1)[:candidates]
+            best = best[np.argsort(-scores[best])]
+            return [(float(scores[index]), self.memories[index]) for index in best]
+
+    def save(self):
+        with self.lock:
+            self.vectors.flush()
+            meta = {"model": self.embedder.name, "dimension": self.dimension, "count": self.count}
+            if self.ann is not None:
+                self.ann.save_index(self._path("index.hnsw"))
+                meta["ann_count"] = self.count
+            tmp_filename = self._path("meta.json.tmp")
+            with open(tmp_filename, "w") as file:
+                json.dump(meta, file)
+            os.replace(tmp_filename, self._path("meta.json"))
+
+
+class LongTermMemory:
+    def __init__(self, directory='long_term_memory', embedding_model='sentence-transformers/all-MiniLM-L6-v2',
+                 max_open_chats=16, min_score=0.3, use_ann=True, enabled=True):
+        """
+        Long-term memory of chats: every message is embedded (on a background thread) and stored in a MemoryIndex
+        per chat (directory/<chat_key>/). recall() returns the memories most relevant to a text.
+
+        The embedding model is loaded on first use (see subsystem). At most max_open_chats indexes are kept open,
+        the least recently used one is saved and closed.
+        """
+        self.directory = directory
+        self.embedding_model = embedding_model
+        self.max_open_chats = max_open_chats
+        self.min_score = min_score
+        self.use_ann = use_ann
+        self.embedder = None
+        self.subsystem = lifecycle.Subsystem("embeddings", self._load, enabled=enabled, required=False)
+        self._indexes = OrderedDict()
+        self._indexes_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _load(self):
+        self.embedder = load_embedder(self.embedding_model)
+
+    def _open(self, chat_key, create=True):
+        """Return the MemoryIndex of chat_key (None if it has no memories and create is False)."""
+        with self._indexes_lock:
+            index = self._indexes.get(chat_key)
+            if index is not None:
+                self._indexes.move_to_end(chat_key)
+                return index
+            directory = os.path.join(self.directory, chat_key)
+            if not create and not os.path.exists(directory):
+                return None
+            index = self._indexes[chat_key] = MemoryIndex(directory, self.embedder, use_ann=self.use_ann)
+            while len(self._indexes) > max(self.max_open_chats, 1):
+                _, evicted = self._indexes.popitem(last=False)
+                evicted.save()
+            return index
+
+    def add(self, chat_key, name, text):
+        """Queue a message for embedding."""
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._index_loop, name="long-term-memory", daemon=True)
+                self._thread.start()
+        self._queue.put((chat_key, {"name": name, "text": text, "time": time.time()}))
+
+    def _index_loop(self):
+        while True:
+            items = [self._queue.get()]
+            # embed everything that queued up in one batch
+            while len(items) < 64:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.subsystem.ensure_loaded()
+                rows_by_chat = OrderedDict()
+                for row, (chat_key, _) in enumerate(items):
+                    rows_by_chat.setdefault(chat_key, []).append(row)
+                vectors = self.embedder.encode([memory['text'] for _, memory in items])
+                for chat_key, rows in rows_by_chat.items():
+                    self._open(chat_key).append([items[row][1] for row in rows], vectors[rows])
+            except Exception as e:
+                print(f"Error adding long-term memories: {e}")
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def flush(self):
+        """Wait until all queued messages are embedded and save the open indexes."""
+        self._queue.join()
+        with self._indexes_lock:
+            indexes = list(self._indexes.values())
+        for index in indexes:
+            index.save()
+
+    def search(self, chat_key, text, candidates=8):
+        """Return up to candidates (score, memory) pairs of chat_key that are similar to text, the most similar first."""
+        self.subsystem.ensure_loaded()
+        index = self._open(chat_key, create=False)
+        if index is None:
+            return []
+        query_vector = self.embedder.encode([text])[0]
+        return [(score, memory) for score, memory in index.search(query_vector, candidates) if score >= self.min_score]
+
+    def recall(self, chat_key, text, token_budget, token_counter, top_k=8, exclude=()):
+        """
+        Return the "name: text" lines of the memories most relevant to text that fit into token_budget (in the order they were added).
+        Memories whose (name, text) is in exclude (like the messages that are still in the chat history) are skipped.
+        """
+        exclude = set(exclude)
+        selected = []
+        for _, memory in self.search(chat_key, text, candidates=top_k + len(exclude)):
+            if (memory['name'], memory['text']) in exclude:
+                continue
+            line = f"{memory['name']}: {memory['text']}"
+            # +1 for the line break
+            tokens = token_counter(line) + 1
+            if tokens > token_budget:
+                continue
+            token_budget -= tokens
+            selected.append((memory['time'], line))
+            if len(selected) >= top_k:
+                break
+        return [line for _, line in sorted(selected)]
+
+    def close(self):
+        if self.subsystem.is_ready():
+            self.flush()